@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# vim: set et ts=4 sw=4 sts=4:
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''Check the asyncio functions of dispass.api against the synchronous ones
+
+USAGE: python bench/asyncapi.py [-s <size>]
+
+Options:
+-s <size>     number of labels (default: 1000)
+
+Every check runs coroutines on an event loop, the way the example in
+`dispass.api` does, and compares the passphrases with those of
+`derive()` and `deriveMany()`:
+
+``deriveAsync``     a labelname and a label record
+``deriveMany``      all labels, in order, with the default executor and
+                    with an executor of 2 threads; also no labels
+``streamAsync``     all labels, in the order the chunks are finished
+``failure``         an unknown algorithm fails the future of the chunk
+
+Needs the trollius and futures packages, the checks are skipped without
+them. Exits with status 1 when any check fails.
+'''
+
+import getopt
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from dispass import api
+
+if api.hasAsyncio and api.hasFutures:
+    import concurrent.futures
+    import trollius
+    from trollius import From, Return
+
+password = 'qqqqqqqq'
+
+
+def run(coroutine):
+    '''Run `coroutine` on the event loop and return its result'''
+
+    return trollius.get_event_loop().run_until_complete(coroutine)
+
+
+def checkDerive(labels):
+    '''Derive single labels with deriveAsync()'''
+
+    @trollius.coroutine
+    def generate():
+        by_name = yield From(api.deriveAsync('test', password))
+        by_record = yield From(api.deriveAsync(
+            ('test', 50, 'dispass2', 10, ()), password))
+        raise Return((by_name, by_record))
+
+    by_name, by_record = run(generate())
+    errors = []
+    if by_name != api.derive('test', password):
+        errors.append('deriveAsync: labelname gives another passphrase')
+    if by_record != api.derive(('test', 50, 'dispass2', 10, ()), password):
+        errors.append('deriveAsync: label record gives another passphrase')
+    return errors
+
+
+def checkDeriveMany(labels):
+    '''Derive all labels with deriveManyAsync()'''
+
+    expected = api.deriveMany(labels, password)
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+
+    @trollius.coroutine
+    def generate():
+        default = yield From(api.deriveManyAsync(labels, password))
+        threads = yield From(api.deriveManyAsync(labels, password,
+                                                 executor=executor))
+        empty = yield From(api.deriveManyAsync([], password))
+        raise Return((default, threads, empty))
+
+    try:
+        default, threads, empty = run(generate())
+    finally:
+        executor.shutdown()
+    errors = []
+    if default != expected:
+        errors.append('deriveMany: passphrases of the default executor '
+                      'differ')
+    if threads != expected:
+        errors.append('deriveMany: passphrases of 2 threads differ')
+    if empty != []:
+        errors.append('deriveMany: no labels gives {empty!r}'
+                      .format(empty=empty))
+    return errors
+
+
+def checkStream(labels):
+    '''Derive all labels with streamAsync()'''
+
+    @trollius.coroutine
+    def generate():
+        streamed = []
+        for chunk in api.streamAsync(labels, password):
+            streamed.extend((yield From(chunk)))
+        raise Return(streamed)
+
+    if sorted(run(generate())) != sorted(api.deriveMany(labels, password)):
+        return ['streamAsync: passphrases differ']
+    return []
+
+
+def checkFailure(labels):
+    '''Derive a label with an unknown algorithm'''
+
+    @trollius.coroutine
+    def generate():
+        try:
+            yield From(api.deriveManyAsync(labels, password,
+                                           algo='unknown'))
+        except Exception:
+            raise Return(True)
+        raise Return(False)
+
+    if not run(generate()):
+        return ['failure: no exception for an unknown algorithm']
+    return []
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hs:')
+    except getopt.GetoptError, err:
+        print str(err), '\n'
+        print __doc__
+        return 2
+
+    size = 1000
+    for o, a in opts:
+        if o == '-s':
+            size = int(a)
+        elif o == '-h':
+            print __doc__
+            return
+
+    if not (api.hasAsyncio and api.hasFutures):
+        print('skipped: the asyncio functions need the trollius and '
+              'futures packages')
+        return
+
+    labels = ['label{i}.example.com'.format(i=i) for i in xrange(size)]
+    failed = False
+    for name, check in (('deriveAsync', checkDerive),
+                        ('deriveMany', checkDeriveMany),
+                        ('streamAsync', checkStream),
+                        ('failure', checkFailure)):
+        try:
+            errors = check(labels)
+        except Exception, err:
+            errors = ['{name}: raised {err!r}'.format(name=name, err=err)]
+        print('{name:14} {size} labels  {status}'
+              .format(name=name, size=size,
+                      status='FAIL' if errors else 'ok'))
+        for error in errors:
+            print('    ' + error)
+        failed = failed or bool(errors)
+
+    if failed:
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
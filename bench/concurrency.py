@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# vim: set et ts=4 sw=4 sts=4:
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''Stress test of Filehandler and CLI state shared between threads
+
+USAGE: python bench/concurrency.py [-t <threads>] [-d <seconds>]
+
+Options:
+-t <threads>  number of threads per check (default: 8)
+-d <seconds>  duration of every check (default: 5)
+
+``cli``         every thread generates passphrases with a CLI object of
+                its own, for labels and a password of its own, and checks
+                that it only gets its own passphrases back
+``filehandler`` one thread adds, changes and removes labels of a single
+                Filehandler while the other threads read it without
+                locking and check that every snapshot is consistent
+``instances``   every thread parses a labelfile of its own and checks
+                that no labels of other Filehandler objects show up
+``watcher``     one thread appends labels to a labelfile that a
+                LabelfileWatcher applies to a Filehandler, one thread
+                changes other labels of that Filehandler and the other
+                threads check its snapshots; afterwards every appended
+                label must be there
+``sqlite``      like ``filehandler``, for an SQLiteFilehandler whose
+                connection is shared by all threads; the other threads
+                also query it with lookup() and scan(). Skipped
+                without the sqlite3 module
+``watch-shards`` one thread adds, changes and removes labels of a sharded
+                labelfile through Filehandlers of its own, like separate
+                dispass-label processes, while a LabelfileWatcher applies
+                the changes to a Filehandler whose snapshots the other
+                threads check; afterwards the Filehandler must have the
+                labels of the labelfile
+``watch-sqlite`` the same for an SQLite database. Skipped without the
+                sqlite3 module
+``sqlite-locks`` every thread adds labels to an SQLite database through
+                an SQLiteFilehandler of its own and saves, like separate
+                dispass-label processes, which must all succeed; then a
+                change while another connection locks the database for
+                longer than the timeout must fail without raising or
+                saving anything. Skipped without the sqlite3 module
+
+Exits with status 1 when any check finds cross-talk or an inconsistent
+snapshot.
+'''
+
+import getopt
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from dispass import algos
+from dispass.cli import CLI
+from dispass.dispass import Settings
+from dispass.filehandler import Filehandler
+from dispass.shardhandler import ShardedFilehandler
+from dispass.sqlitehandler import SQLiteFilehandler, hasSQLite
+from dispass.watcher import LabelfileWatcher
+
+if hasSQLite:
+    import sqlite3
+
+settings = Settings()
+
+
+def runThreads(target, count, duration):
+    '''Run `target(number, deadline)` on `count` threads
+
+    :Return: List of the error messages returned by the threads
+    '''
+
+    deadline = time.time() + duration
+    errors = []
+
+    def run(number):
+        try:
+            errors.extend(target(number, deadline))
+        except Exception, err:
+            errors.append('thread {number} raised {err!r}'
+                          .format(number=number, err=err))
+
+    threads = [threading.Thread(target=run, args=(number, ))
+               for number in xrange(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def checkCLI(number, deadline):
+    '''Generate passphrases with a CLI object until `deadline`'''
+
+    password = 'password of thread {number}'.format(number=number)
+    labels = dict(('thread{number}-label{i}'.format(number=number, i=i),
+                   (30, None)) for i in xrange(20))
+    expected = dict((labelname, algos.digestLabel(
+        (labelname, 30, 'dispass1', None), password))
+        for labelname in labels)
+    seen = []
+
+    console = CLI(settings)
+    console.passwordPrompt = lambda: algos.passwordBuffer(password)
+    console.render = lambda divlen: seen.append(dict(console.passphrases))
+
+    errors = []
+    rounds = 0
+    while time.time() < deadline:
+        del seen[:]
+        console.interactive({'dispass1': labels}, None)
+        rounds += 1
+        if seen != [expected]:
+            errors.append('cli: thread {number} got passphrases of other '
+                          'threads in round {rounds}'
+                          .format(number=number, rounds=rounds))
+            break
+    return errors
+
+
+def checkSnapshot(lf):
+    '''Return an error message if the snapshot of `lf` is inconsistent'''
+
+    labelfile, labelindex, tagindex, algodict = lf.snapshot
+    if len(labelfile) != len(labelindex):
+        return 'labelfile and labelindex differ in size'
+    for label in labelfile:
+        if labelindex.get(label[0]) != label:
+            return 'label {name} missing from labelindex'.format(
+                name=label[0])
+        for tag in label[4]:
+            if label[0] not in tagindex.get(tag, ()):
+                return 'label {name} missing from tagindex'.format(
+                    name=label[0])
+        if label[0] not in algodict.get(label[2], {}):
+            return 'label {name} missing from algodict'.format(
+                name=label[0])
+    if sum(len(labels) for labels in algodict.itervalues()) != len(labelfile):
+        return 'algodict has labels that are not in labelfile'
+    for tag, labelnames in tagindex.iteritems():
+        for labelname in labelnames:
+            if labelname not in labelindex:
+                return 'tagindex has label {name} that is not in ' \
+                       'labelfile'.format(name=labelname)
+    try:
+        lf.select(patterns=['label-1*'], tags=['even'])
+    except Exception, err:
+        return 'select() raised {err!r}'.format(err=err)
+
+
+def checkFilehandler(count, duration, directory):
+    '''Change a Filehandler on one thread while all others read it'''
+
+    location = os.path.join(directory, 'shared')
+    lf = Filehandler(settings, location)
+    stop = []
+
+    def write(number, deadline):
+        rand = random.Random(number)
+        try:
+            while time.time() < deadline:
+                i = rand.randint(0, 999)
+                labelname = 'label-{i}'.format(i=i)
+                tags = ('even', ) if i % 2 == 0 else ('odd', )
+                action = rand.random()
+                if action < 0.4:
+                    lf.add(labelname, algo=rand.choice(algos.algorithms),
+                           tags=tags)
+                elif action < 0.7:
+                    lf.update([(labelname, rand.randint(8, 50),
+                                rand.choice(algos.algorithms), 1, tags)])
+                else:
+                    lf.remove([labelname])
+        finally:
+            stop.append(True)
+        return []
+
+    def read(number, deadline):
+        checks = 0
+        while not stop:
+            error = checkSnapshot(lf)
+            checks += 1
+            if error:
+                return ['filehandler: thread {number}: {error} (after '
+                        '{checks} checks)'.format(number=number, error=error,
+                                                  checks=checks)]
+        return []
+
+    return runThreads(lambda number, deadline: (write if number == 0 else
+                                                read)(number, deadline),
+                      max(count, 2), duration)
+
+
+def checkInstances(count, duration, directory):
+    '''Parse labelfiles of their own on all threads at once'''
+
+    for number in xrange(count):
+        labelfile = open(os.path.join(directory, str(number)), 'w')
+        for i in xrange(200):
+            labelfile.write('thread{number}-label{i}\n'.format(number=number,
+                                                              i=i))
+        labelfile.close()
+
+    def parse(number, deadline):
+        location = os.path.join(directory, str(number))
+        prefix = 'thread{number}-'.format(number=number)
+        while time.time() < deadline:
+            for lf in (Filehandler(settings, location),
+                       Filehandler(settings, location, lazy=True)):
+                lf.add(prefix + 'new')
+                labelnames = [label[0] for label in lf.labelfile]
+                if (len(labelnames) != 201 or not
+                        all(name.startswith(prefix) for name in labelnames)):
+                    return ['instances: thread {number} got labels of other '
+                            'Filehandler objects'.format(number=number)]
+        return []
+
+    return runThreads(parse, count, duration)
+
+
+def checkSQLite(count, duration, directory):
+    '''Change an SQLiteFilehandler on one thread while all others query
+    it'''
+
+    lf = SQLiteFilehandler(settings, os.path.join(directory, 'shared.db'))
+    stop = []
+
+    def write(number, deadline):
+        rand = random.Random(number)
+        try:
+            while time.time() < deadline:
+                i = rand.randint(0, 999)
+                labelname = 'label-{i}'.format(i=i)
+                tags = ('even', ) if i % 2 == 0 else ('odd', )
+                action = rand.random()
+                if action < 0.4:
+                    lf.add(labelname, algo=rand.choice(algos.algorithms),
+                           tags=tags)
+                elif action < 0.7:
+                    lf.update([(labelname, rand.randint(8, 50),
+                                rand.choice(algos.algorithms), 1, tags)])
+                elif action < 0.95:
+                    lf.remove([labelname])
+                else:
+                    lf.save()
+        finally:
+            stop.append(True)
+        return []
+
+    def read(number, deadline):
+        rand = random.Random(number)
+        checks = 0
+        while not stop:
+            error = checkSnapshot(lf)
+            labelname = 'label-{i}'.format(i=rand.randint(0, 999))
+            label = lf.lookup(labelname)
+            if label is not None and (label[0] != labelname or
+                                      len(label) != 5):
+                error = 'lookup({name}) returned {label!r}'.format(
+                    name=labelname, label=label)
+            for label in lf.scan('label-1'):
+                if 'label-1' not in label[0]:
+                    error = 'scan(label-1) returned {name}'.format(
+                        name=label[0])
+            checks += 1
+            if error:
+                return ['sqlite: thread {number}: {error} (after {checks} '
+                        'checks)'.format(number=number, error=error,
+                                         checks=checks)]
+        return []
+
+    return runThreads(lambda number, deadline: (write if number == 0 else
+                                                read)(number, deadline),
+                      max(count, 2), duration)
+
+
+def checkSQLiteLocks(count, duration, directory):
+    '''Add labels to one database through an SQLiteFilehandler per
+    thread, then change it while it is locked'''
+
+    location = os.path.join(directory, 'locked.db')
+    saved = []
+
+    def write(number, deadline):
+        i = 0
+        while time.time() < deadline:
+            labelname = 'label-{number}-{i}'.format(number=number, i=i)
+            lf = SQLiteFilehandler(settings, location, lazy=True)
+            if not lf.add(labelname) or not lf.save():
+                return ['sqlite-locks: thread {number}: adding {name} '
+                        'failed: {error}'.format(number=number,
+                                                 name=labelname,
+                                                 error=lf.read_error)]
+            saved.append(labelname)
+            i += 1
+        return []
+
+    errors = runThreads(write, count, duration)
+    if set(SQLiteFilehandler(settings, location).labelindex) != set(saved):
+        errors.append('sqlite-locks: labels differ from those saved')
+
+    lf = SQLiteFilehandler(settings, location, lazy=True)
+    lf.connection.execute('PRAGMA busy_timeout = 100')
+    locker = sqlite3.connect(location, isolation_level=None)
+    locker.execute('BEGIN EXCLUSIVE')
+    try:
+        if lf.add('locked') or lf.save():
+            errors.append('sqlite-locks: changed a locked database')
+        elif 'locked' not in (lf.read_error or ''):
+            errors.append('sqlite-locks: error {error!r} instead of a '
+                          'locked database'.format(error=lf.read_error))
+    except Exception, err:
+        errors.append('sqlite-locks: raised {err!r}'.format(err=err))
+    finally:
+        locker.execute('ROLLBACK')
+        locker.close()
+    if SQLiteFilehandler(settings, location).lookup('locked'):
+        errors.append('sqlite-locks: saved a change to a locked database')
+    return errors
+
+
+def checkWatcher(count, duration, directory):
+    '''Apply appended labels with a watcher while threads use the
+    Filehandler'''
+
+    location = os.path.join(directory, 'watched')
+    open(location, 'w').close()
+    lf = Filehandler(settings, location)
+    watcher = LabelfileWatcher(lf, interval=0.01)
+    appended = []
+    stop = []
+
+    def append(number, deadline):
+        try:
+            while time.time() < deadline:
+                labelname = 'appended-{i}'.format(i=len(appended))
+                labelfile = open(location, 'a')
+                labelfile.write(labelname + '\n')
+                labelfile.close()
+                appended.append(labelname)
+                time.sleep(0.002)
+        finally:
+            stop.append(True)
+        return []
+
+    def edit(number, deadline):
+        rand = random.Random(number)
+        while not stop:
+            lf.update([('edited-{i}'.format(i=rand.randint(0, 99)),
+                        rand.randint(8, 50), 'dispass1', None, ())])
+        return []
+
+    def read(number, deadline):
+        while not stop:
+            error = checkSnapshot(lf)
+            if error:
+                return ['watcher: thread {number}: {error}'
+                        .format(number=number, error=error)]
+        return []
+
+    watcher.start()
+    try:
+        errors = runThreads(lambda number, deadline: (
+            append if number == 0 else edit if number == 1 else read)(
+                number, deadline), max(count, 3), duration)
+        time.sleep(0.1)
+        watcher.check()
+    finally:
+        watcher.stop()
+
+    missing = [labelname for labelname in appended
+               if labelname not in lf.labelindex]
+    if missing:
+        errors.append('watcher: {num} appended labels were not applied, '
+                      'e.g. {name}'.format(num=len(missing),
+                                           name=missing[0]))
+    return errors
+
+
+def checkWatcherStorage(count, duration, location, cls):
+    '''Change a labelfile of class `cls` from other Filehandlers while a
+    watcher applies the changes to a Filehandler that threads read'''
+
+    lf = cls(settings, location)
+    watcher = LabelfileWatcher(lf, interval=0.01)
+    stop = []
+
+    def write(number, deadline):
+        rand = random.Random(number)
+        try:
+            while time.time() < deadline:
+                other = cls(settings, location, lazy=True)
+                labelname = 'label-{i}'.format(i=rand.randint(0, 99))
+                action = rand.random()
+                if action < 0.4:
+                    other.add(labelname)
+                elif action < 0.7:
+                    other.update([(labelname, rand.randint(8, 50),
+                                   'dispass1', None, ())])
+                else:
+                    other.remove([labelname])
+                if not other.save():
+                    return ['{name}: could not save {loc}'
+                            .format(name=cls.__name__, loc=location)]
+                time.sleep(0.002)
+        finally:
+            stop.append(True)
+        return []
+
+    def read(number, deadline):
+        while not stop:
+            error = checkSnapshot(lf)
+            if error:
+                return ['{name}: thread {number}: {error}'
+                        .format(name=cls.__name__, number=number,
+                                error=error)]
+        return []
+
+    watcher.start()
+    try:
+        errors = runThreads(lambda number, deadline: (
+            write if number == 0 else read)(number, deadline),
+            max(count, 2), duration)
+    finally:
+        watcher.stop()
+
+    watcher.reload()
+    stored = cls(settings, location).labelindex
+    if lf.labelindex != stored:
+        errors.append('{name}: {num} labels in memory differ from the '
+                      'labelfile'.format(
+                          name=cls.__name__,
+                          num=len(set(lf.labelindex.items()) ^
+                                  set(stored.items()))))
+    return errors
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'd:ht:')
+    except getopt.GetoptError, err:
+        print str(err), '\n'
+        print __doc__
+        return 2
+
+    count = 8
+    duration = 5.0
+    for o, a in opts:
+        if o == '-t':
+            count = int(a)
+        elif o == '-d':
+            duration = float(a)
+        elif o == '-h':
+            print __doc__
+            return
+
+    # Switch threads often, so more interleavings are tried
+    sys.setcheckinterval(10)
+
+    directory = tempfile.mkdtemp(prefix='dispass-concurrency-')
+    failed = False
+    checks = [
+        ('cli', lambda: runThreads(checkCLI, count, duration)),
+        ('filehandler', lambda: checkFilehandler(count, duration,
+                                                 directory)),
+        ('instances', lambda: checkInstances(count, duration, directory)),
+        ('watcher', lambda: checkWatcher(count, duration, directory))]
+    sharded = os.path.join(directory, 'sharded')
+    os.mkdir(sharded)
+    open(os.path.join(sharded, '.shards'), 'w').write('hash 1\n')
+    checks.append(('watch-shards', lambda: checkWatcherStorage(
+        count, duration, sharded, ShardedFilehandler)))
+    if hasSQLite:
+        checks.append(('sqlite', lambda: checkSQLite(count, duration,
+                                                     directory)))
+        checks.append(('watch-sqlite', lambda: checkWatcherStorage(
+            count, duration, os.path.join(directory, 'watched.db'),
+            SQLiteFilehandler)))
+        checks.append(('sqlite-locks', lambda: checkSQLiteLocks(
+            count, duration, directory)))
+    try:
+        for name, check in checks:
+            errors = check()
+            print('{name:12} {count} threads {secs:.1f} s  {status}'
+                  .format(name=name, count=count, secs=duration,
+                          status='FAIL' if errors else 'ok'))
+            for error in errors[:5]:
+                print('    ' + error)
+            failed = failed or bool(errors)
+    finally:
+        shutil.rmtree(directory)
+
+    if failed:
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# vim: set et ts=4 sw=4 sts=4:
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''Check all registered digest engines against the golden vectors
+
+USAGE: python bench/golden.py [check] [<engine>] [<engine2>] [...]
+       python bench/golden.py generate
+
+The golden vectors in golden.txt.gz are passphrases generated by the
+reference implementation for many labels, every length from 1 to 171,
+several sequence numbers and passwords of various shapes. ``check`` runs
+every engine registered in `dispass.algos.engines`, plus ``cache`` (a
+`dispass.cache.PassphraseCache`) registered here, or only the given
+engines against them. It reports throughput and exits with status 1 if
+an engine generates a different passphrase. Every vector is generated twice
+in a row, with the password as a string and as a bytearray from
+`dispass.algos.passwordBuffer()`, so engines that keep state are checked
+on reuse as well.
+
+``generate`` writes the golden vectors. It must only be run when the
+algorithms themselves change, since it makes the current implementation
+the reference for all others.
+'''
+
+import gzip
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from dispass import algos
+from dispass.cache import PassphraseCache
+
+corpus = os.path.join(os.path.dirname(__file__), 'golden.txt.gz')
+
+labelnames = (
+    'test', 'test2', 'a', 'x' * 256, 'www.example.com', 'mail.example.org',
+    'user@example.com', 'label with spaces', 'tab\tlabel', '0',
+    u'r\xe9sum\xe9.example.com'.encode('utf-8'),
+    u'\u4f8b\u3048.jp'.encode('utf-8'),
+)
+'''Labelnames of various shapes, extended by random labelnames'''
+
+passwords = (
+    'qqqqqqqq', 'correct horse battery staple', '12345678',
+    '!@#$%^&*()_+-=[]{};\':",./<>?\\|`~', 'p' * 1024, ' leading space',
+    u'w\xe4chtersp\xe4\xdf'.encode('utf-8'),
+    u'\u30d1\u30b9\u30ef\u30fc\u30c9'.encode('utf-8'),
+    '\x00binary\xff\xfe',
+)
+'''Passwords of various shapes, extended by random passwords'''
+
+seqnos = (1, 2, 10, 99, 1000, 123456789)
+'''Sequence numbers used for dispass2'''
+
+max_length = 171
+'''Integer. Longest passphrase the algorithms generate'''
+
+
+def generateVectors(rounds=3, seed=0):
+    '''Return a list of `(algo, length, seqno, labelname, password)`
+
+    Every length is used `rounds` times by every algorithm. The vectors of
+    the doctests of `dispass.algos` come first.
+    '''
+
+    rand = random.Random(seed)
+    vectors = [('dispass1', 30, None, 'test', 'qqqqqqqq'),
+               ('dispass1', 50, None, 'test2', 'qqqqqqqq'),
+               ('dispass2', 30, 1, 'test', 'qqqqqqqq'),
+               ('dispass2', 50, 10, 'test2', 'qqqqqqqq')]
+
+    for i in xrange(rounds):
+        for length in xrange(1, max_length + 1):
+            for algo in algos.algorithms:
+                if rand.random() < 0.5:
+                    labelname = rand.choice(labelnames)
+                else:
+                    labelname = 'label-{num:08x}.example.com'.format(
+                        num=rand.getrandbits(32))
+                if rand.random() < 0.5:
+                    password = rand.choice(passwords)
+                else:
+                    password = ''.join(chr(rand.randint(32, 126)) for c in
+                                       xrange(rand.randint(8, 64)))
+                seqno = rand.choice(seqnos) if algo == 'dispass2' else None
+                vectors.append((algo, length, seqno, labelname, password))
+
+    return vectors
+
+
+def generate():
+    '''Write the golden vectors, generated by `algos.digestLabel()`'''
+
+    filehandle = gzip.open(corpus, 'wb')
+    filehandle.write('# algo\tlength\tseqno\tlabelname (hex)\t'
+                     'password (hex)\tpassphrase\n')
+    for algo, length, seqno, labelname, password in generateVectors():
+        passphrase = algos.digestLabel((labelname, length, algo, seqno),
+                                       password)
+        filehandle.write('\t'.join((algo, str(length), str(seqno or '-'),
+                                    labelname.encode('hex'),
+                                    password.encode('hex'),
+                                    passphrase)) + '\n')
+    filehandle.close()
+    print('Wrote golden vectors to ' + corpus)
+
+
+def readVectors():
+    '''Return a list of `((labelname, length, algo, seqno), password,
+    passphrase)` of the golden vectors'''
+
+    vectors = []
+    for line in gzip.open(corpus, 'rb'):
+        if line[0] == '#':
+            continue
+        algo, length, seqno, labelname, password, passphrase = \
+            line.rstrip('\n').split('\t')
+        vectors.append(((labelname.decode('hex'), int(length), algo,
+                         None if seqno == '-' else int(seqno)),
+                        password.decode('hex'), passphrase))
+    return vectors
+
+
+def check(names):
+    '''Check engines against the golden vectors
+
+    :Return: Integer. Number of engines that failed
+    '''
+
+    vectors = readVectors()
+    failed = 0
+
+    for name in names or sorted(algos.engines):
+        engine = algos.engines[name]
+        mismatches = []
+        start = time.time()
+        for label, password, passphrase in vectors:
+            for password in (password, algos.passwordBuffer(password)):
+                result = engine(label, password)
+                if result != passphrase:
+                    mismatches.append((label, result, passphrase))
+        seconds = time.time() - start
+
+        print('{name:12} {qty:>6} passphrases {secs:8.4f} s '
+              '{rate:>10.0f} passphrases/sec  {status}'
+              .format(name=name, qty=len(vectors) * 2, secs=seconds,
+                      rate=len(vectors) * 2 / seconds if seconds else 0,
+                      status='FAIL' if mismatches else 'ok'))
+        for label, result, passphrase in mismatches[:5]:
+            print('    {label!r}: {result!r} != {expected!r}'
+                  .format(label=label, result=result, expected=passphrase))
+        if mismatches:
+            failed += 1
+
+    return failed
+
+
+def main(argv):
+    args = argv[1:]
+    if args and args[0] == 'generate':
+        generate()
+        return
+    if args and args[0] == 'check':
+        args = args[1:]
+
+    algos.registerEngine('cache', PassphraseCache().digest)
+
+    unknown = [name for name in args if name not in algos.engines]
+    if unknown:
+        print(__doc__)
+        print('Engines: ' + ', '.join(sorted(algos.engines)))
+        return 2
+
+    if check(args):
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
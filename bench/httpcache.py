@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# vim: set et ts=4 sw=4 sts=4:
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''Check the cache of labelfiles served over http against a local server
+
+USAGE: python bench/httpcache.py [-s <size>]
+
+Options:
+-s <size>     number of labels of the synthetic labelfile (default: 10000)
+
+Every step fetches a labelfile from a BaseHTTPServer on 127.0.0.1 into a
+temporary cache directory and checks the labels, the number of requests
+the server got and the warnings written to stderr:
+
+``download``        an uncached labelfile is downloaded
+``not modified``    the ETag of the cached copy is answered with a 304
+``changed``         a changed labelfile is downloaded again
+``max-age``         a fresh cached copy is used without a request
+``truncated``       a download shorter than its Content-Length is
+                    discarded and the cached copy is used
+``truncated new``   the same without a cached copy finds no labelfile
+``404``             an error response uses the cached copy
+``500 new``         an error response without a cached copy finds no
+                    labelfile
+``offline``         the cached copy is used when the server is down
+
+Exits with status 1 when any step fails.
+'''
+
+import BaseHTTPServer
+import getopt
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from dispass.dispass import Settings
+from dispass.filehandler import Filehandler
+from dispass.httphandler import HTTPFilehandler, getCacheDir
+from labelfile import generate
+
+settings = Settings()
+
+
+class LabelfileServer(BaseHTTPServer.HTTPServer):
+    '''Web server of a single labelfile, whatever the path'''
+
+    body = ''
+    '''String. Contents of the labelfile'''
+
+    etag = None
+    '''String. ETag of the labelfile'''
+
+    max_age = 0
+    '''Integer. max-age of the labelfile in seconds, 0 to leave it out'''
+
+    mode = None
+    '''None to serve the labelfile, 'truncated' to close the connection
+    halfway, or an HTTP error status to send instead'''
+
+    requests = 0
+    '''Integer. Number of requests received'''
+
+
+class LabelfileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answer requests like `LabelfileServer` is set up to'''
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.mode not in (None, 'truncated'):
+            self.send_error(server.mode)
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(server.body)))
+        if server.max_age:
+            self.send_header('Cache-Control',
+                             'max-age={age}'.format(age=server.max_age))
+        self.end_headers()
+        if server.mode == 'truncated':
+            self.wfile.write(server.body[:len(server.body) // 2])
+        else:
+            self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server, path):
+    '''Serve labelfile `path` with `server` from now on'''
+
+    filehandle = open(path, 'rb')
+    server.body = filehandle.read()
+    filehandle.close()
+    server.etag = '"{mtime}-{size}"'.format(mtime=time.time(),
+                                            size=len(server.body))
+
+
+def fetch(server, path):
+    '''Fetch `path` from `server` through the cache
+
+    :Return: Tuple of `(HTTPFilehandler, requests, warnings)`
+    '''
+
+    url = 'http://127.0.0.1:{port}{path}'.format(port=server.server_port,
+                                                path=path)
+    requests = server.requests
+    stderr = sys.stderr
+    sys.stderr = StringIO.StringIO()
+    try:
+        fh = HTTPFilehandler(settings, url)
+        warnings = sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+    return fh, server.requests - requests, warnings
+
+
+def check(fh, requests, warnings, labels, want_requests, want_warning):
+    '''Return the list of differences with the expected outcome of a step
+
+    :Parameters:
+        - `labels`: List of expected labels, None if no labelfile should
+          be found
+        - `want_requests`: Integer. Expected number of requests
+        - `want_warning`: String expected in the warnings, None if there
+          should be no warnings
+    '''
+
+    errors = []
+    if labels is None and fh.file_found:
+        errors.append('labelfile found')
+    elif labels is not None and fh.labelfile != labels:
+        errors.append('{count} labels instead of {want}'
+                      .format(count=len(fh.labelfile), want=len(labels)))
+    if requests != want_requests:
+        errors.append('{count} requests instead of {want}'
+                      .format(count=requests, want=want_requests))
+    if want_warning is None and warnings:
+        errors.append('unexpected warning: ' + warnings.strip())
+    elif want_warning is not None and want_warning not in warnings:
+        errors.append('no warning with "{text}"'.format(text=want_warning))
+    leftovers = [name for name in os.listdir(getCacheDir())
+                 if name.startswith('.fetch-')]
+    if leftovers:
+        errors.append('temporary files left: ' + ', '.join(leftovers))
+    return errors
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hs:')
+    except getopt.GetoptError, err:
+        print str(err), '\n'
+        print __doc__
+        return 2
+
+    size = 10000
+    for o, a in opts:
+        if o == '-s':
+            size = int(a)
+        elif o == '-h':
+            print __doc__
+            return
+
+    directory = tempfile.mkdtemp(prefix='dispass-httpcache-')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(directory, 'cache')
+    first = os.path.join(directory, 'first')
+    second = os.path.join(directory, 'second')
+    generate(first, size, seed=0)
+    generate(second, size, seed=1)
+    first_labels = Filehandler(settings, first).labelfile
+    second_labels = Filehandler(settings, second).labelfile
+
+    server = LabelfileServer(('127.0.0.1', 0), LabelfileRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    serve(server, first)
+
+    def step(name, path, labels, want_requests, want_warning=None):
+        start = time.time()
+        errors = check(*fetch(server, path) + (labels, want_requests,
+                                               want_warning))
+        print('{name:14} {secs:.3f} s  {status}'
+              .format(name=name, secs=time.time() - start,
+                      status='FAIL' if errors else 'ok'))
+        for error in errors:
+            print('    ' + error)
+        return errors
+
+    errors = []
+    try:
+        errors += step('download', '/labels', first_labels, 1)
+        errors += step('not modified', '/labels', first_labels, 1)
+        serve(server, second)
+        errors += step('changed', '/labels', second_labels, 1)
+
+        server.max_age = 3600
+        errors += step('max-age', '/fresh', second_labels, 1)
+        errors += step('max-age', '/fresh', second_labels, 0)
+        server.max_age = 0
+
+        serve(server, first)
+        server.mode = 'truncated'
+        errors += step('truncated', '/labels', second_labels, 1,
+                       'using the cached copy')
+        errors += step('truncated new', '/truncated', None, 1,
+                       'no cached copy')
+
+        server.mode = 404
+        errors += step('404', '/labels', second_labels, 1, 'HTTP 404')
+        server.mode = 500
+        errors += step('500 new', '/error', None, 1, 'HTTP 500')
+        server.mode = None
+
+        server.shutdown()
+        server.server_close()
+        errors += step('offline', '/labels', second_labels, 0)
+    finally:
+        server.server_close()
+        shutil.rmtree(directory)
+
+    if errors:
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
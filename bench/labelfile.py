@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# vim: set et ts=4 sw=4 sts=4:
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''Benchmarks of the labelfile handler
+
+USAGE: python bench/labelfile.py <benchmark> [<size>] [<size2>] [...]
+
+Every benchmark is run once for each size (number of labels) in a forked
+child process, so the reported peak memory is not influenced by previous
+runs. Where the number of bytes read from files is known (on Linux) it is
+reported as well. Available benchmarks are listed when no arguments are
+given.
+'''
+
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from dispass import parallel
+from dispass.dispass import Settings
+from dispass.filehandler import Filehandler
+from dispass.sqlitehandler import SQLiteFilehandler
+
+settings = Settings()
+default_sizes = (1000, 10000, 100000)
+
+
+def generate(path, size, seed=0):
+    '''Write a labelfile with `size` random labels to `path`'''
+
+    rand = random.Random(seed)
+    labelfile = open(path, 'w')
+    labelfile.write('# Synthetic labelfile of {size} labels\n\n'
+                    .format(size=size))
+    for i in xrange(size):
+        options = ''
+        if rand.random() < 0.5:
+            options += '  length={length}'.format(length=rand.randint(9, 171))
+        if rand.random() < 0.5:
+            options += '  algo=dispass2  seqno={seqno}'.format(
+                seqno=rand.randint(1, 20))
+        labelfile.write('label-{num:08x}.example.com{options}\n'
+                        .format(num=rand.getrandbits(32), options=options))
+    labelfile.close()
+
+
+def bytesRead():
+    '''Return the number of bytes read by this process, or None if the
+    platform does not report it'''
+
+    try:
+        for line in open('/proc/self/io'):
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def measure(func, *args, **kwargs):
+    '''Call `func` and return its wall time, growth of peak memory and
+    the number of bytes read'''
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    read = bytesRead()
+    start = time.time()
+    func(*args, **kwargs)
+    seconds = time.time() - start
+    if read is not None:
+        read = bytesRead() - read
+    return (seconds,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss, read)
+
+
+def bench_save(directory, size):
+    '''Parse a labelfile and save it, sorted and unsorted'''
+
+    path = os.path.join(directory, 'labels')
+    generate(path, size)
+    lf = Filehandler(settings, file_location=path)
+
+    return [('save (sort)',) + measure(lf.save),
+            ('save (in order)',) + measure(lf.save, sort=False)]
+
+
+def bench_add(directory, size):
+    '''Add a single label to a sorted labelfile and save it'''
+
+    path = os.path.join(directory, 'labels')
+    generate(path, size)
+    Filehandler(settings, file_location=path).save()
+    lf = Filehandler(settings, file_location=path)
+
+    return [('add',) + measure(lf.add, 'label-new.example.com'),
+            ('add + save',) + measure(lf.save)]
+
+
+def bench_sqlite(directory, size):
+    '''Compare lookup and add latency of text and SQLite labelfiles'''
+
+    path = os.path.join(directory, 'labels')
+    generate(path, size)
+    Filehandler(settings, file_location=path).save()
+    database = SQLiteFilehandler(settings, os.path.join(directory, 'l.db'),
+                                 lazy=True)
+    database.importLabelfile(path)
+    labelname = Filehandler(settings, file_location=path).labelfile[-1][0]
+
+    def text_lookup():
+        Filehandler(settings, file_location=path).lookup(labelname)
+
+    def text_mmap_lookup():
+        Filehandler(settings, file_location=path, lazy=True).lookup(labelname)
+
+    def text_add():
+        lf = Filehandler(settings, file_location=path)
+        lf.add('label-new.example.com')
+        lf.save()
+
+    def sqlite_lookup():
+        SQLiteFilehandler(settings, database.file_location,
+                          lazy=True).lookup(labelname)
+
+    def sqlite_add():
+        lf = SQLiteFilehandler(settings, database.file_location, lazy=True)
+        lf.add('label-new.example.com')
+        lf.save()
+
+    return [('text lookup',) + measure(text_lookup),
+            ('text mmap lookup',) + measure(text_mmap_lookup),
+            ('sqlite lookup',) + measure(sqlite_lookup),
+            ('text add + save',) + measure(text_add),
+            ('sqlite add + save',) + measure(sqlite_add),
+            ('sqlite import',) + measure(database.importLabelfile, path)]
+
+
+def bench_gzip(directory, size):
+    '''Compare parse, save and lookup of plain and gzip labelfiles'''
+
+    path = os.path.join(directory, 'labels')
+    generate(path, size)
+    Filehandler(settings, file_location=path).save()
+    compressed = Filehandler(settings, file_location=path)
+    compressed.file_location = path + '.gz'
+    compressed.compressed = True
+    compressed.save()
+    labelname = compressed.labelfile[-1][0]
+
+    results = []
+    for name, location in (('plain', path), ('gzip', path + '.gz')):
+        lf = Filehandler(settings, file_location=location)
+        results += [
+            (name + ' parse',) + measure(Filehandler, settings, location),
+            (name + ' save',) + measure(lf.save),
+            (name + ' lazy lookup',) + measure(
+                Filehandler(settings, location, lazy=True).lookup,
+                labelname)]
+        print('{name:20} {size:>9} labels {kib:9} KiB on disk'
+              .format(name=name, size=size,
+                      kib=os.path.getsize(location) // 1024))
+    return results
+
+
+
+def bench_parallel(directory, size):
+    '''Compare parsing in-process with parsing by worker processes
+
+    Every file size is split into ranges of at least 64 KiB here, so the
+    crossover with the in-process parse shows for small labelfiles too.
+    Peak memory of the worker processes is not included.
+    '''
+
+    path = os.path.join(directory, 'labels')
+    generate(path, size)
+    parallel.min_range = 64 << 10
+    print('{name:20} {size:>9} labels {kib:9} KiB on disk  {cpus} cpus'
+          .format(name='labelfile', size=size,
+                  kib=os.path.getsize(path) // 1024,
+                  cpus=multiprocessing.cpu_count()))
+
+    def parse(processes):
+        lf = Filehandler(settings, file_location=path, lazy=True)
+        lf.parallel_size = 0 if processes > 1 else None
+        lf.processes = processes
+        lf.parse()
+
+    results = [('parse',) + measure(parse, 1)]
+    for processes in sorted(set((2, 4, multiprocessing.cpu_count()))):
+        if processes > 1:
+            results.append(('parse ({num} procs)'.format(num=processes),) +
+                           measure(parse, processes))
+    return results
+
+
+
+def bench_tail(directory, size):
+    '''Parse a labelfile again after 100 labels were appended to it'''
+
+    path = os.path.join(directory, 'labels')
+    generate(path, size)
+    lf = Filehandler(settings, file_location=path)
+    labelfile = open(path, 'a')
+    for i in xrange(100):
+        labelfile.write('label-new{i}.example.com\n'.format(i=i))
+    labelfile.close()
+
+    return [('parse (full)',) + measure(Filehandler, settings, path),
+            ('parse (tail)',) + measure(lf.parse)]
+
+benchmarks = {
+    'add': bench_add,
+    'gzip': bench_gzip,
+    'parallel': bench_parallel,
+    'save': bench_save,
+    'sqlite': bench_sqlite,
+    'tail': bench_tail,
+}
+
+
+def run(benchmark, size):
+    '''Run `benchmark` for `size` labels in a child process and report'''
+
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    directory = tempfile.mkdtemp(prefix='dispass-bench-')
+    try:
+        for name, seconds, rss, read in benchmarks[benchmark](directory,
+                                                              size):
+            print('{name:20} {size:>9} labels {secs:9.4f} s '
+                  '{usec:8.2f} us/label  peak rss +{rss} KiB{read}'
+                  .format(name=name, size=size, secs=seconds,
+                          usec=seconds * 1e6 / size, rss=rss,
+                          read='' if read is None else
+                          '  read {kib} KiB'.format(kib=read // 1024)))
+    finally:
+        shutil.rmtree(directory)
+        sys.stdout.flush()
+        os._exit(0)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in benchmarks:
+        print(__doc__)
+        print('Benchmarks: ' + ', '.join(sorted(benchmarks)))
+        return 2
+
+    sizes = [int(size) for size in argv[2:]] or default_sizes
+    for size in sizes:
+        run(argv[1], size)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# vim: set et ts=4 sw=4 sts=4:
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''End-to-end latency of the dispass command line apps
+
+USAGE: python bench/latency.py [-n <runs>] [-s <size>] [-c <case>]
+                               [-b [<case>=]<ms>] [-m [<case>=]<KiB>]
+
+Options:
+-n <runs>     number of runs of every case per size (default: 20)
+-s <size>     number of labels of the synthetic labelfile, can be given
+              more than once (default: 1000 and 10000)
+-c <case>     only run <case>, can be given more than once
+-b [<case>=]<ms>
+              fail when the p99 wall time of <case>, or of every case,
+              exceeds <ms> milliseconds
+-m [<case>=]<KiB>
+              fail when the peak memory of <case>, or of every case,
+              exceeds <KiB> kibibytes
+
+Every case runs a script of this tree as a new process, so interpreter
+startup, imports, parsing the labelfile and output are all included. The
+password is written to a pipe; the process is started in a new session
+without a controlling terminal, so getpass reads it from that pipe. Peak
+memory is the maximum resident set size reported by wait4().
+
+Exits with status 1 when a budget is exceeded.
+'''
+
+import getopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from labelfile import generate
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+default_sizes = (1000, 10000)
+password = 'benchmark password'
+
+cases = (
+    ('dispass', 'dispass', True,
+     ['-o', '-f', '{labelfile}', 'label-new.example.com']),
+    ('dispass -s', 'dispass', True,
+     ['-o', '-f', '{labelfile}', '-s', '{labelname}']),
+    ('dispass-label -l', 'dispass-label', False,
+     ['-l', '--script', '-f', '{labelfile}']),
+)
+'''Tuple of `(case, script, needs password, arguments)`'''
+
+
+def percentile(values, percent):
+    '''Return the nearest-rank `percent` percentile of sorted `values`'''
+
+    rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def execute(script, args, use_password, env):
+    '''Run a script once and return its wall time and peak memory
+
+    :Return: Tuple of `(seconds, maxrss KiB, exit status)`
+    '''
+
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(root, 'scripts', script)] + args,
+        stdin=subprocess.PIPE, stdout=devnull, stderr=devnull,
+        preexec_fn=os.setsid, env=env)
+    if use_password:
+        process.stdin.write(password + '\n')
+    process.stdin.close()
+    pid, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    process.returncode = status
+    devnull.close()
+    return (seconds, rusage.ru_maxrss, status)
+
+
+def bench(case, size, runs, directory):
+    '''Run `case` `runs` times against a labelfile of `size` labels
+
+    :Return: Tuple of `(p50, p95, p99, maxrss)` with times in seconds
+    '''
+
+    name, script, use_password, args = [c for c in cases if c[0] == case][0]
+    labelfile = os.path.join(directory, 'labels-{size}'.format(size=size))
+    if not os.path.exists(labelfile):
+        generate(labelfile, size)
+
+    # A labelname that is found by exactly one search
+    for line in open(labelfile):
+        if line[0] != '#' and line.strip():
+            labelname = line.split()[0]
+    args = [arg.format(labelfile=labelfile, labelname=labelname)
+            for arg in args]
+
+    env = dict(os.environ, PYTHONPATH=root, HOME=directory)
+    env.pop('DISPASS_LABELFILE', None)
+    env.pop('DISPASS_PROFILE', None)
+    env.pop('DISPASS_METRICS', None)
+    env.pop('DISPASS_PARALLEL_MIB', None)
+
+    times = []
+    maxrss = 0
+    for i in xrange(runs):
+        seconds, rss, status = execute(script, args, use_password, env)
+        if status:
+            raise RuntimeError('{case} exited with status {status}'
+                               .format(case=case, status=status))
+        times.append(seconds)
+        maxrss = max(maxrss, rss)
+
+    times.sort()
+    return (percentile(times, 50), percentile(times, 95),
+            percentile(times, 99), maxrss)
+
+
+def parseBudgets(values):
+    '''Convert ``[<case>=]<limit>`` strings to a dictionary of limits by
+    case, with None as key for the limit of every case'''
+
+    budgets = {}
+    for value in values:
+        case, sep, limit = value.rpartition('=')
+        budgets[case or None] = float(limit)
+    return budgets
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'b:c:hm:n:s:')
+    except getopt.GetoptError, err:
+        print str(err), '\n'
+        print __doc__
+        return 2
+
+    runs = 20
+    sizes = []
+    selected = []
+    time_budgets = []
+    rss_budgets = []
+    for o, a in opts:
+        if o == '-n':
+            runs = int(a)
+        elif o == '-s':
+            sizes.append(int(a))
+        elif o == '-c':
+            selected.append(a)
+        elif o == '-b':
+            time_budgets.append(a)
+        elif o == '-m':
+            rss_budgets.append(a)
+        elif o == '-h':
+            print __doc__
+            print 'Cases: ' + ', '.join(case[0] for case in cases)
+            return
+
+    time_budgets = parseBudgets(time_budgets)
+    rss_budgets = parseBudgets(rss_budgets)
+    over = []
+
+    directory = tempfile.mkdtemp(prefix='dispass-latency-')
+    try:
+        for size in sizes or default_sizes:
+            for case in [c[0] for c in cases]:
+                if selected and case not in selected:
+                    continue
+                p50, p95, p99, maxrss = bench(case, size, runs, directory)
+                print('{case:18} {size:>7} labels  p50 {p50:8.1f} ms  '
+                      'p95 {p95:8.1f} ms  p99 {p99:8.1f} ms  '
+                      'peak rss {rss:>7} KiB'
+                      .format(case=case, size=size, p50=p50 * 1000,
+                              p95=p95 * 1000, p99=p99 * 1000, rss=maxrss))
+                sys.stdout.flush()
+
+                budget = time_budgets.get(case, time_budgets.get(None))
+                if budget is not None and p99 * 1000 > budget:
+                    over.append('{case} ({size} labels): p99 {p99:.1f} ms '
+                                '> {budget:.1f} ms'
+                                .format(case=case, size=size,
+                                        p99=p99 * 1000, budget=budget))
+                budget = rss_budgets.get(case, rss_budgets.get(None))
+                if budget is not None and maxrss > budget:
+                    over.append('{case} ({size} labels): peak rss {rss} KiB '
+                                '> {budget:.0f} KiB'
+                                .format(case=case, size=size, rss=maxrss,
+                                        budget=budget))
+    finally:
+        shutil.rmtree(directory)
+
+    if over:
+        print '\nOver budget:'
+        for message in over:
+            print '  ' + message
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
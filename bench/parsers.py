@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# vim: set et ts=4 sw=4 sts=4:
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+'''Check that every way of reading a labelfile gives the same labels
+
+USAGE: python bench/parsers.py [-n <rounds>]
+
+Options:
+-n <rounds>   number of random labelfiles per check (default: 50)
+
+The labelfiles are made of awkward lines: blank lines, lines of only
+spaces or tabs, comments, indented labels, labels with options and a
+last line without a newline. The labels of a full parse by `Filehandler`
+are the reference.
+
+``tail``        lines are appended to a parsed labelfile a few times and
+                the labels of parsing just the appended lines must be
+                those of a full parse
+``parallel``    a labelfile is split into many small ranges, which are
+                parsed in-process and by a pool of 2 worker processes
+``merge``       two labelfiles are merged and the result must have the
+                labelnames of both
+
+Exits with status 1 when any check finds different labels.
+'''
+
+import getopt
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from dispass import parallel
+from dispass.dispass import Settings
+from dispass.filehandler import Filehandler
+from dispass.merge import LabelfileMerge
+
+settings = Settings()
+
+lines = (
+    'label{i}.example.com\n',
+    'label{i}.example.com  length=12\n',
+    'label{i}.example.com  algo=dispass2  seqno=3  tag=a,b\n',
+    '  indented{i}.example.com  length=20\n',
+    '# comment {i}\n',
+    '\n',
+    '   \n',
+    '\t\n',
+    ' \t \n',
+)
+'''Templates of the lines of a random labelfile'''
+
+
+def randomLines(rand, count):
+    '''Return `count` random lines, the last maybe without a newline'''
+
+    text = ''.join(rand.choice(lines).format(i=rand.randint(0, 99))
+                   for i in xrange(count))
+    if rand.random() < 0.5:
+        text = text[:-1]
+    return text
+
+
+def write(location, text, mode='a'):
+    '''Write `text` to `location` and move its modification time on, so a
+    change within the same second is noticed'''
+
+    filehandle = open(location, mode)
+    filehandle.write(text)
+    filehandle.close()
+    stamp = time.time() + write.moved
+    os.utime(location, (stamp, stamp))
+    write.moved += 1
+write.moved = 1
+
+
+def checkTail(rand, directory):
+    '''Append to a parsed labelfile and compare tail and full parses'''
+
+    location = os.path.join(directory, 'tail')
+    text = randomLines(rand, 20)
+    write(location, text, 'w')
+    lf = Filehandler(settings, location)
+    for step in xrange(5):
+        # Finish a last line without a newline before appending, so it is
+        # parsed again on its own
+        finish = '' if text.endswith('\n') else '\n'
+        text = randomLines(rand, rand.randint(1, 5))
+        write(location, finish + text)
+        lf.parse()
+        full = Filehandler(settings, location)
+        if lf.labelfile != full.labelfile:
+            return ['tail: labels differ after appending {num} times'
+                    .format(num=step + 1)]
+    return []
+
+
+def checkParallel(rand, directory):
+    '''Parse a labelfile in ranges and compare with a full parse'''
+
+    location = os.path.join(directory, 'parallel')
+    write(location, randomLines(rand, 200), 'w')
+    full = Filehandler(settings, location).labelfile
+    parallel.min_range = rand.randint(16, 512)
+    errors = []
+    for processes in (1, 2):
+        if parallel.parseLabelfile(settings, location, processes) != full:
+            errors.append('parallel: labels of {num} process(es) differ'
+                          .format(num=processes))
+    return errors
+
+
+def checkMerge(rand, directory):
+    '''Merge two labelfiles and compare the labelnames'''
+
+    ours = os.path.join(directory, 'ours')
+    theirs = os.path.join(directory, 'theirs')
+    write(ours, randomLines(rand, 50), 'w')
+    write(theirs, randomLines(rand, 50), 'w')
+    labelnames = (set(Filehandler(settings, ours).labelindex) |
+                  set(Filehandler(settings, theirs).labelindex))
+    if not LabelfileMerge(settings, ours, theirs).run():
+        return ['merge: could not write the merged labelfile']
+    if set(Filehandler(settings, ours).labelindex) != labelnames:
+        return ['merge: labelnames differ from those of both labelfiles']
+    return []
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hn:')
+    except getopt.GetoptError, err:
+        print str(err), '\n'
+        print __doc__
+        return 2
+
+    rounds = 50
+    for o, a in opts:
+        if o == '-n':
+            rounds = int(a)
+        elif o == '-h':
+            print __doc__
+            return
+
+    directory = tempfile.mkdtemp(prefix='dispass-parsers-')
+    failed = False
+    try:
+        for name, check in (('tail', checkTail),
+                            ('parallel', checkParallel),
+                            ('merge', checkMerge)):
+            rand = random.Random(0)
+            errors = []
+            for i in xrange(rounds):
+                try:
+                    errors.extend(check(rand, directory))
+                except Exception, err:
+                    errors.append('{name}: raised {err!r}'.format(
+                        name=name, err=err))
+            print('{name:12} {rounds} labelfiles  {status}'
+                  .format(name=name, rounds=rounds,
+                          status='FAIL' if errors else 'ok'))
+            for error in errors[:5]:
+                print('    ' + error)
+            failed = failed or bool(errors)
+    finally:
+        shutil.rmtree(directory)
+
+    if failed:
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,118 @@
+# Bash completion for dispass and dispass-label
+#
+# Source this file from ~/.bashrc or copy it to the bash-completion
+# directory of your system, e.g. /etc/bash_completion.d/dispass
+#
+# Labels are completed by dispass-complete, which reads the label index
+# written next to the labelfile instead of starting dispass itself.
+
+_dispass_labelfile()
+{
+    local i
+    for ((i=1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i]}" in
+            -f|--file) echo "${COMP_WORDS[i+1]}" ;;
+            --file=*) echo "${COMP_WORDS[i]#--file=}" ;;
+        esac
+    done
+}
+
+_dispass()
+{
+    local cur prev labelfile
+    cur="${COMP_WORDS[COMP_CWORD]}"
+    prev="${COMP_WORDS[COMP_CWORD-1]}"
+
+    case "$prev" in
+        -f|--file)
+            COMPREPLY=( $(compgen -f -- "$cur") )
+            return
+            ;;
+        -a|--algo)
+            COMPREPLY=( $(compgen -W "dispass1 dispass2" -- "$cur") )
+            return
+            ;;
+        -l|--length|-n|--number|-t|--tag|--history)
+            return
+            ;;
+    esac
+
+    if [[ "$cur" == -* ]]; then
+        COMPREPLY=( $(compgen -W "-a -c -f -g -h -l -m -n -o -s -t -V
+            --algo= --create --file= --gui --help --history= --length=
+            --match= --number= --output --profile --script --search=
+            --tag= --version --which" -- "$cur") )
+        return
+    fi
+
+    labelfile="$(_dispass_labelfile | tail -n 1)"
+    COMPREPLY=( $(dispass-complete ${labelfile:+-f "$labelfile"} "$cur") )
+}
+
+_dispass_label()
+{
+    local cur prev i command labelfile
+    cur="${COMP_WORDS[COMP_CWORD]}"
+    prev="${COMP_WORDS[COMP_CWORD-1]}"
+
+    case "$prev" in
+        -f|--file)
+            COMPREPLY=( $(compgen -f -- "$cur") )
+            return
+            ;;
+    esac
+
+    # The command is the first word that is not an option or its value
+    for ((i=1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i]}" in
+            -f|--file) ((i++)) ;;
+            -*) ;;
+            *) command="${COMP_WORDS[i]}"; break ;;
+        esac
+    done
+
+    if [[ -z "$command" ]]; then
+        if [[ "$cur" == -* ]]; then
+            COMPREPLY=( $(compgen -W "-f -h -l -V --file= --help --list
+                --profile --script --version" -- "$cur") )
+        else
+            COMPREPLY=( $(compgen -W "import merge remove set-algo
+                set-length" -- "$cur") )
+        fi
+        return
+    fi
+
+    case "$command" in
+        set-length|set-algo)
+            if ((COMP_CWORD == i + 1)); then
+                if [[ "$command" == set-algo ]]; then
+                    COMPREPLY=( $(compgen -W "dispass1 dispass2" -- "$cur") )
+                fi
+                return
+            fi
+            ;;
+        import)
+            if ((COMP_CWORD == i + 1)); then
+                COMPREPLY=( $(compgen -f -- "$cur") )
+            fi
+            return
+            ;;
+        merge)
+            if ((COMP_CWORD <= i + 2)); then
+                COMPREPLY=( $(compgen -f -- "$cur") )
+            fi
+            return
+            ;;
+        remove)
+            ;;
+        *)
+            return
+            ;;
+    esac
+
+    labelfile="$(_dispass_labelfile | tail -n 1)"
+    COMPREPLY=( $(dispass-complete ${labelfile:+-f "$labelfile"} "$cur") )
+}
+
+complete -F _dispass dispass
+complete -F _dispass_label dispass-label
@@ -15,8 +15,15 @@
 import base64
 import hashlib
 
+import metrics
+
 algorithms = ('dispass1', 'dispass2')
 
+engines = {}
+'''Dictionary of {name: function(label, password)} of all implementations
+that must generate the same passphrases as `digestLabel()`. They are
+checked against the golden vectors by ``bench/golden.py``'''
+
 
 class Dispass1:
     '''Dispass1 algorithm
@@ -50,13 +57,10 @@ class Dispass1:
             - The secure hash of `message`
         '''
 
-        sha = hashlib.sha512()
-        sha.update(message)
-        r = base64.b64encode(sha.hexdigest(), '49').replace('=', '')
-
-        return str(r[:length])
+        return digestParts((message, ), length)
 
     @staticmethod
+    @metrics.timed('dispass1.digestPasswordDict')
     def digestPasswordDict(indentifierDict, password):
         '''Creat secure hashes of a dict of `{identifier:(length, )}`
 
@@ -66,19 +70,19 @@ class Dispass1:
 
         :Parameters:
             - `indentifierDict`: A dict of `{identifier: (length, None)}`
-            - `password`: The password to use for hashing entries
+            - `password`: The password to use for hashing entries, a
+              string or a bytearray from `passwordBuffer()`
 
         :Return:
             - A list of '(identifier: (length, seqno)), passphrase)' entries
         '''
 
         hashed = []
+        metrics.count('digest.labels', len(indentifierDict))
 
         for identifier, params in indentifierDict.iteritems():
-            sha = hashlib.sha512()
-            sha.update(identifier + password)
-            r = base64.b64encode(sha.hexdigest(), '49').replace('=', '')
-            hashed.append((identifier, str(r[:params[0]])))
+            hashed.append((identifier,
+                           digestParts((identifier, password), params[0])))
 
         return hashed
 
@@ -115,13 +119,10 @@ class Dispass2:
             - The secure hash of `message`
         '''
 
-        sha = hashlib.sha512()
-        sha.update(message)
-        r = base64.b64encode(sha.hexdigest(), '49').replace('=', '')
-
-        return str(r[:length])
+        return digestParts((message, ), length)
 
     @staticmethod
+    @metrics.timed('dispass2.digestPasswordDict')
     def digestPasswordDict(indentifierDict, password):
         '''Creat secure hashes of a dict of `{identifier:(length, seqno)}`
 
@@ -131,22 +132,153 @@ class Dispass2:
 
         :Parameters:
             - `indentifierDict`: A dict of `{identifier: (length, seqno)}`
-            - `password`: The password to use for hashing entries
+            - `password`: The password to use for hashing entries, a
+              string or a bytearray from `passwordBuffer()`
 
         :Return:
             - A list of '(identifier: (length, seqno)), passphrase)' entries
         '''
 
         hashed = []
+        metrics.count('digest.labels', len(indentifierDict))
 
         for identifier, params in indentifierDict.iteritems():
-            sha = hashlib.sha512()
-            sha.update(identifier + str(params[1]) + password)
-            r = base64.b64encode(sha.hexdigest(), '49').replace('=', '')
-            hashed.append((identifier, str(r[:params[0]])))
+            hashed.append((identifier,
+                           digestParts((identifier, str(params[1]), password),
+                                       params[0])))
 
         return hashed
 
+
+def digestParts(parts, length):
+    '''Return the passphrase of the concatenation of `parts`
+
+    The parts are fed to the hash one by one, so the password is never
+    copied into a message string together with the labelname.
+
+    :Parameters:
+        - `parts`: Iterable of strings or bytearrays
+        - `length`: Length of the passphrase
+
+    >>> digestParts(('test', 'qqqqqqqq'), 30)
+    'Y2Y4Y2Y0Yzg5Nzc1Yzc2MmI4OTU0ND'
+    '''
+
+    sha = hashlib.sha512()
+    for part in parts:
+        sha.update(part)
+    r = base64.b64encode(sha.hexdigest(), '49').replace('=', '')
+
+    return str(r[:length])
+
+
+def digestHistory(identifier, password, length, seqnos):
+    '''Return the dispass2 passphrases of `identifier` for several
+    sequence numbers
+
+    The identifier is hashed once. The hash state after the identifier is
+    copied for every sequence number, so only the sequence number and the
+    password are hashed per passphrase.
+
+    :Parameters:
+        - `identifier`: String. The labelname
+        - `password`: The password to use for hashing, a string or a
+          bytearray from `passwordBuffer()`
+        - `length`: Length of the passphrases
+        - `seqnos`: Iterable of sequence numbers
+
+    :Return:
+        - A list of `(seqno, passphrase)` in the order of `seqnos`
+
+    >>> digestHistory('test2', 'qqqqqqqq', 50, [10])
+    [(10, 'NGEwNjMxMzZiMzljODVmODk4OWQ1ZmE4YTRlY2E4ODZkZjZlZW')]
+    '''
+
+    prefix = hashlib.sha512(identifier)
+    history = []
+    for seqno in seqnos:
+        sha = prefix.copy()
+        sha.update(str(seqno))
+        sha.update(password)
+        r = base64.b64encode(sha.hexdigest(), '49').replace('=', '')
+        history.append((seqno, str(r[:length])))
+
+    return history
+
+
+def passwordBuffer(password):
+    '''Return a mutable copy of `password` that can be wiped afterwards
+
+    The strings returned by getpass can not be cleared, so a password
+    should be copied into a buffer right after it is read and only be
+    passed on as that buffer.
+    '''
+
+    return bytearray(password)
+
+
+def wipe(buffer):
+    '''Overwrite all bytes of a bytearray from `passwordBuffer()` with
+    zeros
+
+    >>> buffer = passwordBuffer('qqqqqqqq')
+    >>> wipe(buffer)
+    >>> buffer
+    bytearray(b'\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00')
+    '''
+
+    if isinstance(buffer, bytearray):
+        buffer[:] = bytearray(len(buffer))
+
+
+def digestLabel(label, password):
+    '''Return the passphrase of a single label
+
+    :Parameters:
+        - `label`: Tuple of `(labelname, length, algorithm, seqno, tags)`
+        - `password`: The password to use for hashing, a string or a
+          bytearray from `passwordBuffer()`
+
+    :Return:
+        - String. The passphrase or None if the algorithm is unknown
+    '''
+
+    if label[2] == 'dispass1':
+        return digestParts((label[0], password), label[1])
+    elif label[2] == 'dispass2':
+        return digestParts((label[0], str(label[3]), password), label[1])
+
+
+def digestLabelDict(label, password):
+    '''Return the passphrase of a single label via `digestPasswordDict()`
+
+    Takes the same arguments as `digestLabel()`. This is the code path
+    used by the command line interface.
+    '''
+
+    if label[2] == 'dispass1':
+        return Dispass1.digestPasswordDict(
+            {label[0]: (label[1], None)}, password)[0][1]
+    elif label[2] == 'dispass2':
+        return Dispass2.digestPasswordDict(
+            {label[0]: (label[1], label[3])}, password)[0][1]
+
+
+def registerEngine(name, engine):
+    '''Add `engine` to `engines` under `name`
+
+    :Parameters:
+        - `name`: String. Name of the engine
+        - `engine`: Function taking a label tuple of `(labelname, length,
+          algorithm, seqno)` and a password, returning the passphrase
+    '''
+
+    engines[name] = engine
+
+registerEngine('reference', digestLabel)
+registerEngine('dict', digestLabelDict)
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
+
@@ -0,0 +1,229 @@
+'''Library interface for generating passphrases
+
+Generate passphrases from other Python programs without prompts or
+output. Labels are given as a labelname or as a label record of a
+Filehandler, e.g. ``Filehandler.labelfile[0]``. Options missing from a
+record are taken from `Settings`.
+
+>>> derive('test', 'qqqqqqqq')
+'Y2Y4Y2Y0Yzg5Nzc1Yzc2MmI4OTU0ND'
+>>> derive(('test', 50, 'dispass2', 10, ()), 'qqqqqqqq')
+'MjgxZTU3MTdiNTAwMTQ3NzAzYjczMjk1YTRkOWNkMzgyMzk5Mj'
+>>> deriveMany(['test', 'test2'], 'qqqqqqqq', length=10)
+[('test', 'Y2Y4Y2Y0Yz'), ('test2', 'NmQzNjUzZT')]
+
+The functions ending in ``Async`` return asyncio futures. The hashing is
+done on a bounded executor, so the event loop is never blocked. On
+Python 2 they are used from trollius coroutines::
+
+    import trollius
+    from trollius import From
+
+    @trollius.coroutine
+    def generate(labels, password):
+        passphrase = yield From(deriveAsync('test', password))
+        passphrases = yield From(deriveManyAsync(labels, password))
+        for chunk in streamAsync(labels, password):
+            for labelname, streamed in (yield From(chunk)):
+                ...
+
+The asyncio functions need the asyncio module (or trollius on Python 2)
+and the concurrent.futures module (the futures package on Python 2).
+``bench/asyncapi.py`` checks them against the synchronous functions.
+'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import multiprocessing
+
+import algos
+from dispass import Settings
+
+try:
+    import concurrent.futures
+    hasFutures = True
+except ImportError:
+    hasFutures = False
+
+try:
+    import asyncio
+    hasAsyncio = True
+except ImportError:
+    try:
+        import trollius as asyncio
+        hasAsyncio = True
+    except ImportError:
+        hasAsyncio = False
+
+settings = Settings()
+'''Settings object with the defaults for options missing from labels'''
+
+chunksize = 256
+'''Integer. Number of labels hashed per job of the executor'''
+
+max_workers = multiprocessing.cpu_count()
+'''Integer. Number of threads of the default executor'''
+
+_executor = None
+
+
+def toLabel(label, length=None, algo=None, seqno=None):
+    '''Return a complete label record of `label`
+
+    :Parameters:
+        - `label`: Labelname or (partial) label record of
+          `(labelname, length, algorithm, seqno, tags)`
+        - `length`, `algo`, `seqno`: Override the options of `label`
+
+    :Return: Tuple of `(labelname, length, algorithm, seqno, tags)`
+    :Raise: ValueError if the algorithm or length is invalid
+    '''
+
+    if isinstance(label, basestring):
+        label = (label, )
+    record = tuple(label) + (None, ) * (5 - len(label))
+
+    length = int(length or record[1] or settings.passphrase_length)
+    algo = algo or record[2] or settings.algorithm
+    seqno = seqno or record[3] or settings.sequence_number
+
+    if algo not in algos.algorithms:
+        raise ValueError('algo "{algo}" does not exist'.format(algo=algo))
+    if length < 1 or length > 171:
+        raise ValueError('length must be between 1 and 171')
+
+    return (record[0], length, algo, seqno, tuple(record[4] or ()))
+
+
+def derive(label, password, **options):
+    '''Return the passphrase of a single label
+
+    :Parameters:
+        - `label`: Labelname or label record
+        - `password`: The password to use for hashing, a string or a
+          bytearray from `algos.passwordBuffer()`
+        - `options`: `length`, `algo` and/or `seqno` to override the
+          options of `label`
+    '''
+
+    return algos.digestLabel(toLabel(label, **options), password)
+
+
+def deriveMany(labels, password, **options):
+    '''Return a list of `(labelname, passphrase)` of all `labels`, in the
+    order of `labels`
+
+    Takes the same arguments as `derive()`, with an iterable of labels.
+    '''
+
+    return list(stream(labels, password, **options))
+
+
+def stream(labels, password, **options):
+    '''Yield `(labelname, passphrase)` of `labels` one at a time
+
+    Takes the same arguments as `deriveMany()`. `labels` is consumed
+    lazily, so this works for labels read from a large labelfile as well.
+    '''
+
+    for label in labels:
+        label = toLabel(label, **options)
+        yield (label[0], algos.digestLabel(label, password))
+
+
+def getExecutor():
+    '''Return the default executor, a pool of `max_workers` threads'''
+
+    global _executor
+
+    if not hasFutures:
+        raise ImportError('the concurrent.futures module is needed for '
+                          'hashing on an executor')
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+    return _executor
+
+
+def _submit(func, args, loop, executor):
+    if not hasAsyncio:
+        raise ImportError('the asyncio module is needed for the asyncio '
+                          'interface')
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if executor is None:
+        executor = getExecutor()
+    return loop.run_in_executor(executor, func, *args)
+
+
+def _chunks(labels, password, options, loop, executor):
+    labels = [toLabel(label, **options) for label in labels]
+    return [_submit(deriveMany, (labels[i:i + chunksize], password), loop,
+                    executor)
+            for i in xrange(0, len(labels), chunksize)]
+
+
+def deriveAsync(label, password, loop=None, executor=None, **options):
+    '''Return a future of the passphrase of a single label
+
+    :Parameters:
+        - `label`, `password`, `options`: See `derive()`
+        - `loop`: Event loop, defaults to the current event loop
+        - `executor`: Executor to hash on, defaults to `getExecutor()`.
+          Pass a ``ProcessPoolExecutor`` to use more than one cpu
+    '''
+
+    return _submit(derive, (toLabel(label, **options), password), loop,
+                   executor)
+
+
+def deriveManyAsync(labels, password, loop=None, executor=None, **options):
+    '''Return a future of the list of `(labelname, passphrase)` of all
+    `labels`, in the order of `labels`
+
+    Labels are hashed in chunks of `chunksize` labels, so several chunks
+    are hashed at the same time by the executor. Takes the same arguments
+    as `deriveAsync()`.
+    '''
+
+    chunks = _chunks(labels, password, options, loop, executor)
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    result = asyncio.Future(loop=loop)
+    if not chunks:
+        result.set_result([])
+        return result
+
+    def done(gathered):
+        if result.cancelled():
+            return
+        if gathered.exception() is not None:
+            result.set_exception(gathered.exception())
+        else:
+            result.set_result([item for chunk in gathered.result()
+                               for item in chunk])
+
+    asyncio.gather(*chunks).add_done_callback(done)
+    return result
+
+
+def streamAsync(labels, password, loop=None, executor=None, **options):
+    '''Return an iterator of futures of lists of `(labelname, passphrase)`,
+    in the order in which the chunks of labels are finished
+
+    Takes the same arguments as `deriveManyAsync()`.
+    '''
+
+    return asyncio.as_completed(
+        _chunks(labels, password, options, loop, executor))
@@ -0,0 +1,161 @@
+'''In-memory cache of generated passphrases'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import collections
+import hashlib
+import hmac
+import os
+import time
+
+import algos
+import metrics
+
+
+class PassphraseCache:
+    '''Least recently used cache of passphrases with a time to live
+
+    Passphrases are stored by labelname, length, algorithm, sequence number
+    and a fingerprint of the password. The fingerprint is a HMAC of the
+    password with a random key that only exists in memory of the current
+    process, so it can not be used to verify guesses of the password
+    elsewhere. Nothing is ever written to disk.
+
+    >>> cache = PassphraseCache(capacity=2)
+    >>> label = ('test', 10, 'dispass1', None)
+    >>> cache.digest(label, 'qqqqqqqq')
+    'Y2Y4Y2Y0Yz'
+    >>> cache.digest(label, 'qqqqqqqq')
+    'Y2Y4Y2Y0Yz'
+    >>> cache.hits, cache.misses
+    (1, 1)
+    >>> cache.digest(label, 'qqqqqqqr') == cache.digest(label, 'qqqqqqqq')
+    False
+    >>> cache.digest(('test2', 10, 'dispass1', None), 'qqqqqqqq')
+    'NmQzNjUzZT'
+    >>> len(cache)
+    2
+    >>> cache.wipe()
+    >>> len(cache)
+    0
+    '''
+
+    capacity = 256
+    '''Integer. Maximum number of passphrases kept'''
+
+    ttl = 300
+    '''Integer. Number of seconds a passphrase is kept'''
+
+    def __init__(self, capacity=None, ttl=None):
+        '''Create an empty cache with a new fingerprint key
+
+        :Parameters:
+            - `capacity`: Integer. Override `capacity`
+            - `ttl`: Integer. Override `ttl`
+        '''
+
+        if capacity is not None:
+            self.capacity = capacity
+        if ttl is not None:
+            self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.wipe()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fingerprint(self, password):
+        '''Return the fingerprint of `password` in this process'''
+
+        return hmac.new(self.key, password, hashlib.sha256).digest()
+
+    def getKey(self, label, password):
+        '''Return the cache key of `label` and `password`'''
+
+        return (label[0], int(label[1]), label[2],
+                None if label[2] == 'dispass1' else str(label[3]),
+                self.fingerprint(password))
+
+    def get(self, label, password):
+        '''Return the cached passphrase of `label` or None
+
+        :Parameters:
+            - `label`: Tuple of `(labelname, length, algorithm, seqno)`,
+              further items are ignored
+            - `password`: The password to use for hashing
+        '''
+
+        key = self.getKey(label, password)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            return None
+
+        self.entries[key] = entry
+        return entry[1]
+
+    def put(self, label, password, passphrase):
+        '''Store `passphrase` of `label`, evicting the least recently used
+        passphrases when the cache is full'''
+
+        key = self.getKey(label, password)
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, passphrase)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def digest(self, label, password):
+        '''Return the passphrase of `label`, hashing it only when it is not
+        cached already
+
+        :Parameters:
+            - `label`: Tuple of `(labelname, length, algorithm, seqno)`
+            - `password`: The password to use for hashing
+
+        :Return:
+            - String. The passphrase or None if the algorithm is unknown
+        '''
+
+        passphrase = self.get(label, password)
+        if passphrase is not None:
+            self.hits += 1
+            metrics.count('cache.hits')
+            return passphrase
+
+        self.misses += 1
+        metrics.count('cache.misses')
+        passphrase = algos.digestLabel(label, password)
+        if passphrase is not None:
+            self.put(label, password, passphrase)
+        return passphrase
+
+    def expire(self):
+        '''Remove all passphrases of which the time to live has passed'''
+
+        now = time.time()
+        for key, entry in self.entries.items():
+            if entry[0] < now:
+                del self.entries[key]
+
+    def wipe(self):
+        '''Remove all passphrases and replace the fingerprint key
+
+        Call this when the application is locked or closed.
+        '''
+
+        self.entries = collections.OrderedDict()
+        self.key = os.urandom(32)
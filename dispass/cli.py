@@ -12,8 +12,10 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import collections
 import getpass
 import algos
+import parallel
 
 from dispass import versionStr
 from filehandler import Filehandler
@@ -34,8 +36,9 @@ class CLI:
     scriptableIO = None
     '''Boolean. Optimize input/output for wrapping dispass'''
 
-    passphrases = []
-    '''List of 2-tuples of labels and generated passphrases'''
+    passphrases = None
+    '''Dictionary of {label: passphrase} being shown by render(), set on
+    init'''
 
     def __init__(self, settings):
         '''Set `useCurses` to True or False.
@@ -47,6 +50,7 @@ class CLI:
         self.seqno = settings.sequence_number
         self.settings = settings
         self.useCurses = hasCurses
+        self.passphrases = {}
 
     def setAlgo(self, algo):
         '''Optionally override the algorithm to use for generating passphrases
@@ -99,7 +103,7 @@ class CLI:
     def passwordPrompt(self):
         '''Prompt for password.
 
-        :Return: Password string.
+        :Return: Password bytearray, to be wiped with `algos.wipe()`
         '''
 
         while True:
@@ -119,7 +123,118 @@ class CLI:
             else:
                 break
 
-        return inp
+        return algos.passwordBuffer(inp)
+
+    def which(self, filehandler, labels=None):
+        '''Prompt for a passphrase and password and find its label
+
+        :Parameters:
+            - `filehandler`: Filehandler object of the labelfile to search
+            - `labels`: List of labels to search, defaults to all labels
+              of `filehandler`
+
+        :Return: Boolean. True if the label was found
+        '''
+
+        if labels is None:
+            labels = filehandler.labelfile
+
+        passphrase = algos.passwordBuffer(getpass.getpass('Passphrase: '))
+        password = None
+        try:
+            password = self.passwordPrompt()
+            label, hashed, seconds = parallel.findProducer(
+                labels, passphrase, password)
+        finally:
+            algos.wipe(password)
+            algos.wipe(passphrase)
+
+        if label:
+            print('Passphrase is generated from label "{label}"'
+                  .format(label=label[0]))
+        else:
+            print('No label in {loc} generates this passphrase'
+                  .format(loc=filehandler.url or filehandler.file_location))
+        print('Hashed {hashed} of {total} labels in {secs:.3f} s '
+              '({rate:.0f} labels/sec)'
+              .format(hashed=hashed, total=len(labels),
+                      secs=seconds, rate=hashed / seconds if seconds else 0))
+        return bool(label)
+
+    def interactiveFiles(self, locations, patterns=(), tags=()):
+        '''Prompt for password once and show the passphrases of all labels
+        in several labelfiles, prefixed with the labelfile they are in
+
+        :Parameters:
+            - `locations`: List of labelfile locations
+            - `patterns`, `tags`: Only use labels selected by these, see
+              `Filehandler.select()`
+
+        :Return: Boolean. True if all labelfiles could be loaded
+        '''
+
+        password = self.passwordPrompt()
+        try:
+            results, wall = parallel.digestLabelfiles(
+                self.settings, locations, password, patterns, tags)
+        finally:
+            algos.wipe(password)
+
+        self.passphrases = collections.OrderedDict()
+        loaded = True
+        for location, passphrases, seconds in results:
+            if passphrases is None:
+                print('error: could not load labelfile at "{loc}"'
+                      .format(loc=location))
+                loaded = False
+                continue
+            for label, passphrase in passphrases:
+                self.passphrases['{loc}: {label}'.format(
+                    loc=location, label=label)] = passphrase
+
+        if self.passphrases:
+            self.render(len(max(self.passphrases, key=len)) + 2)
+        else:
+            print('Nothing to generate, you need to add some labels')
+        self.passphrases = {}
+
+        print('Generated passphrases of {qty} labelfiles in {wall:.3f} s '
+              '(sum of per-labelfile times: {total:.3f} s)'
+              .format(qty=len(results), wall=wall,
+                      total=sum(result[2] for result in results)))
+        return loaded
+
+    def history(self, labels, history):
+        '''Prompt for password and show the passphrases of sequence
+        numbers 1 to `history` of all labels
+
+        :Parameters:
+            - `labels`: List of dispass2 labels of
+              `(labelname, length, algorithm, seqno, tags)`
+            - `history`: Integer. Highest sequence number to generate
+        '''
+
+        password = self.passwordPrompt()
+        try:
+            results, seconds = parallel.digestHistories(labels, password,
+                                                        history)
+        finally:
+            algos.wipe(password)
+
+        self.passphrases = collections.OrderedDict()
+        for label, passphrases in results:
+            for seqno, passphrase in passphrases:
+                self.passphrases['{label} #{seqno}'.format(
+                    label=label, seqno=seqno)] = passphrase
+
+        self.render(len(max(self.passphrases, key=len)) + 2)
+        self.passphrases = {}
+
+        qty = len(labels) * history
+        print('Generated {qty} passphrases of {labels} labels in '
+              '{secs:.3f} s ({rate:.0f} passphrases/sec)'
+              .format(qty=qty, labels=len(labels), secs=seconds,
+                      rate=qty / seconds if seconds else 0))
 
     def interactive(self, labels, filehandler):
         '''Start interactive prompt, generating and showing the passprase(s)
@@ -128,58 +243,79 @@ class CLI:
             - `labels`: List or dict of labels to use for passprase generation
         '''
 
-        password = self.passwordPrompt()
         algo_dispass1 = algos.Dispass1()
         algo_dispass2 = algos.Dispass2()
         fh = filehandler
         added = False
         saved = False
 
-        if isinstance(labels, list):
-            labelmap = []
-            for i in labels:
-                labelmap.append((i, (self.passphraseLength, self.algorithm)))
-                if (self.createLabel and
-                    fh.add(labelname=i, length=self.passphraseLength,
-                           algo=self.algorithm, seqno=self.seqno)):
-                    added = True
-            if added and fh.save():
-                saved = True
-
-            if self.algorithm == 'dispass1':
-                self.passphrases = algo_dispass1.digestPasswordDict(
-                    dict(labelmap), password
-                )
-            elif self.algorithm == 'dispass2':
-                self.passphrases = algo_dispass2.digestPasswordDict(
-                    dict(labelmap), password
-                )
-
-            divlen = len(max(labels, key=len)) + 2
-            self.passphrases = dict(self.passphrases)
-
-        elif isinstance(labels, dict):
-            for algo, labels in labels.iteritems():
-                if algo == 'dispass1':
-                    self.passphrases += algo_dispass1.digestPasswordDict(
-                        labels, password
+        password = self.passwordPrompt()
+        try:
+            if isinstance(labels, list):
+                labelmap = []
+                for i in labels:
+                    labelmap.append((i, (self.passphraseLength,
+                                         self.algorithm)))
+                if self.createLabel:
+                    added = fh.addMany([(i, self.passphraseLength,
+                                         self.algorithm, self.seqno, ())
+                                        for i in labels])
+                if added and fh.save():
+                    saved = True
+
+                if self.algorithm == 'dispass1':
+                    self.passphrases = algo_dispass1.digestPasswordDict(
+                        dict(labelmap), password
                     )
-                elif algo == 'dispass2':
-                    self.passphrases += algo_dispass2.digestPasswordDict(
-                        labels, password
+                elif self.algorithm == 'dispass2':
+                    self.passphrases = algo_dispass2.digestPasswordDict(
+                        dict(labelmap), password
                     )
 
-            label_list = []
-            self.passphrases = dict(self.passphrases)
-            for label, length in self.passphrases.iteritems():
-                label_list.append(label)
-            if label_list:
-                divlen = len(max(label_list, key=len)) + 2
-            else:
-                print('Nothing to generate, you need to add some labels')
-                return
+                divlen = len(max(labels, key=len)) + 2
+                self.passphrases = dict(self.passphrases)
+
+            elif isinstance(labels, dict):
+                passphrases = []
+                for algo, labels in labels.iteritems():
+                    if algo == 'dispass1':
+                        passphrases += algo_dispass1.digestPasswordDict(
+                            labels, password
+                        )
+                    elif algo == 'dispass2':
+                        passphrases += algo_dispass2.digestPasswordDict(
+                            labels, password
+                        )
+
+                label_list = []
+                self.passphrases = dict(passphrases)
+                for label, length in self.passphrases.iteritems():
+                    label_list.append(label)
+                if label_list:
+                    divlen = len(max(label_list, key=len)) + 2
+                else:
+                    print('Nothing to generate, you need to add some labels')
+                    return
+        finally:
+            algos.wipe(password)
+
+        self.render(divlen)
+        self.passphrases = {}
+
+        if saved:
+            print('Succesfully added label(s) to {loc}'
+                  .format(loc=fh.url or fh.file_location))
+        if self.createLabel and not saved:
+            print('error: could not save to "{loc}"{err}\n'
+                  .format(loc=fh.url or fh.file_location,
+                          err=': ' + fh.read_error if fh.read_error else ''))
 
-        del password
+    def render(self, divlen):
+        '''Show the generated passphrases via curses or on stdout
+
+        :Parameters:
+            - `divlen`: Integer. Width of the label column
+        '''
 
         if self.useCurses:
             stdscr = curses.initscr()
@@ -213,11 +349,3 @@ class CLI:
                     print '{:50} {}'.format(label[:50], passphrase)
                 else:
                     print "{:{fill}} {}".format(label, passphrase, fill=divlen)
-        self.passphrases = {}
-
-        if saved:
-            print('Succesfully added label(s) to {loc}'
-                  .format(loc=fh.file_location))
-        if self.createLabel and not saved:
-            print('error: could not save to "{loc}"\n'
-                  .format(loc=fh.file_location))
@@ -27,10 +27,14 @@ import os
 import sys
 
 import algos
+import parallel
 from cli import CLI
-from filehandler import Filehandler
+from filehandler import Filehandler, compilePatterns, getFilehandler
 from gui import GUI
 from interactive_editor import InteractiveEditor
+from merge import LabelfileMerge
+from profiler import profiled
+from shardhandler import isSharded
 
 
 class Settings(object):
@@ -48,9 +52,31 @@ class Settings(object):
 settings = Settings()
 
 
+def loadError(lf):
+    '''Return the error message for a labelfile that could not be loaded
+
+    :Parameters:
+        - `lf`: Filehandler object of the labelfile
+    '''
+
+    if lf.read_error:
+        return ('error: could not read labelfile at "{loc}": {err}'
+                .format(loc=lf.url or lf.file_location, err=lf.read_error))
+    return ('error: could not load labelfile at "{loc}"'
+            .format(loc=lf.url or lf.file_location))
+
+
 class Dispass(object):
     '''Command handler for ``dispass``'''
 
+    shortopts = "a:cf:ghl:m:n:os:t:V?"
+    '''String. Short options in the format of getopt'''
+
+    longopts = ["algo=", "create", "file=", "gui", "help", "history=",
+                "length=", "match=", "number", "output", "script",
+                "search=", "tag=", "version", "which"]
+    '''List of long options in the format of getopt'''
+
     def usage(self):
         '''Print help / usage information'''
 
@@ -68,12 +94,26 @@ class Dispass(object):
         print '                more secure way of displaying via curses)'
         print '-V, --version   show full version information and exit'
         print "--script        optimize input/output for 'wrapping' dispass"
+        print '--profile[=<path>]'
+        print '                write profiling stats to <path> (default: '
+        print '                dispass.prof) and print a summary'
+        print '--history=<number>'
+        print '                dispass sequence numbers 1 to <number> of'
+        print '                dispass2 labels, to audit past passphrases'
         print
         print 'Options (when using labelfile):'
         print '-s <string>, --search=<string>'
         print ' ' * 15, 'dispass label from file that matches <string>'
         print '-f <labelfile>, --file=<labelfile>'
-        print '                set location of labelfile'
+        print '                set location of labelfile, repeat to dispass'
+        print '                labels of several labelfiles or pass a'
+        print '                directory of labelfiles'
+        print '-m <pattern>, --match=<pattern>'
+        print '                only dispass labels matching glob <pattern>,'
+        print "                or regular expression when prefixed with 're:'"
+        print '-t <tag>, --tag=<tag>'
+        print '                only dispass labels with tag <tag>'
+        print '--which         find the label of a passphrase'
         print
         print 'Options (when passing labels as arguments):'
         print '-l <length>, --length=<length>'
@@ -83,6 +123,7 @@ class Dispass(object):
         print '-n <number>, --number=<number>'
         print '                override sequence number (default = 1)'
 
+    @profiled
     def main(self, argv):
         '''Entry point and handler of command options and arguments
 
@@ -94,12 +135,15 @@ class Dispass(object):
         console = CLI(settings)
         a_flag = None
         f_flag = None
+        f_list = []
+        h_flag = None
+        m_flag = []
+        t_flag = []
+        w_flag = None
 
         try:
-            opts, args = getopt.getopt(
-                argv[1:], "a:cf:ghl:n:os:V?",
-                ["algo=", "create", "file=", "gui", "help", "length=",
-                 "number", "output", "script", "search=", "version"])
+            opts, args = getopt.getopt(argv[1:], self.shortopts,
+                                       self.longopts)
         except getopt.GetoptError, err:
             print str(err), "\n"
             self.usage()
@@ -155,16 +199,25 @@ class Dispass(object):
                 console.setLength(length)
             elif o in ("-f", "--file"):
                 f_flag = a
+                f_list.append(a)
+            elif o in ("-m", "--match"):
+                m_flag.append(a)
+            elif o in ("-t", "--tag"):
+                t_flag.append(a)
             elif o in ("-s", "--search"):
                 if f_flag:
-                    lf = Filehandler(settings, file_location=f_flag)
+                    lf = getFilehandler(settings, file_location=f_flag,
+                                        lazy=True)
                 else:
-                    lf = Filehandler(settings)
+                    lf = getFilehandler(settings, lazy=True)
 
                 if lf.file_found:
                     result = lf.search(a)
 
-                    if not result:
+                    if lf.read_error:
+                        print loadError(lf)
+                        return 1
+                    elif not result:
                         print('{execname}: could not find a label with '
                               '"{label}" in labelfile'
                               .format(execname=execname, label=a))
@@ -177,8 +230,7 @@ class Dispass(object):
                     console.interactive(result, lf)
                     return
                 else:
-                    print ('error: could not load labelfile at '
-                           '"{loc}"\n').format(loc=lf.file_location)
+                    print loadError(lf) + '\n'
                     return 1
             elif o in ("-o", "--output"):
                 console.setCurses(False)
@@ -190,15 +242,74 @@ class Dispass(object):
                 return
             elif o in "--script":
                 console.setScriptableIO()
+            elif o == "--which":
+                w_flag = True
+            elif o == "--history":
+                try:
+                    h_flag = int(a)
+                except ValueError:
+                    h_flag = 0
+                if h_flag < 1:
+                    print 'error: history must be a positive number\n'
+                    self.usage()
+                    return 1
             else:
                 assert False, "unhandled option"
 
+        try:
+            compilePatterns(m_flag)
+        except ValueError, err:
+            print 'error: {err}'.format(err=err)
+            return 1
+
+        # Several labelfiles or a directory of labelfiles
+        if len(f_list) > 1 or (f_flag and os.path.isdir(f_flag) and
+                               not isSharded(f_flag)):
+            if labels or w_flag or h_flag:
+                print('error: options --which, --history and labels as '
+                      'arguments can only be used with a single labelfile')
+                return 1
+            if a_flag:
+                print('error: option -a can only be used when specifying '
+                      'label(s) as argument(s)')
+                return 1
+            locations = parallel.getLabelfiles(f_list)
+            if not locations:
+                print('error: no labelfiles found in "{loc}"'
+                      .format(loc=f_flag))
+                return 1
+            if not console.interactiveFiles(locations, m_flag, t_flag):
+                return 1
+            return
+
+        # Labels given as arguments only need the labelfile when adding them
         if f_flag:
-            lf = Filehandler(settings, file_location=f_flag)
+            lf = getFilehandler(settings, file_location=f_flag,
+                                lazy=bool(labels))
         else:
-            lf = Filehandler(settings)
+            lf = getFilehandler(settings, lazy=bool(labels))
 
-        if labels:
+        if h_flag:
+            if labels:
+                if console.algorithm != 'dispass2':
+                    print('error: option --history needs algorithm dispass2, '
+                          'use -a dispass2')
+                    return 1
+                selected = [(label, console.passphraseLength, 'dispass2',
+                             None, ()) for label in labels]
+            elif not lf.file_found:
+                print loadError(lf)
+                return 1
+            else:
+                selected = [label for label in
+                            lf.select(patterns=m_flag, tags=t_flag)
+                            if label[2] == 'dispass2']
+            if not selected:
+                print('{execname}: no dispass2 labels to generate the history '
+                      'of'.format(execname=execname))
+                return 1
+            console.history(selected, h_flag)
+        elif labels:
             console.interactive(labels, lf)
         else:
             if a_flag:
@@ -206,18 +317,37 @@ class Dispass(object):
                       'label(s) as argument(s)')
                 return 1
 
-            if lf.file_found:
+            if lf.file_found and w_flag:
+                if m_flag or t_flag:
+                    found = console.which(lf, lf.select(patterns=m_flag,
+                                                        tags=t_flag))
+                else:
+                    found = console.which(lf)
+                if not found:
+                    return 1
+                return
+            elif lf.file_found and (m_flag or t_flag):
+                selected = lf.select(patterns=m_flag, tags=t_flag)
+                if not selected:
+                    print('{execname}: no labels in labelfile match the '
+                          'given pattern(s) and/or tag(s)'
+                          .format(execname=execname))
+                    return
+                console.interactive(lf.getAlgodict(selected), lf)
+                return
+            elif lf.file_found:
                 console.interactive(lf.algodict, lf)
                 return
             else:
-                print ('error: could not load labelfile at "{loc}"'
-                       .format(loc=lf.file_location))
+                print loadError(lf)
+                if not lf.writable or lf.read_error:
+                    return 1
                 inp = raw_input('Do you want to create it? Y/n ')
 
                 if inp == '' or inp[0].lower() == 'y':
                     if not lf.save():
                         print ('error: could not save to "{loc}"\n'
-                               .format(loc=lf.file_location))
+                               .format(loc=lf.url or lf.file_location))
                         return 1
                 else:
                     return 1
@@ -226,10 +356,17 @@ class Dispass(object):
 class DispassLabel(object):
     '''Command handler for ``dispass-label``'''
 
+    shortopts = "f:hlV"
+    '''String. Short options in the format of getopt'''
+
+    longopts = ["file=", "help", "list", "script", "version"]
+    '''List of long options in the format of getopt'''
+
     def usage(self):
         '''Print help / usage information'''
 
-        print('USAGE: dispass-label [-hlV] [-f <labelfile>] [--script]\n\n'
+        print('USAGE: dispass-label [-hlV] [-f <labelfile>] [--script]\n'
+              '       dispass-label [-f <labelfile>] <command> [<args>]\n\n'
               'Options:\n'
               '-h, --help      show this help and exit\n'
               '-l, --list      print all labels and options found '
@@ -238,8 +375,188 @@ class DispassLabel(object):
               '-f <labelfile>, --file=<labelfile>\n'
               '                set location of labelfile\n'
               "--script        optimize input/output for 'wrapping' "
-              'dispass-label')
+              'dispass-label\n'
+              '--profile[=<path>]\n'
+              '                write profiling stats to <path> (default: '
+              'dispass-label.prof)\n'
+              '                and print a summary\n\n'
+              'Commands (the labelfile is written once per command):\n'
+              'set-length <length> <pattern> [<pattern2>] [...]\n'
+              '                set length of labels matching any pattern\n'
+              'set-algo <algorithm> <pattern> [<pattern2>] [...]\n'
+              '                set algorithm of labels matching any pattern\n'
+              'remove <pattern> [<pattern2>] [...]\n'
+              '                remove labels matching any pattern\n'
+              'import <labelfile>\n'
+              '                add all labels of <labelfile>, replacing '
+              'labels\n'
+              '                with the same name\n'
+              'merge <theirs> [<base>]\n'
+              '                merge labelfile <theirs> into the labelfile, '
+              'using\n'
+              '                common ancestor <base> for a three-way '
+              'merge\n\n'
+              "Patterns are globs, or regular expressions when prefixed "
+              "with 're:'")
+
+    def edit(self, lf, command, args):
+        '''Apply a bulk edit command to all matching labels and save once
+
+        :Parameters:
+            - `lf`: Filehandler object of the labelfile to edit
+            - `command`: String. One of ``set-length``, ``set-algo``,
+              ``remove`` or ``import``
+            - `args`: List of arguments of the command
 
+        :Return: Integer. Exit code
+        '''
+
+        if command == 'merge':
+            return self.merge(lf, args)
+        elif command == 'import':
+            if len(args) != 1:
+                print 'error: import needs a single labelfile\n'
+                self.usage()
+                return 2
+            imported = getFilehandler(settings, file_location=args[0])
+            if not imported.file_found:
+                print loadError(imported)
+                return 1
+            added, changed = lf.update(imported.labelfile)
+            message = ('Added {added} and changed {changed} label(s)'
+                       .format(added=added, changed=changed))
+        elif command in ('set-length', 'set-algo', 'remove'):
+            if command != 'remove':
+                if not args:
+                    print 'error: {cmd} needs a value\n'.format(cmd=command)
+                    self.usage()
+                    return 2
+                value = args.pop(0)
+            if not args:
+                print 'error: {cmd} needs a pattern\n'.format(cmd=command)
+                self.usage()
+                return 2
+
+            if command == 'set-length':
+                try:
+                    value = int(value)
+                except ValueError:
+                    print 'error: length must be a number'
+                    return 1
+                if value < 1 or value > 171:
+                    print 'error: length must be between 1 and 171'
+                    return 1
+            elif command == 'set-algo':
+                value = value.lower()
+                if value not in algos.algorithms:
+                    print 'error: algo "{algo}" does not exist'.format(
+                        algo=value)
+                    return 1
+
+            try:
+                compilePatterns(args)
+            except ValueError, err:
+                print 'error: {err}'.format(err=err)
+                return 1
+
+            if not lf.file_found:
+                print loadError(lf)
+                return 1
+
+            selected = lf.select(patterns=args)
+            if lf.read_error:
+                print loadError(lf)
+                return 1
+            elif not selected:
+                print 'No labels match the given pattern(s)'
+                return 1
+
+            if command == 'remove':
+                message = ('Removed {qty} label(s)'
+                           .format(qty=lf.remove(label[0]
+                                                 for label in selected)))
+            else:
+                if command == 'set-length':
+                    edited = [(label[0], value) + label[2:]
+                              for label in selected]
+                else:
+                    edited = [label[:2] + (value, ) + label[3:]
+                              for label in selected]
+                message = ('Changed {qty} label(s)'
+                           .format(qty=lf.update(edited)[1]))
+        else:
+            print 'error: unknown command "{cmd}"\n'.format(cmd=command)
+            self.usage()
+            return 2
+
+        if lf.read_error:
+            print loadError(lf)
+            return 1
+        if not lf.save():
+            print ('error: could not save to "{loc}"{err}'
+                   .format(loc=lf.url or lf.file_location,
+                           err=': ' + lf.read_error if lf.read_error else ''))
+            return 1
+        print message
+
+    def merge(self, lf, args):
+        '''Merge another labelfile into `lf` and report all conflicts
+
+        :Parameters:
+            - `lf`: Filehandler object of the labelfile to merge into
+            - `args`: List of the location of theirs and optionally base
+
+        :Return: Integer. Exit code, 1 if there are conflicts
+        '''
+
+        if len(args) not in (1, 2):
+            print 'error: merge needs a labelfile and optionally a base\n'
+            self.usage()
+            return 2
+        if lf.__class__ is not Filehandler:
+            print 'error: merge only supports plain text labelfiles'
+            return 1
+        if not lf.file_found:
+            print loadError(lf)
+            return 1
+
+        merge = LabelfileMerge(settings, lf.file_location, *args)
+        try:
+            if not merge.run():
+                print ('error: could not save to "{loc}"'
+                       .format(loc=lf.url or lf.file_location))
+                return 1
+        except IOError, err:
+            print ('error: could not read labelfile at "{loc}": {err}'
+                   .format(loc=err.filename, err=err.strerror or err))
+            return 1
+
+        print ('Added {added}, changed {changed} and removed {removed} '
+               'label(s)'.format(**merge.counts))
+        if not merge.conflicts:
+            return
+
+        print ('{qty} conflict(s), kept ours:'
+               .format(qty=len(merge.conflicts)))
+        for labelname, base, ours, theirs in merge.conflicts:
+            print labelname
+            for side, label in (('base', base), ('ours', ours),
+                                ('theirs', theirs)):
+                if side == 'base' and len(args) == 1:
+                    continue
+                if label is None:
+                    options = '(removed)'
+                else:
+                    options = ('length={length} algo={algo} seqno={seqno}'
+                               .format(length=label[1], algo=label[2],
+                                       seqno=label[3]))
+                    if label[4]:
+                        options += ' tag=' + ','.join(label[4])
+                print '    {side:7} {options}'.format(side=side,
+                                                      options=options)
+        return 1
+
+    @profiled
     def main(self, argv):
         '''Entry point and handler of command options and arguments
 
@@ -252,9 +569,8 @@ class DispassLabel(object):
         script_flag = None
 
         try:
-            opts, args = getopt.getopt(argv[1:], "f:hlV",
-                                       ["file", "help", "list",
-                                        "script", "version"])
+            opts, args = getopt.getopt(argv[1:], self.shortopts,
+                                       self.longopts)
         except getopt.GetoptError, err:
             print str(err), "\n"
             self.usage()
@@ -276,20 +592,26 @@ class DispassLabel(object):
             else:
                 assert False, "unhandled option"
 
+        # Commands load only what they need of the labelfile
         if f_flag:
-            lf = Filehandler(settings, file_location=f_flag)
+            lf = getFilehandler(settings, file_location=f_flag,
+                                lazy=bool(args))
         else:
-            lf = Filehandler(settings)
+            lf = getFilehandler(settings, lazy=bool(args))
+
+        if args:
+            return self.edit(lf, args[0], args[1:])
 
         if not lf.file_found:
-            print ('error: could not load labelfile at "{loc}"'
-                   .format(loc=lf.file_location))
+            print loadError(lf)
+            if not lf.writable or lf.read_error:
+                return 1
             inp = raw_input('Do you want to create it? Y/n ')
 
             if inp == '' or inp[0].lower() == 'y':
                 if not lf.save():
                     print ('error: could not save to "{loc}"\n'
-                           .format(loc=lf.file_location))
+                           .format(loc=lf.url or lf.file_location))
                     return 1
             else:
                 return 1
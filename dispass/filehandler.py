@@ -14,15 +14,111 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import bisect
 import datetime
+import fnmatch
+import functools
+import gzip
+import hashlib
+import mmap
+import multiprocessing
 import os
+import re
+import sys
+import threading
+import zlib
 from os.path import expanduser, exists
 
 from dispass import __version__
+import metrics
+
+
+def locked(method):
+    '''Run `method` while holding the write lock of the Filehandler'''
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def getParallelSize(value):
+    '''Return the size from which labelfiles are parsed by worker
+    processes
+
+    :Parameters:
+        - `value`: String. Size in MiB, e.g. from the DISPASS_PARALLEL_MIB
+          environment var
+
+    :Return: Integer. Size in bytes, or None to parse every labelfile
+             in-process if `value` is empty or invalid
+    '''
+
+    if not value:
+        return None
+    try:
+        size = int(value)
+        if size < 0:
+            raise ValueError('size can not be negative')
+    except ValueError, err:
+        sys.stderr.write('warning: parsing by worker processes disabled, '
+                         'invalid DISPASS_PARALLEL_MIB "{value}": {err}\n'
+                         .format(value=value, err=err))
+        return None
+    return size << 20
+
+
+def isLabelLine(line):
+    '''Return True if `line` of a labelfile holds a label, False if it is
+    a comment or has nothing but whitespace
+
+    >>> [isLabelLine(line) for line in ('a.com\\n', '# a.com\\n', '\\n', '  ')]
+    [True, False, False, False]
+    '''
+
+    return bool(line) and line[0] != '#' and not line.isspace()
+
+
+def compilePatterns(patterns):
+    '''Return a list of functions that match labelnames with `patterns`
+
+    :Parameters:
+        - `patterns`: List of glob patterns, or regular expressions when
+          prefixed with ``re:``
+
+    :Raise: ValueError if a regular expression is invalid
+
+    >>> compilePatterns(['re:('])
+    Traceback (most recent call last):
+        ...
+    ValueError: invalid pattern "re:(": unbalanced parenthesis
+    '''
+
+    matchers = []
+    for pattern in patterns:
+        if pattern.startswith('re:'):
+            try:
+                matchers.append(re.compile(pattern[len('re:'):]).search)
+            except re.error, err:
+                raise ValueError('invalid pattern "{pattern}": {err}'
+                                 .format(pattern=pattern, err=err))
+        else:
+            matchers.append(re.compile(fnmatch.translate(pattern)).match)
+    return matchers
 
 
 class Filehandler:
-    '''Parsing of labelfiles and writing to labelfiles'''
+    '''Parsing of labelfiles and writing to labelfiles
+
+    The labels are kept per instance in snapshots: `labelfile`,
+    `labelindex`, `tagindex` and `algodict` are never changed after they
+    are set. Methods that change labels build new ones and replace the
+    old ones while holding `lock`, so one Filehandler can be read from
+    several threads without locking while another thread changes it.
+    Readers that need more than one of them take them together from
+    `snapshot`.
+    '''
 
     filehandle = None
     '''File object, set on init if labelfile is found'''
@@ -30,31 +126,109 @@ class Filehandler:
     file_found = None
     '''Boolean value set on init'''
 
+    read_error = None
+    '''String. Why the labelfile could not be read, if it exists but is
+    unreadable or corrupt, e.g. truncated gzip data. save() refuses to
+    overwrite such a labelfile'''
+
     file_location = None
     '''String of labelfile location, set on init'''
 
-    algodict = {}
+    url = None
+    '''String. Location the labelfile was fetched from, if it is not a
+    local file'''
+
+    writable = True
+    '''Boolean. Labels can be saved to the labelfile'''
+
+    lock = None
+    '''threading.RLock object held while labels are changed, set on
+    init'''
+
+    algodict = None
     '''Dictionary of {algorithm: (labelname, (length, seqno))}'''
 
-    labelfile = []
-    '''List of [(labelname, length, algorithm, seqno), ... ]'''
+    labelfile = None
+    '''List of [(labelname, length, algorithm, seqno, tags), ... ] where
+    tags is a tuple of strings'''
+
+    labelindex = None
+    '''Dictionary of {labelname: (labelname, length, algorithm, seqno,
+    tags)}'''
+
+    tagindex = None
+    '''Dictionary of {tag: frozenset([labelname, ...])}'''
+
+    snapshot = None
+    '''Tuple of `(labelfile, labelindex, tagindex, algodict)`, replaced
+    at once with every change'''
+
+    is_sorted = True
+    '''Boolean. True if `labelfile` is sorted on labelname'''
 
     longest_labelname = None
-    '''String. The longest labelname of `labelfile`. Set on refresh()'''
+    '''String. The longest labelname of `labelfile`. Kept up to date by
+    publish() and insert()'''
+
+    lazy = False
+    '''Boolean. Labelfile is not parsed yet, lookups are done via mmap'''
+
+    buffersize = 65536
+    '''Integer. Size in bytes of the write buffer used by save()'''
+
+    compressed = False
+    '''Boolean. The labelfile is gzip compressed, set on init from the
+    gzip magic number of the file or a ``.gz`` extension'''
+
+    compresslevel = 6
+    '''Integer. Gzip compression level used by save() for compressed
+    labelfiles'''
 
-    def __init__(self, settings, file_location=None):
-        '''Open file; if file is found: strip comments and parse()'''
+    parallel_size = getParallelSize(os.getenv('DISPASS_PARALLEL_MIB', ''))
+    '''Integer. Plain text labelfiles of at least this many bytes are
+    parsed by `processes` worker processes, see
+    `parallel.parseLabelfile()`. None to always parse in-process, which
+    is the default: worker processes only pay off on some systems, see
+    ``bench/labelfile.py parallel``'''
+
+    processes = None
+    '''Integer. Number of worker processes for parsing large labelfiles,
+    defaults to the number of cpus'''
+
+    checkpoint = None
+    '''Tuple of `(stamp, offset, digest, count)` of the parsed labelfile:
+    its inode, size and modification time, the offset of the end of its
+    last complete line, a hashlib sha1 object of the bytes up to there and
+    the number of labels in them. None if the labels were changed since
+    they were parsed'''
+
+    def __init__(self, settings, file_location=None, lazy=False):
+        '''Open file; if file is found: strip comments and parse()
+
+        If `lazy` is true the labelfile is not parsed on init. Calls to
+        `search()` and `lookup()` will then scan a memory map of the file
+        and only materialise the lines of matching labels. Any method that
+        needs the full labelfile will parse it first.
+        '''
 
         self.settings = settings
+        self.lock = threading.RLock()
+        self.publish([])
 
         if file_location:
             self.file_location = expanduser(file_location)
         else:
             self.file_location = expanduser(self.getDefaultFileLocation())
+        self.compressed = isGzip(self.file_location)
 
-        self.parse()
+        if lazy:
+            self.lazy = True
+            self.file_found = os.path.isfile(self.file_location)
+        else:
+            self.parse()
 
-    def getDefaultFileLocation(self):
+    @staticmethod
+    def getDefaultFileLocation():
         """Scan default labelfile paths"""
 
         label_env = os.getenv('DISPASS_LABELFILE')
@@ -68,122 +242,776 @@ class Filehandler:
         else:
             return home_file
 
+    @metrics.timed('filehandler.parse')
+    @locked
     def parse(self):
-        '''Create dictionary {algorithm: (label, (length, seqno))}'''
+        '''Create dictionary {algorithm: (label, (length, seqno))}
 
-        file_stripped = []
-        self.labelfile = []
+        When the labelfile was parsed before and lines were only appended
+        to it since, just the appended lines are parsed, see
+        `parseTail()`.
+        '''
 
+        if self.checkpoint is not None and self.parseTail():
+            return self
+
+        labels = []
+        self.read_error = None
         try:
-            self.filehandle = open(self.file_location, 'r')
+            stamp = statStamp(self.file_location)
+            self.filehandle = openLabelfile(self.file_location)
             self.file_found = True
-        except IOError:
+        except (IOError, OSError), err:
+            if os.path.exists(self.file_location):
+                self.read_error = err.strerror or str(err)
             self.file_found = False
+            self.publish(labels)
+            self.lazy = False
             return
 
         # Strip comments and blank lines
-        for i in self.filehandle:
-            if i[0] != '\n' and i[0] != '#':
-                file_stripped.append(i)
+        hashed = None
+        try:
+            parsed = self.parseWorkers() if self.useWorkers() else None
+            if parsed is not None:
+                labels = parsed
+            elif self.compressed or os.linesep != '\n':
+                for i in self.filehandle:
+                    if i[0] != '#' and not i.isspace():
+                        labels.append(self.parseLine(i))
+            else:
+                # Hash the complete lines while they are read, for the
+                # checkpoint. Text mode only reads the bytes as they are
+                # where lines end in a single newline.
+                digest = hashlib.sha1()
+                update = digest.update
+                offset = 0
+                partial = ''
+                for i in self.filehandle:
+                    if i[-1] == '\n':
+                        update(i)
+                        offset += len(i)
+                    else:
+                        partial = i
+                    if i[0] != '#' and not i.isspace():
+                        labels.append(self.parseLine(i))
+                hashed = (digest, offset, partial)
+        except (IOError, zlib.error), err:
+            # Corrupt or truncated gzip data
+            self.read_error = str(err) or 'corrupt gzip data'
+            self.file_found = False
+            labels = []
+        finally:
+            self.filehandle.close()
 
+        self.publish(labels)
+        self.lazy = False
         if self.file_found:
-            self.filehandle.close()
+            self.checkpoint = self.getCheckpoint(stamp, labels, hashed)
+            return self
+
+    def getCheckpoint(self, stamp, labels, hashed=None):
+        '''Return the checkpoint of `labels`, parsed from the labelfile
+        when it had `stamp`
+
+        :Parameters:
+            - `hashed`: Tuple of `(digest, offset, partial)` like that of
+              `hashLines()`, of the lines hashed while parsing. If None
+              the labelfile is read again to hash it
+
+        :Return: Tuple for `checkpoint`, or None if the labelfile is
+                 compressed or changed while it was parsed
+        '''
+
+        if self.compressed:
+            return None
+        try:
+            if hashed is None:
+                filehandle = open(self.file_location, 'rb')
+                try:
+                    hashed = hashLines(filehandle, stamp[1])
+                finally:
+                    filehandle.close()
+            if statStamp(self.file_location) != stamp:
+                return None
+        except (IOError, OSError):
+            return None
+        digest, offset, partial = hashed
+
+        count = len(labels)
+        if isLabelLine(partial):
+            # The last line is not finished yet, it is parsed again later
+            count -= 1
+        return (stamp, offset, digest, count)
+
+    @metrics.timed('filehandler.parse_tail')
+    @locked
+    def parseTail(self):
+        '''Parse only the lines appended since the last parse
+
+        :Return: Boolean. False if the labelfile was changed otherwise and
+                 needs to be parsed again in full
+
+        The labelfile up to the `checkpoint` is hashed again, which is a
+        lot cheaper than parsing it. When it is unchanged, the labels of
+        the appended lines are added to the current snapshot, a label
+        replacing earlier labels with the same name just like in a full
+        parse. A last line without a newline is parsed again next time.
+        '''
+
+        stamp, offset, digest, count = self.checkpoint
+        try:
+            current = statStamp(self.file_location)
+            if current == stamp:
+                return True
+            if current[1] < offset:
+                return False
+
+            filehandle = open(self.file_location, 'rb')
+            try:
+                prefix, end, partial = hashLines(filehandle, offset)
+                data = filehandle.read(current[1] - offset)
+            finally:
+                filehandle.close()
+            if statStamp(self.file_location) != current:
+                return False
+        except (IOError, OSError):
+            return False
+        if end != offset or prefix.digest() != digest.digest():
+            return False
+
+        lines = data.split('\n')
+        partial = lines.pop()
+        labels = [self.parseLine(line) for line in lines
+                  if isLabelLine(line)]
+        prefix.update(data[:len(data) - len(partial)])
+        checkpoint = (current, offset + len(data) - len(partial), prefix,
+                      count + len(labels))
+        if isLabelLine(partial):
+            labels.append(self.parseLine(partial))
+
+        if count == len(self.labelfile):
+            self.extend(labels)
         else:
-            return
+            self.publish(self.labelfile[:count] + labels)
+        self.checkpoint = checkpoint
+        metrics.count('filehandler.tail_labels', len(labels))
+        return True
+
+    def parseWorkers(self):
+        '''Parse the labelfile with worker processes, see
+        `parallel.parseLabelfile()`
+
+        :Return: List of `(labelname, length, algorithm, seqno, tags)`, or
+                 None if the worker processes failed and the labelfile
+                 should be parsed in-process
+        '''
+
+        import parallel
+        try:
+            return parallel.parseLabelfile(self.settings, self.file_location,
+                                           self.processes)
+        except Exception, err:
+            metrics.count('filehandler.workers_failed')
+            sys.stderr.write('warning: parsing "{loc}" by worker processes '
+                             'failed, parsing it in-process: {err!r}\n'
+                             .format(loc=self.file_location, err=err))
+            return None
+
+    def useWorkers(self):
+        '''Return True if the labelfile should be parsed by worker
+        processes'''
+
+        if self.compressed or self.parallel_size is None:
+            return False
+        if (self.processes or multiprocessing.cpu_count()) < 2:
+            return False
+        try:
+            return os.path.getsize(self.file_location) >= self.parallel_size
+        except OSError:
+            return False
+
+    def parseLine(self, line):
+        '''Parse a single line of a labelfile
+
+        :Parameters:
+            - `line`: String. A line of a labelfile for which
+              `isLabelLine()` is True
+
+        :Return:
+            - Tuple of `(labelname, length, algorithm, seqno, tags)`
+        '''
+
+        wordlist = []
+        for word in line.rsplit(' '):
+            if word != '':
+                wordlist.append(word.strip('\n'))
+
+        labelname = wordlist.pop(0)
+        length = self.settings.passphrase_length
+        seqno = self.settings.sequence_number
+        algo = self.settings.algorithm
+        tags = ()
+
+        for arg in wordlist:
+            if arg.startswith('tag='):
+                tags += tuple(tag for tag in arg[len('tag='):].split(',')
+                              if tag and tag not in tags)
+            elif 'length=' in arg:
+                try:
+                    length = int(arg.strip('length='))
+                except ValueError:
+                    print "Warning: Invalid length in: '%s'" % wordlist
+            elif 'algo=' in arg:
+                algo = arg.strip('algo=')
+            elif 'seqno=' in arg:
+                seqno = arg.strip('seqno=')
+
+        return (labelname, length, algo, seqno, tags)
+
+    def getAlgodict(self, labels):
+        '''Create dictionary {algorithm: (label, (length, seqno))}
+
+        :Parameters:
+            - `labels`: List of
+              `(labelname, length, algorithm, seqno, tags)`
+        '''
 
-        labels = []
         labels_dispass1 = []
         labels_dispass2 = []
 
-        for i in file_stripped:
-            wordlist = []
-            line = i.rsplit(' ')
-            for word in line:
-                if word != '':
-                    wordlist.append(word.strip('\n'))
-            labels.append(wordlist)
-
-        for line in labels:
-            labelname = line.pop(0)
-            length = self.settings.passphrase_length
-            seqno = self.settings.sequence_number
-            algo = self.settings.algorithm
-
-            for arg in line:
-                if 'length=' in arg:
-                    try:
-                        length = int(arg.strip('length='))
-                    except ValueError:
-                        print "Warning: Invalid length in: '%s'" % line
-                elif 'algo=' in arg:
-                    algo = arg.strip('algo=')
-                elif 'seqno=' in arg:
-                    seqno = arg.strip('seqno=')
-
+        for labelname, length, algo, seqno, tags in labels:
             if algo == 'dispass1':
                 labels_dispass1.append((labelname, (length, None)))
             elif algo == 'dispass2':
                 labels_dispass2.append((labelname, (length, seqno)))
 
-            self.labelfile.append((labelname, length, algo, seqno))
+        return {'dispass1': dict(labels_dispass1),
+                'dispass2': dict(labels_dispass2)}
 
-        self.algodict = {'dispass1': dict(labels_dispass1),
-                         'dispass2': dict(labels_dispass2)}
-        return self
+    def scan(self, needle):
+        '''Scan a memory map of the labelfile for labelnames
 
-    def add(self, labelname, length=None, algo=None, seqno=None):
-        '''Add label to `labelfile`'''
+        :Parameters:
+            - `needle`: String to find in labelnames
 
-        length = length if length else self.settings.passphrase_length
-        algo = algo if algo else self.settings.algorithm
-        seqno = seqno if seqno else self.settings.sequence_number
+        :Return:
+            - List of `(labelname, length, algorithm, seqno, tags)` of all
+              labels that have `needle` in their labelname
 
-        for label in self.labelfile:
-            if labelname == label[0]:
-                return False
+        The labelfile is searched for occurrences of `needle` without
+        copying it into memory. Only the lines on which `needle` is found
+        within the labelname are parsed. Compressed labelfiles can not be
+        mapped, they are decompressed and searched line by line instead.
+        '''
 
-        self.labelfile.append((labelname, length, algo, seqno))
-        return True
+        labels = []
 
-    def refresh(self, sort=True):
-        '''Sort `labelfile` on labelname and get longest label'''
+        if self.compressed:
+            return self.scanLines(needle)
+
+        try:
+            filehandle = open(self.file_location, 'rb')
+        except IOError:
+            return labels
+
+        try:
+            buf = mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # Empty files can not be mapped
+            filehandle.close()
+            return labels
+
+        size = buf.size()
+        pos = buf.find(needle)
+        while pos != -1 and pos < size:
+            start = buf.rfind('\n', 0, pos) + 1
+            end = buf.find('\n', pos)
+            if end == -1:
+                end = size
 
-        if sort:
-            self.labelfile.sort()
-        labelnames = []
-        for label in self.labelfile:
-            labelnames.append(label[0])
+            name_start = start
+            while name_start < end and buf[name_start] == ' ':
+                name_start += 1
+            name_end = buf.find(' ', name_start, end)
+            if name_end == -1:
+                name_end = end
+
+            if (buf[start] != '#' and name_start < name_end and
+                    buf.find(needle, name_start, name_end) != -1):
+                labels.append(self.parseLine(buf[start:end]))
+            pos = buf.find(needle, end + 1)
+
+        buf.close()
+        filehandle.close()
+        return labels
+
+    def scanLines(self, needle):
+        '''Search the labelfile for labelnames line by line, see `scan()`'''
+
+        labels = []
+        try:
+            filehandle = openLabelfile(self.file_location)
+        except IOError:
+            return labels
+
+        try:
+            for line in filehandle:
+                if needle in line and line[0] != '#':
+                    words = line.split(None, 1)
+                    if words and needle in words[0]:
+                        labels.append(self.parseLine(line))
+        except (IOError, zlib.error), err:
+            self.read_error = str(err) or 'corrupt gzip data'
+        finally:
+            filehandle.close()
+        return labels
+
+    def lookup(self, labelname):
+        '''Find a single label by its exact name
+
+        :Parameters:
+            - `labelname`: String. Name of the label
+
+        :Return:
+            - Tuple of `(labelname, length, algorithm, seqno, tags)` or None
+        '''
+
+        if not self.lazy:
+            return self.labelindex.get(labelname)
+
+        found = None
+        for label in self.scan(labelname):
+            if label[0] == labelname:
+                found = label
+        return found
+
+    def add(self, labelname, length=None, algo=None, seqno=None, tags=()):
+        '''Add label to `labelfile`
+
+        The label is inserted at its sorted position if `labelfile` is
+        sorted already, so saving does not need to sort it again.
+        '''
+
+        return self.addMany([(labelname, length, algo, seqno, tags)]) == 1
+
+    @locked
+    def addMany(self, labels):
+        '''Add labels, skipping existing labels
+
+        :Parameters:
+            - `labels`: Iterable of
+              `(labelname, length, algorithm, seqno, tags)`, where length,
+              algorithm and seqno may be None for defaults
+
+        :Return: Integer. Number of labels that were added
+
+        Every `add()` copies the snapshot of labels, so adding N labels
+        one by one to a labelfile takes O(N^2) time. Here the snapshot is
+        replaced once for all labels.
+        '''
+
+        if self.lazy:
+            self.parse()
+
+        settings = self.settings
+        added = []
+        labelnames = set()
+        for labelname, length, algo, seqno, tags in labels:
+            if labelname in self.labelindex or labelname in labelnames:
+                continue
+            labelnames.add(labelname)
+            added.append((labelname,
+                          length if length else settings.passphrase_length,
+                          algo if algo else settings.algorithm,
+                          seqno if seqno else settings.sequence_number,
+                          tuple(tags)))
+
+        self.insertMany(added)
+        return len(added)
+
+    @locked
+    def update(self, labels):
+        '''Add labels or replace the labels with the same name
+
+        :Parameters:
+            - `labels`: Iterable of
+              `(labelname, length, algorithm, seqno, tags)`
+
+        :Return: Tuple of `(added, changed)` numbers of labels
+
+        All labels are applied in memory in one pass; call save() once
+        afterwards to write them.
+        '''
+
+        if self.lazy:
+            self.parse()
+
+        labelindex = dict(self.labelindex)
+        added = changed = 0
+        for label in labels:
+            label = tuple(label[:4]) + (tuple(label[4]), )
+            current = labelindex.get(label[0])
+            if current is None:
+                added += 1
+            elif current != label:
+                changed += 1
+            else:
+                continue
+            labelindex[label[0]] = label
+
+        if added or changed:
+            self.publish(sorted(labelindex.itervalues()), is_sorted=True)
+        return (added, changed)
+
+    @locked
+    def remove(self, labelnames):
+        '''Remove labels by name
+
+        :Parameters:
+            - `labelnames`: Iterable of labelnames
+
+        :Return: Integer. Number of labels removed
+        '''
+
+        if self.lazy:
+            self.parse()
+
+        labelnames = set(labelnames) & set(self.labelindex)
         if labelnames:
-            self.longest_labelname = max(labelnames, key=len)
-
-    def save(self):
-        '''Save `labelfile` to file'''
-
-        self.refresh()
-        labelfile = ('# Generated by DisPass {version} on {datetime}\n\n'
-                     .format(version=__version__,
-                             datetime=datetime.datetime.now()))
-        for label in self.labelfile:
-            options = ''
-            if label[1] != self.settings.passphrase_length:
-                options += 'length={length}  '.format(length=label[1])
-            if label[2] != self.settings.algorithm:
-                options += 'algo={algo}  '.format(algo=label[2])
-            if label[3] != self.settings.sequence_number:
-                options += 'seqno={seqno}  '.format(seqno=label[3])
-
-            labelfile += ('{label:{divlen}}  {options}\n'
-                          .format(label=label[0], options=options,
-                                  divlen=len(self.longest_labelname)))
+            self.publish([label for label in self.labelfile
+                          if label[0] not in labelnames], self.is_sorted)
+        return len(labelnames)
+
+    @locked
+    def applyReload(self, current, added, removed, changed):
+        '''Apply the differences with the labelfile as it was read again
+        to the labels in memory
+
+        :Parameters:
+            - `current`: Filehandler of the same class that read the
+              labelfile again
+            - `added`, `removed`, `changed`: Lists of
+              `(labelname, length, algorithm, seqno, tags)` that differ
+              between the labels in memory and `current`
+
+        Used by `LabelfileWatcher`. Unlike `update()` and `remove()`
+        nothing is written to the storage of the labelfile, which has the
+        labels already.
+        '''
+
+        labelindex = dict(self.labelindex)
+        for label in added + changed:
+            labelindex[label[0]] = label
+        for label in removed:
+            del labelindex[label[0]]
+        self.publish(sorted(labelindex.itervalues()), is_sorted=True)
+
+    @locked
+    def reindex(self):
+        '''Rebuild `labelindex`, `tagindex`, `longest_labelname` and
+        `algodict` from `labelfile`'''
+
+        self.publish(self.labelfile, self.is_sorted)
+
+    def publish(self, labels, is_sorted=None):
+        '''Replace the snapshot of labels with `labels`
+
+        :Parameters:
+            - `labels`: List of `(labelname, length, algorithm, seqno,
+              tags)`, which must not be changed afterwards
+            - `is_sorted`: Boolean. Whether `labels` is sorted, checked if
+              not given
+
+        All indexes are built before any of them is replaced, so readers
+        never see a partly built snapshot.
+        '''
+
+        labelindex = {}
+        tagindex = {}
+        longest = None
+        for label in labels:
+            labelindex[label[0]] = label
+            for tag in label[4]:
+                tagindex.setdefault(tag, []).append(label[0])
+            if longest is None or len(label[0]) > len(longest):
+                longest = label[0]
+        if is_sorted is None:
+            is_sorted = all(labels[i - 1] <= labels[i]
+                            for i in xrange(1, len(labels)))
+
+        tagindex = dict((tag, frozenset(labelnames))
+                        for tag, labelnames in tagindex.iteritems())
+        self.setSnapshot(labels, labelindex, tagindex,
+                         self.getAlgodict(labels))
+        self.longest_labelname = longest
+        self.is_sorted = is_sorted
+
+    def insert(self, label):
+        '''Replace the snapshot of labels with one that includes `label`
+
+        Copies of the current snapshot are changed, which is cheaper than
+        building it again with `publish()`.
+        '''
+
+        labelfile = list(self.labelfile)
+        if self.is_sorted:
+            bisect.insort(labelfile, label)
+        else:
+            labelfile.append(label)
+
+        labelindex = dict(self.labelindex)
+        labelindex[label[0]] = label
+        tagindex = dict(self.tagindex)
+        for tag in label[4]:
+            tagindex[tag] = tagindex.get(tag, frozenset()) | set([label[0]])
+        algodict = dict(self.algodict)
+        if label[2] in algodict:
+            algodict[label[2]] = dict(algodict[label[2]])
+            algodict[label[2]][label[0]] = (
+                label[1], label[3] if label[2] == 'dispass2' else None)
+
+        self.setSnapshot(labelfile, labelindex, tagindex, algodict)
+        if (self.longest_labelname is None or
+                len(label[0]) > len(self.longest_labelname)):
+            self.longest_labelname = label[0]
+
+    def insertMany(self, labels):
+        '''Replace the snapshot of labels with one that includes `labels`
+
+        The current snapshot is copied once, instead of once per label by
+        calling `insert()` for each of them.
+        '''
+
+        if len(labels) == 1:
+            self.insert(labels[0])
+        elif labels and self.is_sorted:
+            self.publish(sorted(self.labelfile + labels), is_sorted=True)
+        else:
+            self.extend(labels)
+
+    def extend(self, labels):
+        '''Replace the snapshot of labels with one that has `labels`
+        appended
+
+        Like `insert()` copies of the current snapshot are changed. The
+        labels are applied in order, so the result is the same as that of
+        `publish()` of all labels.
+        '''
+
+        if not labels:
+            return
+
+        labelfile = self.labelfile + labels
+        labelindex = dict(self.labelindex)
+        algodict = dict((algo, dict(algolabels)) for algo, algolabels
+                        in self.algodict.iteritems())
+        tagged = {}
+        longest = self.longest_labelname
+        for label in labels:
+            labelindex[label[0]] = label
+            for tag in label[4]:
+                tagged.setdefault(tag, []).append(label[0])
+            if label[2] in algodict:
+                algodict[label[2]][label[0]] = (
+                    label[1], label[3] if label[2] == 'dispass2' else None)
+            if longest is None or len(label[0]) > len(longest):
+                longest = label[0]
+
+        tagindex = dict(self.tagindex)
+        for tag, labelnames in tagged.iteritems():
+            tagindex[tag] = tagindex.get(tag, frozenset()).union(labelnames)
+        is_sorted = self.is_sorted and all(
+            labelfile[i - 1] <= labelfile[i]
+            for i in xrange(max(len(self.labelfile), 1), len(labelfile)))
+
+        self.setSnapshot(labelfile, labelindex, tagindex, algodict)
+        self.longest_labelname = longest
+        self.is_sorted = is_sorted
+
+    def setSnapshot(self, labelfile, labelindex, tagindex, algodict):
+        '''Replace `snapshot` and the attributes it consists of
+
+        The `checkpoint` is dropped, as the labels may no longer be those
+        of the labelfile.
+        '''
+
+        self.checkpoint = None
+        self.snapshot = (labelfile, labelindex, tagindex, algodict)
+        self.labelfile = labelfile
+        self.labelindex = labelindex
+        self.tagindex = tagindex
+        self.algodict = algodict
+
+    @locked
+    def refresh(self, sort=True):
+        '''Sort `labelfile` on labelname if it is not sorted already'''
+
+        if sort and not self.is_sorted:
+            self.setSnapshot(sorted(self.labelfile), self.labelindex,
+                             self.tagindex, self.algodict)
+            self.is_sorted = True
+
+    @metrics.timed('filehandler.save')
+    @locked
+    def save(self, sort=True):
+        '''Save `labelfile` to file
+
+        :Parameters:
+            - `sort`: Boolean. Sort `labelfile` before saving; pass False
+              if `labelfile` is known to be in order already
+
+        Labels are formatted and written one by one through a buffered
+        file object, so no copy of the entire labelfile is kept in memory.
+        Nothing is written if the labelfile could not be read, see
+        `read_error`.
+        '''
+
+        if self.lazy:
+            self.parse()
+        if self.read_error:
+            return False
+
+        self.refresh(sort)
+        if self.longest_labelname:
+            divlen = len(self.longest_labelname)
+        else:
+            divlen = 0
+
+        if not self.writeLabelfile(self.file_location, self.labelfile, divlen):
+            return False
+
+        self.writeIndex(label[0] for label in self.labelfile)
+        return True
+
+    def writeLabelfile(self, file_location, labels, divlen):
+        '''Write labels to a labelfile
+
+        :Parameters:
+            - `file_location`: String. Location of the labelfile
+            - `labels`: Iterable of
+              `(labelname, length, algorithm, seqno, tags)`
+            - `divlen`: Integer. Width of the labelname column
+
+        :Return: Boolean. True if the labelfile was written
+
+        The labelfile is gzip compressed if `compressed` is set. The
+        compressed data is written through the same buffer.
+        '''
+
         try:
-            self.filehandle = open(self.file_location, 'w')
-            self.filehandle.write(labelfile)
-            self.filehandle.close()
+            filehandle = rawfile = open(file_location, 'wb', self.buffersize)
+            if self.compressed:
+                filehandle = gzip.GzipFile(
+                    os.path.basename(file_location), 'wb',
+                    self.compresslevel, rawfile)
+            filehandle.write(
+                '# Generated by DisPass {version} on {datetime}\n\n'
+                .format(version=__version__, datetime=datetime.datetime.now())
+            )
+            for label in labels:
+                filehandle.write(self.formatLine(label, divlen))
+            filehandle.close()
+            rawfile.close()
+        except IOError:
+            return False
+
+        return True
+
+    def getIndexLocation(self):
+        '''Return location of the label index of the labelfile'''
+
+        return self.file_location.rstrip(os.sep) + '.idx'
+
+    def writeIndex(self, labelnames):
+        '''Write the label index used for shell completion
+
+        :Parameters:
+            - `labelnames`: Iterable of labelnames, in any order
+
+        :Return: Boolean. True if the index was written
+
+        The index is a file next to the labelfile with every labelname on
+        a line of its own, in sorted order, so the ``dispass-complete``
+        script can find labels by prefix without parsing the labelfile.
+        The labelnames are always sorted here, as a labelfile saved with
+        ``sort=False`` may be out of order.
+        '''
+
+        try:
+            filehandle = open(self.getIndexLocation(), 'w', self.buffersize)
+            for labelname in sorted(set(labelnames)):
+                filehandle.write(labelname + '\n')
+            filehandle.close()
         except IOError:
             return False
 
         return True
 
+    def formatLine(self, label, divlen):
+        '''Format a label as a line of a labelfile
+
+        :Parameters:
+            - `label`: Tuple of `(labelname, length, algorithm, seqno, tags)`
+            - `divlen`: Integer. Width of the labelname column
+
+        :Return:
+            - String. The line including the trailing newline
+        '''
+
+        options = ''
+        if label[1] != self.settings.passphrase_length:
+            options += 'length={length}  '.format(length=label[1])
+        if label[2] != self.settings.algorithm:
+            options += 'algo={algo}  '.format(algo=label[2])
+        if label[3] != self.settings.sequence_number:
+            options += 'seqno={seqno}  '.format(seqno=label[3])
+        if label[4]:
+            options += 'tag={tags}  '.format(tags=','.join(label[4]))
+
+        return ('{label:{divlen}}  {options}\n'
+                .format(label=label[0], options=options, divlen=divlen))
+
+    def select(self, patterns=(), tags=()):
+        '''Select labels by labelname pattern and/or tag
+
+        :Parameters:
+            - `patterns`: List of glob patterns, or regular expressions
+              when prefixed with ``re:``, to match labelnames with
+            - `tags`: List of tags
+
+        :Return:
+            - List of `(labelname, length, algorithm, seqno, tags)` of the
+              labels that match any of `patterns` and have any of `tags`.
+              Empty `patterns` or `tags` are not used for selecting.
+        :Raise: ValueError if a regular expression is invalid, see
+                `compilePatterns()`
+
+        Labels are looked up in `tagindex`, so only labels with one of
+        `tags` are matched against `patterns`.
+        '''
+
+        if self.lazy:
+            self.parse()
+        labelfile, labelindex, tagindex, algodict = self.snapshot
+
+        if tags:
+            labelnames = set()
+            for tag in tags:
+                labelnames.update(tagindex.get(tag, ()))
+            labelnames = sorted(labelname for labelname in labelnames
+                                if set(tags) & set(labelindex[labelname][4]))
+        else:
+            labelnames = sorted(labelindex)
+
+        if patterns:
+            matchers = compilePatterns(patterns)
+            labelnames = [labelname for labelname in labelnames
+                          if any(match(labelname) for match in matchers)]
+
+        return [labelindex[labelname] for labelname in labelnames]
+
+    @metrics.timed('filehandler.search')
     def search(self, search_string):
         '''Search for substring in labelfile
 
@@ -206,7 +1034,12 @@ class Filehandler:
         length = None
         seqno = None
 
-        for algo, labels in self.algodict.iteritems():
+        if self.lazy:
+            algodict = self.getAlgodict(self.scan(search_string))
+        else:
+            algodict = self.algodict
+
+        for algo, labels in algodict.iteritems():
             for label, params in labels.iteritems():
                 if search_string in label:
                     found_algo = algo
@@ -225,12 +1058,12 @@ class Filehandler:
 
     def getLongestLabel(self):
         '''Return length of longest label name'''
-        labelnames = []
-        for algo, labels in self.algodict.iteritems():
-            for label, params in labels.iteritems():
-                labelnames.append(label)
-        if labelnames:
-            return len(max(labelnames, key=len))
+
+        if self.lazy:
+            self.parse()
+
+        if self.longest_labelname:
+            return len(self.longest_labelname)
         else:
             return False
 
@@ -253,6 +1086,9 @@ class Filehandler:
         If fixed columns is false an ascii table is printed with a variable
         width depending on the length of the longest label.
         '''
+        if self.lazy:
+            self.parse()
+
         if fixed_columns:
             for label in self.labelfile:
                 print('{:50} {:3} {:15} {:3}'
@@ -273,3 +1109,117 @@ class Filehandler:
                               fill=divlen))
             print('+-{:{fill}}-+--------+----------+--------+'
                   .format('-' * divlen, fill=divlen))
+
+
+def getFilehandler(settings, file_location=None, lazy=False):
+    '''Return a handler for the labelfile at `file_location`
+
+    :Parameters:
+        - `settings`: Settings object
+        - `file_location`: String. Location of labelfile (optional)
+        - `lazy`: Boolean. Do not parse the labelfile on init
+
+    :Return:
+        - `HTTPFilehandler` if the labelfile is an http or https URL
+        - `ShardedFilehandler` if the labelfile is a sharded labelfile
+          directory or a location ending in a path separator that does not
+          exist yet
+        - `SQLiteFilehandler` if the labelfile is an SQLite database or
+          has a ``.db`` or ``.sqlite`` extension
+        - `Filehandler` otherwise
+    '''
+
+    location = expanduser(file_location or
+                          Filehandler.getDefaultFileLocation())
+
+    if location.startswith(('http://', 'https://')):
+        from httphandler import HTTPFilehandler
+        return HTTPFilehandler(settings, location, lazy=lazy)
+
+    if os.path.isdir(location) or location.endswith(os.sep):
+        from shardhandler import ShardedFilehandler, isSharded
+        if isSharded(location) or not exists(location):
+            return ShardedFilehandler(settings, location, lazy=lazy)
+
+    if location.endswith(('.db', '.sqlite')) or isSQLite(location):
+        from sqlitehandler import SQLiteFilehandler
+        return SQLiteFilehandler(settings, location, lazy=lazy)
+
+    return Filehandler(settings, location, lazy=lazy)
+
+
+def isSQLite(file_location):
+    '''Return True if `file_location` is an SQLite database'''
+
+    try:
+        filehandle = open(file_location, 'rb')
+    except IOError:
+        return False
+
+    header = filehandle.read(16)
+    filehandle.close()
+    return header == 'SQLite format 3\0'
+
+
+def isGzip(file_location):
+    '''Return True if `file_location` is a gzip compressed file, or does
+    not exist yet and has a ``.gz`` extension'''
+
+    try:
+        filehandle = open(file_location, 'rb')
+    except IOError:
+        return file_location.endswith('.gz')
+
+    header = filehandle.read(2)
+    filehandle.close()
+    return header == '\x1f\x8b'
+
+
+def statStamp(file_location):
+    '''Return the inode, size and modification time of `file_location`
+
+    :Raise: OSError if the file does not exist
+    '''
+
+    stat = os.stat(file_location)
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+def hashLines(filehandle, size):
+    '''Hash the complete lines in the next `size` bytes of `filehandle`
+
+    :Return:
+        - Tuple of `(digest, offset, partial)`: a hashlib sha1 object of
+          the bytes up to and including the last newline, the offset of
+          the end of that newline and the bytes after it
+    '''
+
+    digest = hashlib.sha1()
+    offset = filehandle.tell()
+    partial = ''
+    while size > 0:
+        block = filehandle.read(min(size, 1 << 20))
+        if not block:
+            break
+        size -= len(block)
+        newline = block.rfind('\n')
+        if newline < 0:
+            partial += block
+            continue
+        digest.update(partial)
+        digest.update(block[:newline + 1])
+        offset += len(partial) + newline + 1
+        partial = block[newline + 1:]
+    return (digest, offset, partial)
+
+
+def openLabelfile(file_location):
+    '''Open a labelfile for reading lines, decompressing it while reading
+    if it is gzip compressed
+
+    :Raise: IOError if the labelfile can not be opened
+    '''
+
+    if isGzip(file_location):
+        return gzip.open(file_location, 'rb')
+    return open(file_location, 'r')
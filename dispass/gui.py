@@ -16,9 +16,10 @@ from Tkinter import *
 import tkMessageBox
 import ttk
 
-import algos
+from cache import PassphraseCache
 from dispass import versionStr as dispass_version
-from filehandler import Filehandler
+from filehandler import getFilehandler
+from watcher import LabelfileWatcher
 
 versionStr = 'g%s' % dispass_version
 
@@ -40,8 +41,10 @@ class GUI(Frame):
         '''
 
         self.settings = settings
-        self.labelspecs = {l[0]: l[1:] for l in
-                           Filehandler(self.settings).labelfile}
+        self.cache = PassphraseCache()
+        self.filehandler = getFilehandler(self.settings)
+        self.watcher = LabelfileWatcher(self.filehandler)
+        self.setLabelspecs()
 
         Frame.__init__(self, Tk(className='dispass'))
         self.lengthVar = IntVar()
@@ -49,8 +52,14 @@ class GUI(Frame):
         self.master.title(versionStr)
         self.grid()
         self.createWidgets()
+        self.after(int(self.watcher.interval * 1000), self.watchLabelfile)
 
 # GUI # Setters and getters
+    def setLabelspecs(self):
+        '''Set `labelspecs` to the labels of the labelfile'''
+
+        self.labelspecs = {l[0]: l[1:] for l in self.filehandler.labelfile}
+
     def setFont(self):
         '''Set font and fontsize; not used at this moment'''
         pass
@@ -117,9 +126,9 @@ class GUI(Frame):
                       box_title='Password mismatch')
             return
 
-        # All checks passed, create digest
-        h = algos.Dispass1.digest(label + passwordin1,
-                                  length=self.lengthVar.get())
+        # All checks passed, create digest or reuse it from the cache
+        h = self.cache.digest((label, self.lengthVar.get(), 'dispass1', None),
+                              passwordin1)
         self.result.config(fg="black", readonlybackground="green")
         self.passwordout.set(h)
         self.clearInput()
@@ -162,6 +171,28 @@ class GUI(Frame):
         self.clearIO()
         self.label.focus_set()
 
+    def lock(self):
+        '''Wipe the passphrase cache and reset all fields'''
+
+        self.cache.wipe()
+        self.reset()
+
+    def quit(self):
+        '''Wipe the passphrase cache, stop watching the labelfile and quit'''
+
+        self.cache.wipe()
+        self.watcher.stop()
+        Frame.quit(self)
+
+    def watchLabelfile(self):
+        '''Reload labels changed by other programs, then check again
+        after `LabelfileWatcher.interval` seconds'''
+
+        if self.watcher.check():
+            self.setLabelspecs()
+            self.label.config(values=sorted(self.labelspecs))
+        self.after(int(self.watcher.interval * 1000), self.watchLabelfile)
+
     def labelSelected(self, event):
         '''Set values of input fields according to the selected label.'''
         self.lengthVar.set(self.labelspecs[self.label.get()][0])
@@ -211,7 +242,8 @@ class GUI(Frame):
         self.passwordin2.bind('<Return>', lambda e: genbutton.invoke())
         length.bind('<Return>', lambda e: genbutton.invoke())
         self.master.bind('<Control-q>', lambda e: self.quit())
-        self.master.bind('<Escape>', lambda e: self.reset())
+        self.master.bind('<Escape>', lambda e: self.lock())
+        self.master.protocol('WM_DELETE_WINDOW', self.quit)
         self.label.bind('<<ComboboxSelected>>', self.labelSelected)
 
         # Layout widgets in a grid
@@ -0,0 +1,208 @@
+'''Dispass labelfile handler for labelfiles served over http(s)'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import urllib2
+
+import metrics
+from filehandler import Filehandler
+
+
+def isURL(file_location):
+    '''Return True if `file_location` is an http or https URL'''
+
+    return file_location.startswith(('http://', 'https://'))
+
+
+def getCacheDir():
+    '''Return the directory in which fetched labelfiles are cached'''
+
+    cache_env = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_env, 'dispass', 'http')
+
+
+class HTTPFilehandler(Filehandler):
+    '''Read-only labelfile fetched from a web server
+
+    The labelfile is downloaded into a local cache on init. When it is in
+    the cache already, the request carries the ``ETag`` and
+    ``Last-Modified`` headers of the cached copy, so an unchanged labelfile
+    is answered with a ``304 Not Modified`` and only the cached copy is
+    parsed. While the copy is fresh according to the ``max-age`` of the
+    server, no request is made at all. When the server can not be reached
+    the cached copy is used. An error response of the server, or a
+    download that is shorter or longer than its ``Content-Length``, is
+    warned about on stderr and leaves the cached copy as it is.
+
+    Apart from init it works on the cached copy just like `Filehandler`,
+    including gzip compressed labelfiles. Labels can not be saved.
+    '''
+
+    url = None
+    '''String. URL of the labelfile'''
+
+    writable = False
+
+    timeout = 10
+    '''Integer. Seconds to wait for the web server'''
+
+    status = None
+    '''Integer. HTTP status of the last request, None if no request was
+    made or the server could not be reached'''
+
+    def __init__(self, settings, file_location=None, lazy=False):
+        '''Fetch labelfile `file_location` into the cache and open it
+
+        A `file_location` that is not a URL is opened as a cached copy
+        without fetching it, e.g. when reloaded by `LabelfileWatcher`.
+        '''
+
+        if file_location and isURL(file_location):
+            self.url = file_location
+            name = hashlib.sha1(file_location).hexdigest()
+            file_location = os.path.join(getCacheDir(), name)
+            self.fetch(file_location)
+
+        Filehandler.__init__(self, settings, file_location, lazy=lazy)
+
+    def getMetaLocation(self, file_location):
+        '''Return location of the cached response headers'''
+
+        return file_location + '.meta'
+
+    def readMeta(self, file_location):
+        '''Return the dictionary of cached response headers, or an empty
+        dictionary if the labelfile is not cached'''
+
+        if not os.path.isfile(file_location):
+            return {}
+        try:
+            filehandle = open(self.getMetaLocation(file_location))
+            meta = json.load(filehandle)
+            filehandle.close()
+        except (IOError, ValueError):
+            return {}
+        return meta
+
+    def writeMeta(self, file_location, headers, previous={}):
+        '''Cache the validators and expiry time of a response
+
+        Validators missing from `headers`, e.g. of a ``304`` response, are
+        taken from the `previous` cached headers.
+        '''
+
+        meta = {'etag': headers.get('ETag') or previous.get('etag'),
+                'last_modified': (headers.get('Last-Modified') or
+                                  previous.get('last_modified')),
+                'expires': 0}
+        match = re.search(r'max-age=(\d+)', headers.get('Cache-Control', ''))
+        if match and 'no-cache' not in headers.get('Cache-Control', ''):
+            meta['expires'] = time.time() + int(match.group(1))
+
+        try:
+            filehandle = open(self.getMetaLocation(file_location), 'w')
+            json.dump(meta, filehandle)
+            filehandle.close()
+        except IOError:
+            pass
+
+    @metrics.timed('httphandler.fetch')
+    def fetch(self, file_location):
+        '''Download `url` to `file_location` unless the cached copy there
+        is still valid
+
+        :Return: Boolean. True if a usable copy is at `file_location`
+        '''
+
+        def warn(reason):
+            sys.stderr.write('warning: could not fetch labelfile "{url}": '
+                             '{reason}, {fallback}\n'.format(
+                                 url=self.url, reason=reason,
+                                 fallback=('using the cached copy' if meta
+                                           else 'no cached copy')))
+
+        meta = self.readMeta(file_location)
+        if meta.get('expires', 0) > time.time():
+            metrics.count('httphandler.fresh')
+            return True
+
+        request = urllib2.Request(self.url)
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            request.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError, err:
+            self.status = err.code
+            if err.code == 304 and meta:
+                metrics.count('httphandler.not_modified')
+                self.writeMeta(file_location, err.info(), meta)
+                return True
+            metrics.count('httphandler.error')
+            warn('HTTP {code} {msg}'.format(code=err.code, msg=err.msg))
+            return bool(meta)
+        except (urllib2.URLError, EnvironmentError):
+            return bool(meta)
+
+        self.status = response.getcode()
+        metrics.count('httphandler.downloaded')
+        directory = os.path.dirname(file_location)
+        temp_location = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            fd, temp_location = tempfile.mkstemp(prefix='.fetch-',
+                                                 dir=directory)
+            filehandle = os.fdopen(fd, 'wb')
+            shutil.copyfileobj(response, filehandle, self.buffersize)
+            received = filehandle.tell()
+            filehandle.close()
+            length = response.info().get('Content-Length', '')
+            if length.isdigit() and received != int(length):
+                # The connection was closed before the whole labelfile
+                # was received
+                os.remove(temp_location)
+                metrics.count('httphandler.truncated')
+                warn('received {received} of {length} bytes'
+                     .format(received=received, length=length))
+                return bool(meta)
+            os.rename(temp_location, file_location)
+        except EnvironmentError:
+            if temp_location and os.path.exists(temp_location):
+                os.remove(temp_location)
+            return bool(meta)
+        finally:
+            response.close()
+
+        self.writeMeta(file_location, response.info())
+        return True
+
+    def save(self, sort=True):
+        '''Labelfiles served over http(s) can not be saved
+
+        :Return: Boolean. Always False
+        '''
+
+        return False
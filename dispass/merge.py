@@ -0,0 +1,211 @@
+'''Merging of labelfiles'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import heapq
+import itertools
+import os
+import tempfile
+import zlib
+
+from filehandler import Filehandler, isLabelLine, openLabelfile
+
+
+class LabelfileMerge:
+    '''Two- or three-way merge of plain text labelfiles
+
+    The labelfiles are read line by line in labelname order, which is the
+    order `Filehandler.save()` writes them in, so a merge takes linear time
+    and only keeps a few lines in memory. A labelfile that is not in order
+    is sorted in memory first.
+
+    Without a base, labels of both labelfiles are combined and a label
+    with different options in ours and theirs is a conflict. With a base,
+    a label changed or removed on one side only takes that change and a
+    label changed differently on both sides is a conflict. Ours is kept
+    for all conflicts.
+    '''
+
+    def __init__(self, settings, ours, theirs, base=None):
+        '''Set the locations of the labelfiles to merge
+
+        :Parameters:
+            - `settings`: Settings object
+            - `ours`: String. Location of the labelfile to merge into
+            - `theirs`: String. Location of the labelfile to merge from
+            - `base`: String. Location of the common ancestor of ours and
+              theirs, optional
+        '''
+
+        self.settings = settings
+        self.filehandler = Filehandler(settings, ours, lazy=True)
+        self.locations = [os.path.expanduser(location)
+                          for location in (ours, theirs, base) if location]
+
+        self.conflicts = []
+        '''List of `(labelname, base, ours, theirs)` of conflicting labels,
+        where a label is None if it does not exist on that side'''
+
+        self.counts = {'added': 0, 'changed': 0, 'removed': 0}
+        '''Dictionary of the number of labels added to, changed in and
+        removed from ours'''
+
+    def check(self, location):
+        '''Read a labelfile once to check its order
+
+        :Return: Tuple of `(in_order, longest)` where `longest` is the
+                 length of the longest labelname
+        :Raise: IOError if the labelfile can not be read or is corrupt
+        '''
+
+        in_order = True
+        longest = 0
+        previous = None
+        filehandle = openLabelfile(location)
+        try:
+            for line in filehandle:
+                if not isLabelLine(line):
+                    continue
+                labelname = line.split(None, 1)[0]
+                if previous is not None and labelname < previous:
+                    in_order = False
+                previous = labelname
+                longest = max(longest, len(labelname))
+        except (IOError, zlib.error), err:
+            # Truncated gzip data raises IOError without a filename
+            raise IOError(getattr(err, 'errno', None),
+                          getattr(err, 'strerror', None) or str(err),
+                          location)
+        finally:
+            filehandle.close()
+        return (in_order, longest)
+
+    def readLabels(self, location):
+        '''Yield the labels of a labelfile in file order
+
+        Sequence numbers are converted to integers, so labels only
+        differing in whether the default sequence number is written out
+        are equal.
+        '''
+
+        filehandle = openLabelfile(location)
+        try:
+            for line in filehandle:
+                if isLabelLine(line):
+                    label = self.filehandler.parseLine(line)
+                    if str(label[3]).isdigit():
+                        label = label[:3] + (int(label[3]), label[4])
+                    yield label
+        finally:
+            filehandle.close()
+
+    def orderedLabels(self, location, in_order):
+        '''Yield the labels of a labelfile in labelname order, keeping the
+        last of labels with the same name'''
+
+        if in_order:
+            labels = self.readLabels(location)
+        else:
+            labels = sorted(self.readLabels(location),
+                            key=lambda label: label[0])
+
+        for labelname, group in itertools.groupby(
+                labels, key=lambda label: label[0]):
+            for label in group:
+                pass
+            yield label
+
+    def mergeLabels(self, streams):
+        '''Yield the merged labels of ours, theirs and base streams
+
+        Conflicts and counts are collected in `conflicts` and `counts`.
+        '''
+
+        def keyed(i, stream):
+            for label in stream:
+                yield (label[0], i, label)
+
+        three_way = len(streams) == 3
+        merged = heapq.merge(*[keyed(i, stream)
+                               for i, stream in enumerate(streams)])
+
+        for labelname, group in itertools.groupby(merged,
+                                                  key=lambda item: item[0]):
+            sides = [None, None, None]
+            for labelname, i, label in group:
+                sides[i] = label
+            ours, theirs, base = sides
+
+            if ours == theirs:
+                result = ours
+            elif three_way and ours == base:
+                result = theirs
+            elif three_way and theirs == base:
+                result = ours
+            elif not three_way and (ours is None or theirs is None):
+                result = ours or theirs
+            else:
+                self.conflicts.append((labelname, base, ours, theirs))
+                result = ours
+
+            if result != ours:
+                if ours is None:
+                    self.counts['added'] += 1
+                elif result is None:
+                    self.counts['removed'] += 1
+                else:
+                    self.counts['changed'] += 1
+            if result is not None:
+                yield result
+
+    def run(self):
+        '''Merge the labelfiles and replace ours with the result
+
+        The result is written to a temporary file next to ours, which is
+        then renamed over ours, so ours is never left half written.
+
+        :Return: Boolean. True if the merged labelfile was written
+        :Raise: IOError if one of the labelfiles can not be read
+        '''
+
+        checks = [self.check(location) for location in self.locations]
+        divlen = max(longest for in_order, longest in checks)
+        streams = [self.orderedLabels(location, in_order)
+                   for location, (in_order, longest)
+                   in zip(self.locations, checks)]
+
+        ours = self.locations[0]
+        try:
+            fd, temp_location = tempfile.mkstemp(
+                prefix='.merge-', dir=os.path.dirname(ours) or '.')
+            os.close(fd)
+        except OSError:
+            return False
+
+        if not self.filehandler.writeLabelfile(
+                temp_location, self.mergeLabels(streams), divlen):
+            os.remove(temp_location)
+            return False
+
+        try:
+            os.chmod(temp_location, os.stat(ours).st_mode & 0777)
+            os.rename(temp_location, ours)
+        except OSError:
+            os.remove(temp_location)
+            return False
+
+        self.filehandler.writeIndex(
+            label[0] for label in self.readLabels(ours))
+        return True
@@ -0,0 +1,211 @@
+'''Counters and timers of dispass operations'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import os
+import socket
+import sys
+import time
+
+sinks = []
+'''List of sinks that receive metrics. Nothing is measured while empty'''
+
+
+class Registry:
+    '''Sink keeping counters and timers in memory
+
+    >>> registry = Registry()
+    >>> registry.count('parse.calls', 1)
+    >>> registry.count('parse.calls', 2)
+    >>> registry.timing('parse', 4.0)
+    >>> registry.timing('parse', 2.0)
+    >>> registry.counters
+    {'parse.calls': 3}
+    >>> registry.timers
+    {'parse': [2, 6.0, 2.0, 4.0]}
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        '''Dictionary of {name: count}'''
+
+        self.timers = {}
+        '''Dictionary of {name: [count, total ms, min ms, max ms]}'''
+
+    def count(self, name, value):
+        '''Add `value` to counter `name`'''
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, ms):
+        '''Add a call of `ms` milliseconds to timer `name`'''
+
+        timer = self.timers.get(name)
+        if timer:
+            timer[0] += 1
+            timer[1] += ms
+            timer[2] = min(timer[2], ms)
+            timer[3] = max(timer[3], ms)
+        else:
+            self.timers[name] = [1, ms, ms, ms]
+
+
+class FileSink:
+    '''Sink appending a line of `<timestamp> <name> <value>|<type>` per
+    metric to a local file'''
+
+    def __init__(self, file_location):
+        '''Open `file_location` for appending
+
+        :Raise: IOError if the file can not be opened
+        '''
+
+        self.filehandle = open(os.path.expanduser(file_location), 'a', 1)
+
+    def write(self, name, value, kind):
+        '''Append a line for metric `name` of type `kind`'''
+
+        self.filehandle.write('{time:.6f} {name} {value}|{kind}\n'
+                              .format(time=time.time(), name=name,
+                                      value=value, kind=kind))
+
+    def count(self, name, value):
+        '''Write counter `name` increased by `value`'''
+
+        self.write(name, value, 'c')
+
+    def timing(self, name, ms):
+        '''Write a call of `ms` milliseconds of timer `name`'''
+
+        self.write(name, '{ms:.3f}'.format(ms=ms), 'ms')
+
+
+class StatsdSink:
+    '''Sink sending metrics in statsd format over UDP
+
+    >>> listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    >>> listener.bind(('127.0.0.1', 0))
+    >>> listener.settimeout(5)
+    >>> sink = StatsdSink('127.0.0.1', listener.getsockname()[1])
+    >>> sink.count('parse.calls', 2)
+    >>> listener.recv(512)
+    'dispass.parse.calls:2|c'
+    >>> sink.timing('parse', 1.5)
+    >>> listener.recv(512)
+    'dispass.parse:1.500|ms'
+    >>> listener.close()
+    '''
+
+    def __init__(self, host='localhost', port=8125, prefix='dispass'):
+        '''Create a UDP socket for sending metrics to `host`:`port`
+
+        :Raise: ValueError if `port` is not a number
+        '''
+
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind):
+        '''Send metric `name` of type `kind`, dropping it if the statsd
+        server can not be reached'''
+
+        try:
+            self.socket.sendto('{prefix}.{name}:{value}|{kind}'
+                               .format(prefix=self.prefix, name=name,
+                                       value=value, kind=kind),
+                               self.address)
+        except socket.error:
+            pass
+
+    def count(self, name, value):
+        '''Send counter `name` increased by `value`'''
+
+        self.send(name, value, 'c')
+
+    def timing(self, name, ms):
+        '''Send a call of `ms` milliseconds of timer `name`'''
+
+        self.send(name, '{ms:.3f}'.format(ms=ms), 'ms')
+
+
+def configure(spec):
+    '''Replace the active sinks by the sinks described in `spec`
+
+    :Parameters:
+        - `spec`: String. Comma separated list of ``registry``,
+          ``file:<path>`` and ``statsd[:<host>[:<port>]]``
+
+    :Return: List of the new sinks, empty if a sink can not be set up
+
+    An invalid `spec`, e.g. an unwritable file or a port that is not a
+    number, disables metrics with a warning instead of failing:
+
+    >>> configure('statsd:localhost:port')
+    []
+    '''
+
+    del sinks[:]
+    try:
+        for sink in spec.split(','):
+            options = sink.strip().split(':', 1)
+            if options[0] == 'registry':
+                sinks.append(Registry())
+            elif options[0] == 'file' and len(options) > 1:
+                sinks.append(FileSink(options[1]))
+            elif options[0] == 'statsd':
+                sinks.append(StatsdSink(*options[1].split(':'))
+                             if len(options) > 1 else StatsdSink())
+    except (EnvironmentError, ValueError, TypeError), err:
+        del sinks[:]
+        sys.stderr.write('warning: metrics disabled, invalid DISPASS_METRICS '
+                         '"{spec}": {err}\n'.format(spec=spec, err=err))
+    return sinks
+
+
+def count(name, value=1):
+    '''Increment counter `name` by `value` on all sinks'''
+
+    for sink in sinks:
+        sink.count(name, value)
+
+
+def timed(name):
+    '''Decorator timing every call of a function as `name`
+
+    Every call also increments counter `name` + '.calls'. When there are
+    no sinks the function is called directly.
+    '''
+
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if not sinks:
+                return func(*args, **kwargs)
+
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                ms = (time.time() - start) * 1000
+                for sink in sinks:
+                    sink.count(name + '.calls', 1)
+                    sink.timing(name, ms)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+configure(os.getenv('DISPASS_METRICS', ''))
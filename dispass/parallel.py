@@ -0,0 +1,439 @@
+'''Generating passphrases for many labels using a pool of processes'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+
+import algos
+from algos import digestLabel
+from filehandler import Filehandler, getFilehandler, isLabelLine
+from shardhandler import isSharded
+
+chunksize = 256
+'''Integer. Number of labels handed to a worker process at once'''
+
+min_parallel = 2048
+'''Integer. Below this number of labels no worker processes are started'''
+
+min_range = 1 << 20
+'''Integer. Smallest number of bytes of a labelfile parsed by a worker
+process at once'''
+
+part_timeout = 60
+'''Integer. Seconds `parseLabelfile()` waits for the labels of the next
+part of a labelfile. A worker process that dies, e.g. when it is killed,
+loses its part and it would wait for it forever otherwise'''
+
+_password = None
+'''Master password of a worker process, set by `_initWorker()`'''
+
+_passphrase = None
+'''Passphrase to find in a worker process, set by `_initWorker()`'''
+
+_settings = None
+'''Settings object of a worker process, set by `_initWorker()`'''
+
+_history = None
+'''Number of sequence numbers per label of a worker process, set by
+`_initWorker()`'''
+
+_stop = None
+'''multiprocessing.Event that is set when the tasks left of a worker
+process are no longer needed, set by `_initWorker()`'''
+
+
+def _initWorker(password, passphrase=None, settings=None, history=None,
+                stop=None):
+    global _password, _passphrase, _settings, _history, _stop
+    _password = password
+    _passphrase = passphrase
+    _settings = settings
+    _history = history
+    _stop = stop
+    if password is not None and multiprocessing.current_process().daemon:
+        # A pool worker has a copy of the password of its own
+        multiprocessing.util.Finalize(None, _wipeWorker, exitpriority=0)
+
+
+def _wipeWorker():
+    global _password
+    algos.wipe(_password)
+    _password = None
+
+
+def _parseLabelfile(args):
+    location, patterns, tags = args
+    start = time.time()
+    lf = getFilehandler(_settings, location)
+    if not lf.file_found:
+        return (location, None, time.time() - start)
+    if patterns or tags:
+        labels = lf.select(patterns=patterns, tags=tags)
+    else:
+        labels = lf.labelfile
+    return (location, labels, time.time() - start)
+
+
+def _digestChunk(args):
+    index, chunk = args
+    start = time.time()
+    passphrases = [(label[0], digestLabel(label, _password))
+                   for label in chunk]
+    return (index, passphrases, time.time() - start)
+
+
+def _historyChunk(chunk):
+    return [(label[0], algos.digestHistory(label[0], _password, label[1],
+                                           xrange(1, _history + 1)))
+            for label in chunk]
+
+
+def _parseRange(args):
+    location, start, end = args
+    filehandle = open(location, 'rb')
+    filehandle.seek(start)
+    data = filehandle.read(end - start)
+    filehandle.close()
+
+    parser = Filehandler(_settings, location, lazy=True)
+    return [parser.parseLine(line) for line in data.split('\n')
+            if isLabelLine(line)]
+
+
+def _findInChunk(chunk):
+    if _stop is not None and _stop.is_set():
+        return (0, None)
+    for label in chunk:
+        if digestLabel(label, _password) == _passphrase:
+            return (len(chunk), label)
+    return (len(chunk), None)
+
+
+def stopPool(pool, finished):
+    '''Stop the worker processes of `pool` and wait for them
+
+    :Parameters:
+        - `pool`: multiprocessing.Pool object
+        - `finished`: Boolean. True if all results that are needed were
+          received
+
+    The workers of a finished pool exit by themselves after their last
+    task, which wipes their copy of the password. Otherwise, e.g. on
+    KeyboardInterrupt, they are terminated.
+    '''
+
+    if finished:
+        pool.close()
+    else:
+        pool.terminate()
+    pool.join()
+
+
+def chunks(labels, size):
+    '''Yield lists of at most `size` items of `labels`'''
+
+    for i in xrange(0, len(labels), size):
+        yield labels[i:i + size]
+
+
+def getCandidates(labels, passphrase):
+    '''Return the labels that can possibly produce `passphrase`
+
+    A label can only produce `passphrase` if its length is the same and
+    its algorithm is known.
+    '''
+
+    return [label for label in labels
+            if label[1] == len(passphrase) and label[2] in algos.algorithms]
+
+
+def findProducer(labels, passphrase, password, processes=None):
+    '''Find the label that produces `passphrase` using `password`
+
+    :Parameters:
+        - `labels`: List of `(labelname, length, algorithm, seqno, tags)`
+        - `passphrase`: String. The passphrase to find the label of
+        - `password`: The password to use for hashing
+        - `processes`: Integer. Number of worker processes, defaults to
+          the number of cpus
+
+    :Return:
+        - Tuple of `(label, hashed, seconds)` where `label` is None if no
+          label produces `passphrase` and `hashed` is the number of labels
+          hashed before the search ended
+
+    Labels are hashed in chunks by a pool of worker processes. The
+    chunks left are skipped as soon as a label is found.
+    '''
+
+    start = time.time()
+    candidates = getCandidates(labels, passphrase)
+    hashed = 0
+    found = None
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if len(candidates) < min_parallel or processes == 1:
+        _initWorker(password, passphrase)
+        for chunk in chunks(candidates, chunksize):
+            count, found = _findInChunk(chunk)
+            hashed += count
+            if found:
+                break
+        _initWorker(None)
+        return (found, hashed, time.time() - start)
+
+    stop = multiprocessing.Event()
+    pool = multiprocessing.Pool(processes, _initWorker,
+                                (password, passphrase, None, None, stop))
+    finished = False
+    try:
+        for count, label in pool.imap_unordered(
+                _findInChunk, chunks(candidates, chunksize)):
+            hashed += count
+            if label:
+                found = label
+                break
+        stop.set()
+        finished = True
+    finally:
+        stopPool(pool, finished)
+
+    return (found, hashed, time.time() - start)
+
+
+def getLabelfiles(locations):
+    '''Expand directories in `locations` to the labelfiles in them
+
+    Sharded labelfile directories are kept as a single labelfile. Hidden
+    files and label indexes are skipped.
+    '''
+
+    labelfiles = []
+    for location in locations:
+        location = os.path.expanduser(location)
+        if os.path.isdir(location) and not isSharded(location):
+            labelfiles.extend(
+                os.path.join(location, name)
+                for name in sorted(os.listdir(location))
+                if not name.startswith('.') and not name.endswith('.idx'))
+        else:
+            labelfiles.append(location)
+    return labelfiles
+
+
+def digestLabelfiles(settings, locations, password, patterns=(), tags=(),
+                     processes=None):
+    '''Generate the passphrases of all labels in several labelfiles
+
+    :Parameters:
+        - `settings`: Settings object
+        - `locations`: List of labelfile locations
+        - `password`: The password to use for hashing
+        - `patterns`, `tags`: Only use labels selected by these, see
+          `Filehandler.select()`
+        - `processes`: Integer. Number of worker processes, defaults to
+          the number of cpus
+
+    :Return:
+        - Tuple of `(results, seconds)` where `seconds` is the wall time
+          and `results` is a list with a tuple of
+          `(location, passphrases, seconds)` per labelfile, in the order
+          of `locations`. `passphrases` is a list of
+          `(labelname, passphrase)` or None if the labelfile could not be
+          loaded and `seconds` is the time spent parsing and hashing it.
+
+    The labelfiles are parsed at the same time by a pool of worker
+    processes. Their labels are then hashed in chunks by the same pool,
+    keeping the order of the labels within every labelfile.
+    '''
+
+    start = time.time()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if processes == 1 or len(locations) < 2:
+        _initWorker(password, settings=settings)
+        pool = None
+        mapper = ordered = map
+    else:
+        pool = multiprocessing.Pool(processes, _initWorker,
+                                    (password, None, settings))
+        mapper = pool.imap_unordered
+        ordered = pool.imap
+
+    finished = False
+    try:
+        parsed = {}
+        for location, labels, seconds in mapper(
+                _parseLabelfile,
+                [(location, patterns, tags) for location in locations]):
+            parsed[location] = (labels, seconds)
+
+        jobs = []
+        for index, location in enumerate(locations):
+            labels = parsed[location][0] or []
+            for chunk in chunks(labels, chunksize):
+                jobs.append((index, chunk))
+
+        passphrases = {}
+        seconds = dict((location, parsed[location][1])
+                       for location in locations)
+        for index, chunk, chunk_seconds in ordered(_digestChunk, jobs):
+            passphrases.setdefault(index, []).extend(chunk)
+            seconds[locations[index]] += chunk_seconds
+        finished = True
+    finally:
+        if pool:
+            stopPool(pool, finished)
+        else:
+            _initWorker(None)
+
+    results = []
+    for index, location in enumerate(locations):
+        if parsed[location][0] is None:
+            results.append((location, None, seconds[location]))
+        else:
+            results.append((location, passphrases.get(index, []),
+                            seconds[location]))
+    return (results, time.time() - start)
+
+
+def digestHistories(labels, password, history, processes=None):
+    '''Generate the passphrases of sequence numbers 1 to `history` of
+    dispass2 labels
+
+    :Parameters:
+        - `labels`: List of `(labelname, length, algorithm, seqno, tags)`
+        - `password`: The password to use for hashing
+        - `history`: Integer. Highest sequence number to generate
+        - `processes`: Integer. Number of worker processes, defaults to
+          the number of cpus
+
+    :Return:
+        - Tuple of `(results, seconds)` where `results` is a list of
+          `(labelname, [(seqno, passphrase), ...])` in the order of
+          `labels`
+
+    Labels are hashed in chunks by a pool of worker processes when there
+    are at least `min_parallel` passphrases to generate.
+    '''
+
+    start = time.time()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    size = max(1, chunksize // history)
+
+    if len(labels) * history < min_parallel or processes == 1:
+        _initWorker(password, history=history)
+        results = _historyChunk(labels)
+        _initWorker(None)
+        return (results, time.time() - start)
+
+    results = []
+    pool = multiprocessing.Pool(processes, _initWorker,
+                                (password, None, None, history))
+    finished = False
+    try:
+        for chunk in pool.imap(_historyChunk, chunks(labels, size)):
+            results.extend(chunk)
+        finished = True
+    finally:
+        stopPool(pool, finished)
+
+    return (results, time.time() - start)
+
+
+def splitRanges(location, parts):
+    '''Split a labelfile into byte ranges that start at a line
+
+    :Parameters:
+        - `location`: String. Location of a plain text labelfile
+        - `parts`: Integer. Number of ranges to split the labelfile into
+
+    :Return:
+        - List of at most `parts` tuples of `(start, end)` byte offsets
+          that cover the whole labelfile
+    '''
+
+    size = os.path.getsize(location)
+    starts = [0]
+    filehandle = open(location, 'rb')
+    for i in xrange(1, parts):
+        # Seek to the byte before the split, so a split that is at the
+        # start of a line already stays there
+        filehandle.seek(max(size * i // parts - 1, starts[-1]))
+        filehandle.readline()
+        start = filehandle.tell()
+        if starts[-1] < start < size:
+            starts.append(start)
+    filehandle.close()
+    return zip(starts, starts[1:] + [size])
+
+
+def parseLabelfile(settings, location, processes=None):
+    '''Parse a plain text labelfile using a pool of processes
+
+    :Parameters:
+        - `settings`: Settings object
+        - `location`: String. Location of the labelfile
+        - `processes`: Integer. Number of worker processes, defaults to
+          the number of cpus
+
+    :Return:
+        - List of `(labelname, length, algorithm, seqno, tags)` of all
+          lines, in the order of the labelfile
+    :Raise: IOError if the labelfile can not be read,
+            multiprocessing.TimeoutError if a part was not parsed within
+            `part_timeout` seconds and any exception of a worker process
+
+    The labelfile is split into byte ranges of at least `min_range` bytes
+    that start at a line. Every range is parsed by a worker process and
+    the labels of all ranges are joined in order, so the result is the
+    same as that of `Filehandler.parse()`, including which of several
+    labels with the same name is used. Worker processes of a pool parse
+    in-process, as they can not start processes of their own.
+    '''
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    parts = min(processes * 4, os.path.getsize(location) // min_range)
+    jobs = [(location, start, end)
+            for start, end in splitRanges(location, max(parts, 1))]
+
+    if (processes == 1 or len(jobs) < 2 or
+            multiprocessing.current_process().daemon):
+        _initWorker(None, settings=settings)
+        try:
+            return [label for job in jobs for label in _parseRange(job)]
+        finally:
+            _initWorker(None)
+
+    labels = []
+    pool = multiprocessing.Pool(processes, _initWorker,
+                                (None, None, settings))
+    finished = False
+    try:
+        parts = pool.imap(_parseRange, jobs)
+        for job in jobs:
+            labels.extend(parts.next(part_timeout))
+        finished = True
+    finally:
+        stopPool(pool, finished)
+    return labels
@@ -0,0 +1,276 @@
+'''Profiling of dispass commands'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import cProfile
+import os
+import pstats
+import resource
+import sys
+
+import metrics
+
+try:
+    import tracemalloc
+    hasTracemalloc = True
+except ImportError:
+    hasTracemalloc = False
+
+phases = (
+    ('parse', ('parse', 'scan', 'lookup')),
+    ('digest', ('digest', 'digestPasswordDict', 'digestHistory',
+                'digestHistories', 'digestLabelfiles', 'findProducer')),
+    ('render', ('render', )),
+    ('save', ('save', )),
+)
+'''Tuple of `(phase, function names)` shown in the summary. Functions
+that hash labels on a pool of worker processes count as digest, as the
+profile of the worker processes themselves is not recorded'''
+
+memory_phases = {
+    'filehandler.parse': 'parse',
+    'filehandler.parse_tail': 'parse',
+    'filehandler.search': 'parse',
+    'httphandler.fetch': 'parse',
+    'shardhandler.parse': 'parse',
+    'sqlitehandler.parse': 'parse',
+    'dispass1.digestPasswordDict': 'digest',
+    'dispass2.digestPasswordDict': 'digest',
+    'filehandler.save': 'save',
+    'shardhandler.save': 'save',
+    'sqlitehandler.save': 'save',
+}
+'''Dictionary of {metric: phase} of the timers of `metrics` used to
+measure the growth of peak memory per phase'''
+
+
+class Profiler:
+    '''Run a function under cProfile and write the stats
+
+    Memory is measured as the growth of the peak resident set size per
+    phase: the profiler is a sink of `metrics` while it runs, and growth
+    is attributed to the phase of the timer that finishes next. Where
+    tracemalloc is available (Python 3.4 and later) its allocation sites
+    are written as well.
+
+    Only function names, call counts, timings, memory sizes and
+    allocation sites are recorded, never the arguments or return values
+    of functions. Master passwords and passphrases never end up in the
+    stats files.
+    '''
+
+    def __init__(self, file_location):
+        '''Set location of the stats file
+
+        :Parameters:
+            - `file_location`: String. cProfile stats are written to this
+              location, memory statistics to `file_location` + '.mem'
+        '''
+
+        self.file_location = os.path.expanduser(file_location)
+        self.profile = cProfile.Profile()
+        self.memory = {}
+        '''Dictionary of {phase: growth of peak memory in KiB}'''
+        self.rss = 0
+        self.workers = None
+
+    def count(self, name, value):
+        '''Ignore counters of `metrics`'''
+
+    def timing(self, name, ms):
+        '''Attribute the growth of peak memory since the last timer of
+        `metrics` to the phase of timer `name`'''
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        phase = memory_phases.get(name, 'other')
+        self.memory[phase] = self.memory.get(phase, 0) + rss - self.rss
+        self.rss = rss
+
+    def run(self, func, *args):
+        '''Call `func` with `args`, write stats and print a summary
+
+        :Return: The return value of `func`
+        '''
+
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        metrics.sinks.append(self)
+        if hasTracemalloc:
+            tracemalloc.start()
+        try:
+            return self.profile.runcall(func, *args)
+        finally:
+            metrics.sinks.remove(self)
+            self.timing(None, 0)
+            if hasTracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+            else:
+                snapshot = None
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.workers = (round(usage.ru_utime + usage.ru_stime -
+                                  children.ru_utime - children.ru_stime, 6),
+                            usage.ru_maxrss)
+            self.writeStats(snapshot)
+            self.printSummary()
+
+    def writeStats(self, snapshot=None):
+        '''Write cProfile stats, the growth of peak memory per phase and
+        tracemalloc statistics of `snapshot`'''
+
+        try:
+            self.profile.dump_stats(self.file_location)
+            filehandle = open(self.file_location + '.mem', 'w')
+            filehandle.write('# Growth of peak memory per phase\n')
+            for phase in [name for name, names in phases] + ['other']:
+                if phase in self.memory:
+                    filehandle.write('{phase:8} {kib:9} KiB\n'.format(
+                        phase=phase, kib=self.memory[phase]))
+            filehandle.write('{phase:8} {kib:9} KiB peak\n'.format(
+                phase='total', kib=self.rss))
+            if self.workers and self.workers[0]:
+                filehandle.write('{phase:8} {kib:9} KiB peak of the largest '
+                                 'worker process\n'.format(
+                                     phase='workers', kib=self.workers[1]))
+            if snapshot:
+                filehandle.write('\n# Allocation sites\n')
+                for stat in snapshot.statistics('lineno')[:50]:
+                    filehandle.write('{stat}\n'.format(stat=stat))
+            filehandle.close()
+        except IOError:
+            sys.stderr.write('error: could not write profile to "{loc}"\n'
+                             .format(loc=self.file_location))
+
+    def getPhases(self):
+        '''Return a list of `(phase, seconds)` of the time spent per phase
+
+        Calls of a phase function made from another function of the same
+        phase are not counted twice.
+        '''
+
+        stats = pstats.Stats(self.profile).stats
+        result = []
+
+        for phase, names in phases:
+            seconds = 0.0
+            for func, (cc, nc, tt, ct, callers) in stats.iteritems():
+                if func[2] not in names or 'dispass' not in func[0]:
+                    continue
+                nested = [caller for caller in callers
+                          if caller[2] in names and 'dispass' in caller[0]]
+                if callers and len(nested) == len(callers):
+                    continue
+                seconds += ct
+            result.append((phase, seconds))
+
+        return result
+
+    def printSummary(self):
+        '''Print the time spent per phase and the location of the stats'''
+
+        total = pstats.Stats(self.profile).total_tt
+        sys.stderr.write('\nProfile summary:\n')
+        for phase, seconds in self.getPhases():
+            sys.stderr.write('  {phase:8} {secs:9.4f} s\n'
+                             .format(phase=phase, secs=seconds))
+        sys.stderr.write('  {phase:8} {secs:9.4f} s\n'
+                         .format(phase='total', secs=total))
+        if self.workers and self.workers[0]:
+            sys.stderr.write('  {phase:8} {secs:9.4f} s cpu of worker '
+                             'processes\n'
+                             .format(phase='workers', secs=self.workers[0]))
+        sys.stderr.write('Stats written to {loc}\n'
+                         'Memory statistics written to {loc}.mem\n'
+                         .format(loc=self.file_location))
+
+
+def takesValue(arg, shortopts, longopts):
+    '''Return True if option `arg` is followed by a separate value
+
+    :Parameters:
+        - `arg`: String. Option from the command line
+        - `shortopts`, `longopts`: Options in the format of getopt
+    '''
+
+    if arg.startswith('--'):
+        if '=' in arg:
+            return False
+        name = arg[2:]
+        if name + '=' in longopts or name in longopts:
+            return name + '=' in longopts
+        matches = [opt for opt in longopts if opt.startswith(name)]
+        return len(matches) == 1 and matches[0].endswith('=')
+
+    for i, char in enumerate(arg[1:], 1):
+        pos = shortopts.find(char)
+        if pos >= 0 and shortopts[pos + 1:pos + 2] == ':':
+            return i == len(arg) - 1
+    return False
+
+
+def stripProfileOption(argv, shortopts='', longopts=()):
+    '''Remove the ``--profile[=path]`` option from `argv`
+
+    Only options are looked at, the way getopt does: values of options
+    and all arguments from the first argument that is not an option on
+    are kept, e.g. in ``dispass -s --profile``.
+
+    :Return: Tuple of `(path, argv)`, path is None without the option
+    '''
+
+    file_location = None
+    args = argv[:1]
+    i = 1
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--' or arg == '-' or not arg.startswith('-'):
+            break
+        if arg == '--profile':
+            file_location = argv[0].split('/').pop() + '.prof'
+        elif arg.startswith('--profile='):
+            file_location = arg[len('--profile='):]
+        else:
+            args.append(arg)
+            if takesValue(arg, shortopts, longopts):
+                i += 1
+                args.extend(argv[i:i + 1])
+        i += 1
+    return (file_location, args + argv[i:])
+
+
+def profiled(main):
+    '''Decorator adding the ``--profile[=path]`` option to a main method
+
+    Profiling is enabled by the option or by setting the environment var
+    DISPASS_PROFILE to the location of the stats file. The option is
+    removed from `argv` before it is passed to `main`, using the
+    `shortopts` and `longopts` of the object to tell options from their
+    values. Without a path the stats are written to ``<command>.prof`` in
+    the current directory.
+    '''
+
+    def wrapper(self, argv):
+        file_location, args = stripProfileOption(
+            argv, getattr(self, 'shortopts', ''),
+            getattr(self, 'longopts', ()))
+        file_location = file_location or os.getenv('DISPASS_PROFILE')
+
+        if not file_location:
+            return main(self, args)
+        return Profiler(file_location).run(main, self, args)
+
+    wrapper.__name__ = main.__name__
+    wrapper.__doc__ = main.__doc__
+    return wrapper
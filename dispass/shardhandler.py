@@ -0,0 +1,282 @@
+'''Dispass labelfile handler for sharded labelfile directories'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import hashlib
+import os
+import re
+import threading
+
+import metrics
+from filehandler import Filehandler, locked
+
+marker = '.shards'
+'''Name of the file that marks a directory as a sharded labelfile. It
+contains the sharding scheme and key width, e.g. ``hash 2``'''
+
+schemes = ('hash', 'prefix')
+'''Supported sharding schemes'''
+
+
+def isSharded(file_location):
+    '''Return True if `file_location` is a sharded labelfile directory'''
+
+    return os.path.isfile(os.path.join(file_location, marker))
+
+
+class ShardedFilehandler(Filehandler):
+    '''Labelfile stored as a directory of smaller labelfiles (shards)
+
+    Every label is stored in the shard named after a key derived from its
+    labelname, either the first characters of the hex sha1 of the name
+    (``hash``) or the first characters of the name itself (``prefix``).
+
+    Offers the same interface as `Filehandler`. `lookup()` and `add()` only
+    open the shard the label belongs to and `save()` only rewrites shards
+    that were changed. `search()` scans all shards with `Filehandler.scan()`
+    without parsing them. Everything else loads all shards.
+    '''
+
+    dirty = None
+    '''Set of keys of shards that have unsaved changes'''
+
+    scheme = 'hash'
+    '''String. Sharding scheme, one of `schemes`'''
+
+    width = 2
+    '''Integer. Number of characters of the shard key'''
+
+    def __init__(self, settings, file_location=None, lazy=False):
+        '''Read the sharding scheme; parse() all shards unless `lazy`'''
+
+        self.settings = settings
+        self.lock = threading.RLock()
+        self.shards = {}
+        self.dirty = set()
+        self.publish([])
+        self.lazy = True
+
+        if file_location:
+            self.file_location = os.path.expanduser(file_location)
+        else:
+            self.file_location = os.path.expanduser(
+                self.getDefaultFileLocation())
+
+        try:
+            options = open(os.path.join(self.file_location, marker)).read()
+            self.file_found = True
+        except IOError:
+            options = ''
+            self.file_found = False
+
+        options = options.split()
+        if options and options[0] in schemes:
+            self.scheme = options[0]
+        if len(options) > 1 and options[1].isdigit() and int(options[1]):
+            self.width = int(options[1])
+
+        if not lazy:
+            self.parse()
+
+    def shardKey(self, labelname):
+        '''Return the key of the shard that holds `labelname`'''
+
+        if self.scheme == 'prefix':
+            return re.sub(r'[^A-Za-z0-9_-]', '_', labelname[:self.width])
+        return hashlib.sha1(labelname).hexdigest()[:self.width]
+
+    def shardFor(self, labelname):
+        '''Return the Filehandler of the shard that holds `labelname`'''
+
+        key = self.shardKey(labelname)
+        if key not in self.shards:
+            self.shards[key] = Filehandler(
+                self.settings, os.path.join(self.file_location, key))
+        return self.shards[key]
+
+    def shardLocations(self):
+        '''Return a list of the locations of all existing shards, skipping
+        the label indexes written next to them'''
+
+        if not self.file_found:
+            return []
+        return [os.path.join(self.file_location, name)
+                for name in sorted(os.listdir(self.file_location))
+                if not name.startswith('.') and not name.endswith('.idx')]
+
+    @metrics.timed('shardhandler.parse')
+    @locked
+    def parse(self):
+        '''Load all shards and combine them into a single labelfile'''
+
+        for location in self.shardLocations():
+            key = os.path.basename(location)
+            if key not in self.shards:
+                self.shards[key] = Filehandler(self.settings, location)
+
+        # Shards created by add() or update() may not be saved yet
+        labels = []
+        for shard in self.shards.itervalues():
+            labels.extend(shard.labelfile)
+
+        labels.sort()
+        self.publish(labels, is_sorted=True)
+        self.lazy = False
+        return self
+
+    def scan(self, needle):
+        '''Scan all shards for labelnames that contain `needle`'''
+
+        labels = []
+        for location in self.shardLocations():
+            labels.extend(Filehandler(self.settings, location,
+                                      lazy=True).scan(needle))
+        return labels
+
+    def lookup(self, labelname):
+        '''Find a single label by its exact name, opening only its shard'''
+
+        if not self.lazy:
+            return self.labelindex.get(labelname)
+        return self.shardFor(labelname).lookup(labelname)
+
+    @locked
+    def addMany(self, labels):
+        '''Add labels to the shards they belong to, skipping existing
+        labels
+
+        :Return: Integer. Number of labels that were added
+        '''
+
+        groups = {}
+        for label in labels:
+            groups.setdefault(self.shardKey(label[0]), []).append(label)
+
+        added = []
+        for key, group in groups.iteritems():
+            shard = self.shardFor(group[0][0])
+            labelnames = set(label[0] for label in group
+                             if label[0] not in shard.labelindex)
+            if shard.addMany(group):
+                self.dirty.add(key)
+                added.extend(shard.labelindex[labelname]
+                             for labelname in labelnames)
+
+        if not self.lazy:
+            self.insertMany(added)
+        return len(added)
+
+    @locked
+    def update(self, labels):
+        '''Add labels or replace the labels with the same name in the
+        shards they belong to
+
+        :Return: Tuple of `(added, changed)` numbers of labels
+        '''
+
+        groups = {}
+        for label in labels:
+            groups.setdefault(self.shardKey(label[0]), []).append(label)
+
+        added = changed = 0
+        for key, group in groups.iteritems():
+            shard_added, shard_changed = self.shardFor(group[0][0]).update(
+                group)
+            if shard_added or shard_changed:
+                self.dirty.add(key)
+            added += shard_added
+            changed += shard_changed
+
+        if not self.lazy and (added or changed):
+            self.parse()
+        return (added, changed)
+
+    @locked
+    def remove(self, labelnames):
+        '''Remove labels by name from the shards they belong to
+
+        :Return: Integer. Number of labels removed
+        '''
+
+        groups = {}
+        for labelname in labelnames:
+            groups.setdefault(self.shardKey(labelname), []).append(labelname)
+
+        removed = 0
+        for key, group in groups.iteritems():
+            shard_removed = self.shardFor(group[0]).remove(group)
+            if shard_removed:
+                self.dirty.add(key)
+            removed += shard_removed
+
+        if not self.lazy and removed:
+            self.parse()
+        return removed
+
+    @locked
+    def applyReload(self, current, added, removed, changed):
+        '''Apply the differences with the labelfile as it was read again
+        to the shards in memory
+
+        Shards without unsaved changes are replaced by those of
+        `current`. The differences of shards with unsaved changes are
+        applied to them in memory, so they are saved with the rest of
+        their changes. See `Filehandler.applyReload()`.
+        '''
+
+        for key in set(self.shards) | set(current.shards):
+            if key in self.dirty:
+                continue
+            if key in current.shards:
+                self.shards[key] = current.shards[key]
+            else:
+                del self.shards[key]
+
+        for label in added + changed:
+            key = self.shardKey(label[0])
+            if key in self.dirty:
+                self.shards[key].update([label])
+        for label in removed:
+            key = self.shardKey(label[0])
+            if key in self.dirty:
+                self.shards[key].remove([label[0]])
+        self.parse()
+
+    @metrics.timed('shardhandler.save')
+    @locked
+    def save(self, sort=True):
+        '''Save the shards that were changed, creating the directory
+
+        :Return: Boolean. True if all changed shards were saved
+        '''
+
+        if not self.file_found:
+            try:
+                if not os.path.isdir(self.file_location):
+                    os.makedirs(self.file_location)
+                filehandle = open(os.path.join(self.file_location, marker),
+                                  'w')
+                filehandle.write('{scheme} {width}\n'
+                                 .format(scheme=self.scheme, width=self.width))
+                filehandle.close()
+            except (IOError, OSError):
+                return False
+            self.file_found = True
+
+        for key in list(self.dirty):
+            if not self.shards[key].save(sort):
+                return False
+            self.dirty.discard(key)
+        return True
@@ -0,0 +1,423 @@
+'''Dispass labelfile handler for SQLite databases'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import os
+import threading
+
+import metrics
+from filehandler import Filehandler, locked
+
+try:
+    import sqlite3
+    hasSQLite = True
+except ImportError:
+    hasSQLite = False
+
+schema = (
+    'CREATE TABLE IF NOT EXISTS labels (name TEXT PRIMARY KEY, '
+    'length INTEGER, algo TEXT, seqno, tags TEXT)',
+    'CREATE INDEX IF NOT EXISTS labels_algo ON labels (algo)',
+)
+'''Statements for creating the labels table and its indexes. The primary
+key on name doubles as the index on labelname. Tags are stored as a comma
+separated string.'''
+
+columns = 'name, length, algo, seqno, tags'
+'''Columns of the labels table, in the order of a label tuple'''
+
+
+def migrate(connection):
+    '''Add the columns that databases of older versions lack
+
+    Databases created before tags were supported have no tags column.
+    The schema is looked up with ``PRAGMA table_info``, so the labels
+    table is only altered once.
+    '''
+
+    existing = [column[1] for column in connection.execute(
+        'PRAGMA table_info(labels)')]
+    if 'tags' not in existing:
+        connection.execute('ALTER TABLE labels ADD COLUMN tags TEXT')
+
+
+def toSeqno(seqno):
+    '''Return `seqno` as an integer if it is a number
+
+    Labels parsed from a text labelfile have their seqno as a string and
+    the seqno column has no type, so without this the same seqno could be
+    stored as text and as integer and never compare equal.
+    '''
+
+    try:
+        return int(seqno)
+    except (TypeError, ValueError):
+        return seqno
+
+
+def toLabel(row):
+    '''Convert a row of the labels table to a label tuple'''
+
+    return (row[:3] + (toSeqno(row[3]), ) +
+            (tuple(row[4].split(',')) if row[4] else (), ))
+
+
+def toRow(label):
+    '''Convert a label tuple to a row of the labels table'''
+
+    return tuple(label[:3]) + (toSeqno(label[3]), ','.join(label[4]))
+
+
+class SQLiteFilehandler(Filehandler):
+    '''Storage of labels in an SQLite database
+
+    Offers the same interface as `Filehandler`. The database is not read
+    in full on init; `search()` and `lookup()` query it directly. The full
+    set of labels is only loaded when `labelfile` or `algodict` are needed.
+
+    Changes made by `add()` are kept in a transaction until `save()`
+    commits them. If a query fails, for example because another process
+    keeps the database locked for longer than `timeout`, the transaction
+    is rolled back and the error is kept in `read_error`; `save()` does
+    not commit anything after that.
+
+    The connection is shared by all threads that use the handler, so
+    every query holds `lock` until its rows are fetched.
+    '''
+
+    connection = None
+    '''sqlite3.Connection object, set on init if database is found'''
+
+    timeout = 10
+    '''Integer. Seconds to wait for a lock on the database held by
+    another connection before a query fails'''
+
+    def __init__(self, settings, file_location=None, lazy=False):
+        '''Connect to database if it is found; parse() unless `lazy`'''
+
+        self.settings = settings
+        self.lock = threading.RLock()
+        self.publish([])
+        self.lazy = True
+
+        if file_location:
+            self.file_location = os.path.expanduser(file_location)
+        else:
+            self.file_location = os.path.expanduser(
+                self.getDefaultFileLocation())
+
+        self.file_found = (os.path.isfile(self.file_location) and
+                           self.connect())
+
+        if not lazy:
+            self.parse()
+
+    @locked
+    def connect(self):
+        '''Connect to the database and create the schema if needed
+
+        :Return: Boolean. True if the database could be opened, the error
+                 is kept in `read_error` if not
+        '''
+
+        if self.connection:
+            return True
+
+        if not hasSQLite:
+            print('error: the sqlite3 module is needed for using '
+                  '"{loc}"'.format(loc=self.file_location))
+            return False
+
+        try:
+            self.connection = sqlite3.connect(self.file_location,
+                                              timeout=self.timeout,
+                                              check_same_thread=False)
+            self.connection.text_factory = str
+            for statement in schema:
+                self.connection.execute(statement)
+            migrate(self.connection)
+            self.connection.commit()
+        except sqlite3.Error, err:
+            self.read_error = str(err)
+            self.connection = None
+            return False
+
+        return True
+
+    @metrics.timed('sqlitehandler.parse')
+    @locked
+    def parse(self):
+        '''Load all labels from the database, ordered by labelname'''
+
+        if not self.file_found:
+            self.publish([])
+            self.lazy = False
+            return
+
+        try:
+            labels = [toLabel(row) for row in self.connection.execute(
+                'SELECT {columns} FROM labels ORDER BY name'
+                .format(columns=columns))]
+        except sqlite3.Error, err:
+            self.fail(err)
+            self.file_found = False
+            labels = []
+        self.publish(labels, is_sorted=True)
+        self.lazy = False
+        return self
+
+    @locked
+    def scan(self, needle):
+        '''Query the database for labelnames that contain `needle`
+
+        :Parameters:
+            - `needle`: String to find in labelnames
+
+        :Return:
+            - List of `(labelname, length, algorithm, seqno, tags)`
+        '''
+
+        if not self.file_found:
+            return []
+
+        try:
+            return [toLabel(row) for row in self.connection.execute(
+                'SELECT {columns} FROM labels WHERE instr(name, ?) > 0'
+                .format(columns=columns), (needle, ))]
+        except sqlite3.Error, err:
+            self.fail(err)
+            return []
+
+    @locked
+    def lookup(self, labelname):
+        '''Find a single label by its exact name
+
+        :Parameters:
+            - `labelname`: String. Name of the label
+
+        :Return:
+            - Tuple of `(labelname, length, algorithm, seqno, tags)` or None
+        '''
+
+        if not self.file_found:
+            return None
+
+        try:
+            row = self.connection.execute(
+                'SELECT {columns} FROM labels WHERE name = ?'
+                .format(columns=columns), (labelname, )).fetchone()
+        except sqlite3.Error, err:
+            self.fail(err)
+            return None
+        return toLabel(row) if row else None
+
+    def add(self, labelname, length=None, algo=None, seqno=None, tags=()):
+        '''Add label to the database, the change is saved by save()'''
+
+        return self.addMany([(labelname, length, algo, seqno, tags)]) == 1
+
+    @locked
+    def addMany(self, labels):
+        '''Add labels in a single transaction, skipping existing labels
+
+        :Parameters:
+            - `labels`: Iterable of
+              `(labelname, length, algorithm, seqno, tags)`, where length,
+              algorithm and seqno may be None for defaults
+
+        :Return: Integer. Number of labels that were added, 0 if the
+                 database could not be changed
+        '''
+
+        if not self.connect():
+            return 0
+
+        added = []
+        try:
+            for labelname, length, algo, seqno, tags in labels:
+                label = (labelname,
+                         length if length else self.settings.passphrase_length,
+                         algo if algo else self.settings.algorithm,
+                         seqno if seqno else self.settings.sequence_number,
+                         tuple(tags))
+                cursor = self.connection.execute(
+                    'INSERT OR IGNORE INTO labels ({columns}) '
+                    'VALUES (?, ?, ?, ?, ?)'.format(columns=columns),
+                    toRow(label))
+                if cursor.rowcount == 1:
+                    added.append(label)
+        except sqlite3.Error, err:
+            self.fail(err)
+            return 0
+
+        if not self.lazy:
+            self.insertMany(added)
+        return len(added)
+
+    @locked
+    def update(self, labels):
+        '''Add labels or replace the labels with the same name, the
+        changes are saved by save()
+
+        :Return: Tuple of `(added, changed)` numbers of labels, `(0, 0)`
+                 if the database could not be changed
+        '''
+
+        if not self.connect():
+            return (0, 0)
+
+        added = changed = 0
+        try:
+            for label in labels:
+                label = toLabel(toRow(label))
+                row = self.connection.execute(
+                    'SELECT {columns} FROM labels WHERE name = ?'
+                    .format(columns=columns), (label[0], )).fetchone()
+                if row is None:
+                    added += 1
+                elif toLabel(row) != label:
+                    changed += 1
+                else:
+                    continue
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO labels ({columns}) '
+                    'VALUES (?, ?, ?, ?, ?)'.format(columns=columns),
+                    toRow(label))
+        except sqlite3.Error, err:
+            self.fail(err)
+            return (0, 0)
+        self.file_found = True
+
+        if not self.lazy and (added or changed):
+            self.parse()
+        return (added, changed)
+
+    @locked
+    def remove(self, labelnames):
+        '''Remove labels by name, the change is saved by save()
+
+        :Return: Integer. Number of labels removed, 0 if the database could
+                 not be changed
+        '''
+
+        if not self.file_found:
+            return 0
+
+        removed = 0
+        try:
+            for labelname in labelnames:
+                removed += self.connection.execute(
+                    'DELETE FROM labels WHERE name = ?',
+                    (labelname, )).rowcount
+        except sqlite3.Error, err:
+            self.fail(err)
+            return 0
+
+        if not self.lazy and removed:
+            self.parse()
+        return removed
+
+    @metrics.timed('sqlitehandler.save')
+    @locked
+    def save(self, sort=True):
+        '''Commit pending changes, creating the database if needed
+
+        Nothing is committed if a query failed before, see `read_error`.
+        '''
+
+        if self.read_error or not self.connect():
+            return False
+
+        try:
+            self.connection.commit()
+            labelnames = [row[0] for row in self.connection.execute(
+                'SELECT name FROM labels ORDER BY name')]
+        except sqlite3.Error, err:
+            self.fail(err)
+            return False
+
+        self.file_found = True
+        self.writeIndex(labelnames)
+        return True
+
+    def fail(self, err):
+        '''Roll back the pending changes after query error `err` and keep
+        it in `read_error`'''
+
+        self.read_error = str(err)
+        try:
+            self.connection.rollback()
+        except sqlite3.Error:
+            pass
+
+    def importLabelfile(self, file_location):
+        '''Import all labels from a plain text labelfile
+
+        :Parameters:
+            - `file_location`: String. Location of the labelfile
+
+        :Return: Integer. Number of labels imported, or False if the
+                 labelfile could not be loaded or the database could not
+                 be changed
+
+        Labels that exist in the database already are replaced. The import
+        is done in a single transaction.
+        '''
+
+        lf = Filehandler(self.settings, file_location=file_location)
+        if not lf.file_found or not self.connect():
+            return False
+
+        with self.lock:
+            try:
+                with self.connection:
+                    self.connection.executemany(
+                        'INSERT OR REPLACE INTO labels ({columns}) '
+                        'VALUES (?, ?, ?, ?, ?)'.format(columns=columns),
+                        (toRow(label) for label in lf.labelfile))
+            except sqlite3.Error, err:
+                self.fail(err)
+                return False
+            self.file_found = True
+
+            if not self.lazy:
+                self.parse()
+        return len(lf.labelindex)
+
+    @locked
+    def exportLabelfile(self, file_location):
+        '''Write all labels to a plain text labelfile
+
+        :Parameters:
+            - `file_location`: String. Location of the labelfile
+
+        :Return: Boolean. True if the labelfile was written
+        '''
+
+        if not self.file_found:
+            return False
+
+        try:
+            divlen = self.connection.execute(
+                'SELECT max(length(name)) FROM labels').fetchone()[0]
+            return self.writeLabelfile(
+                os.path.expanduser(file_location),
+                (toLabel(row) for row in self.connection.execute(
+                    'SELECT {columns} FROM labels ORDER BY name'
+                    .format(columns=columns))),
+                divlen or 0)
+        except sqlite3.Error, err:
+            self.fail(err)
+            return False
@@ -0,0 +1,245 @@
+'''Reloading of labelfiles that are changed by other programs'''
+
+# Copyright (c) 2011-2012 Benjamin Althues <benjamin@babab.nl>
+#
+# Permission to use, copy, modify, and distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+import os
+import select
+import sys
+import threading
+
+import metrics
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    libc.inotify_init
+    libc.inotify_add_watch
+    hasInotify = True
+except (ImportError, OSError, AttributeError):
+    hasInotify = False
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+        IN_CREATE | IN_DELETE)
+'''Inotify events that may mean the labelfile was changed'''
+
+
+class LabelfileWatcher(threading.Thread):
+    '''Keep a Filehandler up to date with its labelfile
+
+    Changes are detected by comparing the inode, size and modification
+    time of the labelfile (or of the shards of a sharded labelfile). On
+    Linux the directory of the labelfile is watched with inotify, so the
+    labelfile is only checked after something in that directory changed.
+    Elsewhere it is checked every `interval` seconds.
+
+    When the labelfile changed, it is read again into a second
+    Filehandler and compared with the labels of the Filehandler. Only
+    added, removed and changed labels are applied to the labels in memory
+    with `Filehandler.applyReload()`, which never writes to the labelfile,
+    while holding `lock`, the lock of the Filehandler. The differences
+    are computed while holding it as well, so changes made on other
+    threads in the meantime are never undone. A second Filehandler of a
+    plain text labelfile is kept, so when lines were only appended to the
+    labelfile just those are parsed. Other labelfiles, e.g. SQLite
+    databases or sharded labelfiles, are read by a new one every time.
+
+    Errors while reloading on the background thread are written to
+    stderr and the watcher keeps watching.
+
+    The watcher can run on a background thread with `start()`, or
+    `check()` can be called periodically from an event loop, e.g. the
+    Tkinter loop of gdispass.
+    '''
+
+    interval = 1.0
+    '''Float. Seconds between checks when polling, and the longest time
+    `stop()` has to wait for the thread to finish'''
+
+    def __init__(self, filehandler, callback=None, interval=None):
+        '''Watch the labelfile of `filehandler`
+
+        :Parameters:
+            - `filehandler`: Filehandler object to keep up to date
+            - `callback`: Function called with lists of the added,
+              removed and changed labels after a change was applied. It is
+              called on the thread of the watcher
+            - `interval`: Float. Override `interval`
+        '''
+
+        threading.Thread.__init__(self, name='LabelfileWatcher')
+        self.daemon = True
+        self.filehandler = filehandler
+        self.callback = callback
+        if interval is not None:
+            self.interval = interval
+
+        self.lock = filehandler.lock
+        '''Lock of the Filehandler, held while changes are computed and
+        applied'''
+
+        self.stopped = threading.Event()
+        self.current = None
+        self.fd = None
+        self.stamp = self.getStamp()
+        if hasInotify:
+            self.addWatch()
+
+    def addWatch(self):
+        '''Start watching the directory of the labelfile with inotify'''
+
+        location = self.filehandler.file_location
+        if not os.path.isdir(location):
+            location = os.path.dirname(location) or '.'
+
+        fd = libc.inotify_init()
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd, location, mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def getStamp(self):
+        '''Return the inode, size and modification time of the labelfile,
+        or of all shards when it is a directory'''
+
+        location = self.filehandler.file_location
+        try:
+            if os.path.isdir(location):
+                return tuple(self.statStamp(os.path.join(location, name))
+                             for name in sorted(os.listdir(location)))
+            return self.statStamp(location)
+        except OSError:
+            return None
+
+    def statStamp(self, location):
+        stat = os.stat(location)
+        return (location, stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def wait(self, timeout):
+        '''Wait until the labelfile may have changed or `timeout` seconds
+        have passed
+
+        :Return: Boolean. True if the labelfile should be checked
+        '''
+
+        if self.fd is None:
+            return not self.stopped.wait(timeout)
+
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except select.error:
+            return False
+        if not readable:
+            return False
+
+        # Drain all queued events, the labelfile is checked only once
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 4096)
+        return True
+
+    def check(self):
+        '''Apply changes of the labelfile since the last check
+
+        :Return: Boolean. True if changes were applied
+        '''
+
+        if self.fd is not None and not self.wait(0):
+            return False
+
+        stamp = self.getStamp()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return self.reload()
+
+    @metrics.timed('watcher.reload')
+    def reload(self):
+        '''Read the labelfile and apply the differences to the Filehandler
+
+        :Return: Boolean. True if any label was added, removed or changed
+        '''
+
+        fh = self.filehandler
+        if self.current is None or self.current.checkpoint is None:
+            # Without a checkpoint nothing can be parsed incrementally
+            self.current = fh.__class__(fh.settings, fh.file_location)
+        else:
+            self.current.parse()
+        current = self.current
+        if not current.file_found:
+            return False
+
+        with self.lock:
+            if fh.lazy:
+                fh.parse()
+
+            added = []
+            changed = []
+            for labelname, label in current.labelindex.iteritems():
+                old = fh.labelindex.get(labelname)
+                if old is None:
+                    added.append(label)
+                elif old != label:
+                    changed.append(label)
+            removed = [label for labelname, label in
+                       fh.labelindex.iteritems()
+                       if labelname not in current.labelindex]
+
+            if added or removed or changed:
+                fh.applyReload(current, added, removed, changed)
+
+        if not (added or removed or changed):
+            return False
+
+        metrics.count('watcher.labels', len(added + removed + changed))
+        if self.callback:
+            self.callback(added, removed, changed)
+        return True
+
+    def run(self):
+        '''Check the labelfile until `stop()` is called'''
+
+        while not self.stopped.is_set():
+            if self.wait(self.interval):
+                stamp = self.getStamp()
+                if stamp != self.stamp:
+                    self.stamp = stamp
+                    try:
+                        self.reload()
+                    except Exception, err:
+                        sys.stderr.write(
+                            'error: could not reload labelfile "{loc}": '
+                            '{err!r}\n'.format(
+                                loc=self.filehandler.file_location, err=err))
+
+    def stop(self):
+        '''Stop the watcher thread and stop watching the labelfile'''
+
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
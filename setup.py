@@ -43,5 +43,6 @@ setup(
         'Topic :: Security :: Cryptography',
         'Topic :: Utilities',
     ],
-    scripts=['scripts/dispass', 'scripts/gdispass', 'scripts/dispass-label'],
+    scripts=['scripts/dispass', 'scripts/gdispass', 'scripts/dispass-label',
+             'scripts/dispass-complete'],
     )